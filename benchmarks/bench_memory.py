@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -
+"""Memory retained by result of `Packet.parse` of a synthetic catalogue and offers pack.
+
+Reports memory which is reclaimed if parsed items don't keep references to xml
+and the size of a parsed product and offer.
+
+Only memory allocated by python is traced, so the size of libxml2 tree
+is not included. The tree is freed only if nothing refers to it.
+
+Usage: python -m benchmarks.bench_memory [products_count]
+"""
+import os
+import gc
+import sys
+import tracemalloc
+from io import BytesIO
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+django.setup()
+
+from cml import items  # noqa: E402
+from tests.synthetic import packet_xml  # noqa: E402
+
+
+def retained(data: bytes, **kwargs) -> int:
+    gc.collect()
+    tracemalloc.start()
+    try:
+        pack = items.Packet.parse(BytesIO(data), **kwargs)
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del pack
+    return size
+
+
+def main(count=20000):
+    data = packet_xml(products=count, offers=count)
+    kept = retained(data, keep_xml_elements=True)
+    dropped = retained(data, keep_xml_elements=False)
+    print(f'products={count} offers={count}: '
+          f'keep_xml_elements=True {kept / 2 ** 20:.1f} MiB, '
+          f'keep_xml_elements=False {dropped / 2 ** 20:.1f} MiB, '
+          f'reclaimed {(kept - dropped) / 2 ** 20:.1f} MiB')
+
+    empty = retained(packet_xml(classifier=False), keep_xml_elements=False)
+    for name, data in (('product', packet_xml(products=count, classifier=False)),
+                       ('offer', packet_xml(offers=count, classifier=False))):
+        size = retained(data, keep_xml_elements=False) - empty
+        print(f'{name}: {size / count:.0f} bytes')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -
+"""Time of parsing a synthetic packet serially and by process pool.
+
+Usage: python -m benchmarks.bench_parallel [products_count] [processes]
+"""
+import os
+import sys
+import time
+from io import BytesIO
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+django.setup()
+
+from cml import items  # noqa: E402
+from tests.synthetic import packet_xml  # noqa: E402
+
+
+def measure(data: bytes, processes: int) -> float:
+    t = time.perf_counter()
+    items.Packet.parse(BytesIO(data), keep_xml_elements=False, processes=processes)
+    return time.perf_counter() - t
+
+
+def main(count=20000, processes=None):
+    processes = processes or os.cpu_count()
+    data = packet_xml(products=count, offers=count)
+    serial = measure(data, 1)
+    parallel = measure(data, processes)
+    print(f'products={count} offers={count} cpus={os.cpu_count()}: '
+          f'serial {serial:.2f}s, processes={processes} {parallel:.2f}s, speedup x{serial / parallel:.2f}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
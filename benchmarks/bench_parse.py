@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -
+"""Throughput of parsing a synthetic catalogue and offers pack.
+
+Compares single pass parsing of `XmlFields` tables with
+lookup of every field by `XmlElement.find/findall` (the way it was done before).
+
+Results vary between runs by 10-20%. With 3000 items, offers are parsed
+about x1.25-x1.5 faster with or without namespace. The gain for products
+is within the noise (x0.9-x1.2), because their parsing is dominated by
+resolution of FileRef paths.
+
+Usage: python -m benchmarks.bench_parse [products_count]
+"""
+import gc
+import os
+import sys
+import time
+from io import BytesIO
+from unittest import mock
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'tests.settings')
+django.setup()
+
+from cml import items  # noqa: E402
+from cml.xml import XmlElement, XmlFields  # noqa: E402
+from tests.synthetic import packet_xml  # noqa: E402
+
+
+def parse_by_find(self: XmlFields, el: XmlElement, obj):
+    for field in self.fields:
+        if field.many:
+            value = el.findall(field.path, converter=field.converter, converter_xml=field.converter_xml,
+                               required=field.required)
+        else:
+            value = el.find(field.path, converter=field.converter, converter_xml=field.converter_xml,
+                            required=field.required, default=field.default)
+        setattr(obj, field.attr, value)
+    return obj
+
+
+def measure(parse_xml, el: XmlElement) -> float:
+    gc.disable()
+    try:
+        t = time.perf_counter()
+        parse_xml(el)
+        return time.perf_counter() - t
+    finally:
+        gc.enable()
+
+
+def compare(parse_xml, el: XmlElement, repeat=7) -> (float, float):
+    """Best times of parsing before and after. Runs alternate, so both are equally affected by noise"""
+    before = after = None
+    for _ in range(repeat):
+        with mock.patch.object(XmlFields, 'parse', parse_by_find):
+            t = measure(parse_xml, el)
+        before = t if before is None else min(before, t)
+        t = measure(parse_xml, el)
+        after = t if after is None else min(after, t)
+    return before, after
+
+
+def main(count=5000):
+    for namespace in (False, True):
+        root = XmlElement.parse(BytesIO(packet_xml(products=count, offers=count, namespace=namespace)))
+        for name, parse_xml, el in (
+                ('products', items.Catalogue.parse_xml, root.find('Каталог')),
+                ('offers', items.OffersPack.parse_xml, root.find('ПакетПредложений'))):
+            before, after = compare(parse_xml, el)
+            print(f'namespace={namespace!s:5} {name}={count}: '
+                  f'before {count / before:.0f} items/s, after {count / after:.0f} items/s, '
+                  f'speedup x{before / after:.2f}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
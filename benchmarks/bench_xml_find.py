@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -
+"""Per-element cost of XmlElement.find/findall.
+
+Compares lookups of offer fields the old way (ElementPath with `nsmap` per call,
+which is still used as fallback for not compiled paths) with the compiled paths.
+
+Usage: python -m benchmarks.bench_xml_find [offers_count]
+"""
+import sys
+import time
+from io import BytesIO
+from unittest import mock
+from cml.xml import XmlElement
+from tests.synthetic import packet_xml
+
+# Lookups made by Offer.parse_xml and Price.parse_xml
+OFFER_PATHS = ('Ид', 'Наименование', 'Артикул', 'Количество', 'БазоваяЕдиница')
+PRICE_PATHS = ('Представление', 'ИдТипаЦены', 'ЦенаЗаЕдиницу', 'Валюта', 'Единица', 'Коэффициент')
+
+
+def lookup(el: XmlElement):
+    for path in OFFER_PATHS:
+        el.find(path)
+    el.findall('Склад')
+    for price in el.findall('Цены/Цена'):
+        for path in PRICE_PATHS:
+            price.find(path)
+
+
+def measure(offers, func) -> float:
+    t = time.perf_counter()
+    for el in offers:
+        func(el)
+    return (time.perf_counter() - t) / len(offers) * 1e6
+
+
+def main(count=20000):
+    for namespace in (False, True):
+        root = XmlElement.parse(BytesIO(packet_xml(offers=count, namespace=namespace)))
+        offers = root.findall('ПакетПредложений/Предложения/Предложение')
+        with mock.patch('cml.xml._compile_path', lambda path, ns: None):
+            before = measure(offers, lookup)
+        after = measure(offers, lookup)
+        print(f'namespace={namespace!s:5} offers={count}: '
+              f'before {before:.1f} us/offer, after {after:.1f} us/offer, speedup x{before / after:.2f}')
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -1,2 +1,4 @@
 import logging
-logger = logging.getLogger(__name__)
\ No newline at end of file
+logger = logging.getLogger(__name__)
+
+__version__ = '1.0.0.4'
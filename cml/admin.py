@@ -23,6 +23,9 @@ class ExchangeAdmin(admin.ModelAdmin):
         'user',
         'dt_start',
         'file_name',
+        'file_hash',
+        'file_size',
+        'archive_name',
         'c_up',
         'c_up_xml',
         'c_up_img',
@@ -32,6 +35,10 @@ class ExchangeAdmin(admin.ModelAdmin):
         'c_imp_doc',
         'c_exp_doc',
         'state',
+        'job_state',
+        'progress',
+        'import_pos',
+        'job_heartbeat',
         'report',
     )
     ordering = ('-dt_start', )
@@ -93,3 +100,32 @@ class ExchangeAdmin(admin.ModelAdmin):
 
     def has_add_permission(self, request):
         return False
+
+
+@admin.register(ExchangeJob)
+class ExchangeJobAdmin(admin.ModelAdmin):
+    list_display = (
+        'pk',
+        'exchange',
+        'file_name',
+        'state',
+        'priority',
+        'dt_created',
+        'dt_started',
+        'dt_finished',
+        'worker',
+    )
+    list_filter = ('state', )
+    readonly_fields = (
+        'exchange',
+        'file_name',
+        'file_hash',
+        'dt_created',
+        'dt_started',
+        'dt_finished',
+        'worker',
+    )
+    ordering = ('-pk', )
+
+    def has_add_permission(self, request):
+        return False
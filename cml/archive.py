@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -
+"""Zip archives uploaded by 1C if `settings.CML_USE_ZIP` is set.
+
+Archive is indexed once its upload is complete: all files but xml are extracted to the directory
+of the archive, names of members are saved to a file near the archive.
+Xml files are parsed straight from the archive, see `ArchiveMember` and `open_source()`.
+Imported xml files are marked in the index, so the archive is kept until all of them are imported.
+"""
+from __future__ import absolute_import
+import contextlib
+import json
+import os
+import shutil
+import typing
+import zipfile
+from pathlib import Path
+from . import logger
+from .items import FileRef
+
+_INDEX_SUFFIX = '.index.json'
+
+
+class ArchiveMember(object):
+    """Xml file packed in zip archive. It's used as a path of file"""
+
+    def __init__(self, archive_path: str or Path, name: str):
+        self.archive_path = str(archive_path)
+        self.name = name
+
+    def __str__(self):
+        return os.path.join(self.archive_path, self.name)
+
+    def __eq__(self, other):
+        return isinstance(other, ArchiveMember) and (self.archive_path, self.name) == (other.archive_path, other.name)
+
+    def __hash__(self):
+        return hash((self.archive_path, self.name))
+
+
+@contextlib.contextmanager
+def open_source(source: str or Path or ArchiveMember) -> typing.Iterator[typing.BinaryIO]:
+    """Open file or member of archive for reading"""
+    if isinstance(source, ArchiveMember):
+        with zipfile.ZipFile(source.archive_path) as zf, zf.open(source.name) as f:
+            yield f
+    else:
+        with open(source, 'rb') as f:
+            yield f
+
+
+def _stat_key(path: str) -> list:
+    st = os.stat(path)
+    return [st.st_size, st.st_mtime_ns]
+
+
+def _load_index(archive_path: str) -> dict or None:
+    """Index of archive, if it's saved for the current file"""
+    try:
+        with open(archive_path + _INDEX_SUFFIX, 'r') as f:
+            index = json.load(f)
+        if index['stat'] == _stat_key(archive_path):
+            return index
+    except (OSError, ValueError, KeyError):
+        pass
+    return None
+
+
+def _save_index(archive_path: str, index: dict):
+    index_path = archive_path + _INDEX_SUFFIX
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(index, f)
+    os.replace(tmp_path, index_path)
+
+
+def get_index(archive_path: str) -> [str]:
+    """Names of files in archive. Not xml files are extracted when archive is indexed"""
+    index = _load_index(archive_path)
+    if index is not None:
+        return index['names']
+
+    stat_key = _stat_key(archive_path)
+    names = []
+    base_path = os.path.dirname(archive_path)
+    with zipfile.ZipFile(archive_path) as zf:
+        for info in zf.infolist():
+            if info.is_dir():
+                continue
+            fref = FileRef(info.filename, base_path)  # safe path inside of `base_path`
+            name = str(fref.path)
+            names.append(name)
+            if fref.path.suffix == '.xml':
+                continue
+            os.makedirs(fref.full_path.parent, exist_ok=True)
+            with zf.open(info) as src, open(fref.full_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+    _save_index(archive_path, {'stat': stat_key, 'names': names, 'imported': []})
+    logger.info(f'Archive is indexed: {archive_path}, files: {len(names)}')
+    return names
+
+
+def find_member(path: str or Path, archive_path: str or Path) -> ArchiveMember or None:
+    """Find file `path` in zip archive `archive_path`"""
+    archive_path, path = str(archive_path), str(path)
+    if not zipfile.is_zipfile(archive_path):
+        return None
+    if path in get_index(archive_path):
+        return ArchiveMember(archive_path, path)
+    return None
+
+
+def mark_imported(member: ArchiveMember) -> bool:
+    """Save that xml file of archive is imported. Returns True if all xml files of the archive are imported"""
+    get_index(member.archive_path)
+    index = _load_index(member.archive_path)
+    imported = set(index.get('imported', [])) | {member.name}
+    index['imported'] = sorted(imported)
+    _save_index(member.archive_path, index)
+    return all(name in imported for name in index['names'] if name.endswith('.xml'))
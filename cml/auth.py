@@ -2,17 +2,101 @@
 from __future__ import absolute_import
 import six
 import base64
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 from django.http import HttpResponse
-from django.contrib.auth import authenticate, login
+from django.contrib.auth import authenticate, login, get_user_model
+from .conf import settings
 
 
-def view_or_basicauth(view, request, test_func, realm='', *args, **kwargs):
+class CredentialsEntry(object):
+    __slots__ = ('user_id', 'backend', 'stamp', 'expires', 'results')
+
+    def __init__(self, user, expires: float):
+        self.user_id = user.pk
+        self.backend = getattr(user, 'backend', None)
+        self.stamp = CredentialsCache.get_stamp(user)
+        self.expires = expires
+        self.results = {}  # results of test functions of views by their keys
+
+
+class CredentialsCache(object):
+    """
+    Process-local cache of users authenticated by basic auth header,
+    so password hasher doesn't run for each request of 1C.
+
+    Entries are keyed by HMAC of the header, credentials are not kept.
+    Entry is used only while password hash and active flag of the user are the same.
+    Size and time to live are `settings.CML_AUTH_CACHE_SIZE` and `settings.CML_AUTH_CACHE_TTL`.
+    """
+
+    def __init__(self):
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(header: str) -> bytes:
+        return hmac.new(settings.SECRET_KEY.encode(), header.encode(), hashlib.sha256).digest()
+
+    @staticmethod
+    def get_stamp(user) -> bytes:
+        return hashlib.sha256(f'{user.password}:{user.is_active}'.encode()).digest()
+
+    def get_user(self, key: bytes):
+        """User of valid entry and the entry"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None, None
+            if entry.expires <= time.monotonic():
+                del self._entries[key]
+                return None, None
+            self._entries.move_to_end(key)
+
+        user = get_user_model()._default_manager.filter(pk=entry.user_id).first()
+        if user is None or self.get_stamp(user) != entry.stamp:
+            # Password or active flag is changed
+            self.delete(key)
+            return None, None
+        if entry.backend is not None:
+            user.backend = entry.backend
+        return user, entry
+
+    def set(self, key: bytes, user) -> CredentialsEntry:
+        entry = CredentialsEntry(user, time.monotonic() + settings.CML_AUTH_CACHE_TTL)
+        if settings.CML_AUTH_CACHE_TTL > 0 and settings.CML_AUTH_CACHE_SIZE > 0:
+            with self._lock:
+                self._entries[key] = entry
+                self._entries.move_to_end(key)
+                while len(self._entries) > settings.CML_AUTH_CACHE_SIZE:
+                    self._entries.popitem(last=False)
+        return entry
+
+    def delete(self, key: bytes):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+credentials_cache = CredentialsCache()
+
+
+def view_or_basicauth(view, request, test_func, realm='', *args, test_key=None, **kwargs):
     """
     This is a helper function used by both 'logged_in_or_basicauth' and
     'has_perm_or_basicauth' that does the nitty of determining if they
     are already logged in or if they have provided proper http-authorization
     and returning the view if all goes well, otherwise responding with a 401.
+
+    Users authenticated by the header are cached, see `CredentialsCache`.
+    Result of `test_func` is cached with the user by `test_key` if it's given.
     """
     if test_func(request.user):
         # Already logged in, just return the view.
@@ -27,16 +111,28 @@ def view_or_basicauth(view, request, test_func, realm='', *args, **kwargs):
             # NOTE: We are only support basic authentication for now.
             #
             if auth[0].lower() == "basic":
-                if six.PY2:
-                    uname, passwd = base64.b64decode(auth[1]).split(':')
-                else:
-                    uname, passwd = base64.b64decode(auth[1]).decode('utf-8').split(':')
-                user = authenticate(username=uname, password=passwd)
+                key = credentials_cache.make_key(auth[1])
+                user, entry = credentials_cache.get_user(key)
+                if user is None:
+                    if six.PY2:
+                        uname, passwd = base64.b64decode(auth[1]).split(':')
+                    else:
+                        uname, passwd = base64.b64decode(auth[1]).decode('utf-8').split(':')
+                    user = authenticate(username=uname, password=passwd)
+                    if user is not None and user.is_active:
+                        entry = credentials_cache.set(key, user)
+                        login(request, user)
+                # Cached user is not logged in again, so the request doesn't write session and `last_login`.
+                # Session key needed by checkauth is created by the view
                 if user is not None:
                     if user.is_active:
-                        login(request, user)
                         request.user = user
-                        if test_func(request.user):
+                        passed = entry.results.get(test_key)
+                        if passed is None:
+                            passed = test_func(request.user)
+                            if test_key is not None:
+                                entry.results[test_key] = passed
+                        if passed:
                             return view(request, *args, **kwargs)  # type: ignore[attr-defined]
 
     # Either they did not provide an authorization header or
@@ -82,7 +178,7 @@ def logged_in_or_basicauth(realm=''):
         def wrapper(request, *args, **kwargs):
             return view_or_basicauth(func, request,
                                      lambda u: u.is_authenticated,
-                                     realm, *args, **kwargs)  # type: ignore[attr-defined]
+                                     realm, *args, test_key='authenticated', **kwargs)  # type: ignore[attr-defined]
         return wrapper
     return view_decorator
 
@@ -104,6 +200,6 @@ def has_perm_or_basicauth(perm, realm=''):
         def wrapper(request, *args, **kwargs):
             return view_or_basicauth(func, request,
                                      lambda u: u.has_perm(perm),
-                                     realm, *args, **kwargs)  # type: ignore[attr-defined]
+                                     realm, *args, test_key=f'perm:{perm}', **kwargs)  # type: ignore[attr-defined]
         return wrapper
     return view_decorator
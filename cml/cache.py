@@ -0,0 +1,341 @@
+# -*- coding: utf-8 -
+"""Cache of parsed packets on local disk.
+
+Items yielded by `items.Packet.iterparse()` are pickled into gzip files named
+by SHA-256 of the source file. Entries are kept in a directory of the library version,
+directories of other versions are deleted. The least recently used entries are evicted
+when size of cache exceeds `settings.CML_PARSE_CACHE_MAX_SIZE`.
+
+Items are pickled by blocks, each block is a separate gzip member. Offsets of blocks
+are saved to index of entry, so reading may start from any item, see `iterparse_from()`.
+Parsing limited by time is saved as partial entry and continued by the next call,
+see `parse_to_cache()`.
+"""
+from __future__ import absolute_import
+import bisect
+import gzip
+import hashlib
+import io
+import itertools
+import os
+import pickle
+import shutil
+import tempfile
+import time
+import typing
+from django.core.exceptions import ImproperlyConfigured
+from . import __version__, logger, items
+from .archive import open_source
+from .conf import settings
+
+_ENTRY_SUFFIX = '.blocks.gz'
+_INDEX_SUFFIX = '.index.pickle'
+_TMP_SUFFIX = '.tmp'
+_PART = '.part'  # added to key of partial entry
+_BLOCK_ITEMS = 1000  # items pickled together, it bounds memory and count of items read before a position
+_BLOCK_END = None  # marker written at the end of block, so reader starts new unpickler
+
+
+class EntryIndex(typing.NamedTuple):
+    """Positions of the first items of blocks, offsets of blocks in entry file
+    and positions of containers of products and offers.
+    `count` items are stored by `size` bytes of entry file"""
+    blocks: list
+    offsets: list
+    containers: list
+    count: int = 0
+    size: int = 0
+    complete: bool = False
+
+
+def file_hash(path, chunk_size=1024 * 1024) -> str:
+    """SHA-256 of file. `path` may refer to member of archive, see `archive.open_source()`"""
+    h = hashlib.sha256()
+    with open_source(path) as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class PacketCache(object):
+    def __init__(self, root: str = None, max_size: int = None):
+        self.root = root or settings.CML_PARSE_CACHE_ROOT
+        if not self.root:
+            # Entries are unpickled, so the directory must not be writable by untrusted parties
+            raise ImproperlyConfigured('CML_PARSE_CACHE_ROOT is required by parse cache. '
+                                       'Set it to a private directory outside of MEDIA_ROOT')
+        self.max_size = settings.CML_PARSE_CACHE_MAX_SIZE if max_size is None else max_size
+        self.path = os.path.join(self.root, __version__)
+
+    def _entry_path(self, key: str) -> str:
+        return os.path.join(self.path, key + _ENTRY_SUFFIX)
+
+    def _index_path(self, key: str) -> str:
+        return os.path.join(self.path, key + _INDEX_SUFFIX)
+
+    def load(self, key: str, start=0) -> typing.Iterator or None:
+        """Items stored by `key` beginning from position `start` or None if there is no such entry.
+        Blocks of items before `start` are not read"""
+        path = self._entry_path(key)
+        offset, skip = 0, start
+        if start:
+            index = self.load_index(key)
+            if index is None:
+                return None
+            i = bisect.bisect_right(index.blocks, start) - 1
+            offset, skip = index.offsets[i], start - index.blocks[i]
+        try:
+            f = open(path, 'rb')
+        except FileNotFoundError:
+            return None
+        os.utime(path)  # mark as recently used
+        f.seek(offset)
+        return self._load(f, skip)
+
+    @staticmethod
+    def _load(raw, skip: int) -> typing.Iterator:
+        # Gzip members of blocks are read as a single stream
+        with raw, gzip.GzipFile(fileobj=raw, mode='rb') as f:
+            unpickler = pickle.Unpickler(f)
+            while True:
+                try:
+                    it = unpickler.load()
+                except EOFError:
+                    return
+                if it is _BLOCK_END:
+                    unpickler = pickle.Unpickler(f)
+                elif skip:
+                    skip -= 1
+                else:
+                    yield it
+
+    def load_index(self, key: str) -> EntryIndex or None:
+        try:
+            with open(self._index_path(key), 'rb') as f:
+                return pickle.load(f)
+        except FileNotFoundError:
+            return None
+
+    def seek(self, key: str, start: int) -> tuple or None:
+        """The last container before position `start` and items beginning from `start`,
+        the same as `utils.ItemsStream.skip()` of stored items. None if there is no such entry"""
+        index = self.load_index(key)
+        stream = self.load(key, start) if index is not None else None
+        if stream is None:
+            return None
+        container = None
+        i = bisect.bisect_left(index.containers, start)
+        if i:
+            containers = self.load(key, index.containers[i - 1])
+            container = next(containers, None)
+            containers.close()
+        return container, stream
+
+    def store(self, key: str, stream: typing.Iterable) -> typing.Iterator:
+        """Pass items of `stream` through, storing them by `key`.
+        Entry is saved only if `stream` is exhausted."""
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            self._drop_other_versions()
+            fd, tmp_path = tempfile.mkstemp(suffix=_TMP_SUFFIX, dir=self.path)
+        except OSError as e:
+            logger.warning(f'Parse cache is not available: {e}')
+            yield from stream
+            return
+
+        saved = False
+        try:
+            with open(fd, 'wb') as raw:
+                writer = _EntryWriter(raw, EntryIndex([], [], []))
+                for it in stream:
+                    if writer is not None:
+                        try:
+                            writer.add(it)
+                        except Exception as e:
+                            logger.warning(f'Parsed packet cannot be cached: {e}')
+                            writer = None
+                    yield it
+                if writer is not None:
+                    index = writer.close()
+
+            if writer is not None:
+                self._save_index(key, index)
+                os.replace(tmp_path, self._entry_path(key))
+                saved = True
+        finally:
+            if not saved:
+                self._remove(tmp_path)
+
+        self._evict()
+
+    def build(self, key: str, parse: typing.Callable[[int], typing.Iterable],
+              deadline: float = None) -> EntryIndex or None:
+        """Store items of `parse(start)` by `key` until `time.monotonic()` reaches `deadline`.
+        Blocks stored before the deadline are kept as partial entry, and the next call continues it
+        with `start` equal to count of stored items. Returns index of stored items, it's `complete`
+        if items are exhausted. None if items cannot be stored"""
+        part = key + _PART
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            self._drop_other_versions()
+            index = self.load_index(part)
+            if index is None or not os.path.exists(self._entry_path(part)):
+                index = EntryIndex([], [], [])
+            raw = open(self._entry_path(part), 'r+b' if index.count else 'wb')
+        except OSError as e:
+            logger.warning(f'Parse cache is not available: {e}')
+            return None
+
+        with raw:
+            # Blocks written after the last saved index are dropped
+            raw.truncate(index.size)
+            raw.seek(index.size)
+            writer = _EntryWriter(raw, index)
+            for it in parse(index.count):
+                try:
+                    flushed = writer.add(it)
+                except Exception as e:
+                    logger.warning(f'Parsed packet cannot be cached: {e}')
+                    self._remove(self._entry_path(part))
+                    self._remove(self._index_path(part))
+                    return None
+                if flushed and deadline is not None and time.monotonic() >= deadline:
+                    index = writer.index
+                    self._save_index(part, index)
+                    return index
+            index = writer.close()
+
+        self._save_index(key, index)
+        os.replace(self._entry_path(part), self._entry_path(key))
+        self._remove(self._index_path(part))
+        self._evict()
+        return index
+
+    def _save_index(self, key: str, index: EntryIndex):
+        fd, tmp_path = tempfile.mkstemp(suffix=_TMP_SUFFIX, dir=self.path)
+        try:
+            with open(fd, 'wb') as f:
+                pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_path, self._index_path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _drop_other_versions(self):
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            if name != __version__ and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith(_ENTRY_SUFFIX):
+                st = entry.stat()
+                entries.append((st.st_mtime, st.st_size, entry.path))
+            elif not entry.name.endswith((_INDEX_SUFFIX, _TMP_SUFFIX)):
+                # Entry of other format of the same version
+                self._remove(entry.path)
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            if self._remove(path):
+                total -= size
+                self._remove(path[:-len(_ENTRY_SUFFIX)] + _INDEX_SUFFIX)
+
+    @staticmethod
+    def _remove(path) -> bool:
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logger.warning(f'Cannot delete entry of parse cache: {e}')
+            return False
+
+
+class _EntryWriter(object):
+    """Writer of items to entry file by blocks. Index of written blocks is `index`"""
+
+    def __init__(self, raw, index: EntryIndex):
+        self.raw = raw
+        self.index = index
+        self.block = io.BytesIO()
+        self.pickler = None  # of the current block
+        self.count = index.count
+
+    def add(self, it) -> bool:
+        """Pickle item. Returns True if block is written"""
+        # Item is pickled at once, consumer of stream may change it
+        if self.pickler is None:
+            self.index.blocks.append(self.count)
+            self.pickler = pickle.Pickler(self.block, pickle.HIGHEST_PROTOCOL)
+        if isinstance(it, (items.Catalogue, items.OffersPack)):
+            self.index.containers.append(self.count)
+        self.pickler.dump(it)
+        self.count += 1
+        if self.count - self.index.blocks[-1] < _BLOCK_ITEMS:
+            return False
+        self._write_block()
+        return True
+
+    def _write_block(self):
+        """Write pickled items as gzip member"""
+        self.pickler.dump(_BLOCK_END)
+        self.pickler = None
+        self.index.offsets.append(self.raw.tell())
+        self.raw.write(gzip.compress(self.block.getvalue(), compresslevel=3))
+        self.block.seek(0)
+        self.block.truncate()
+        self.raw.flush()
+        self.index = self.index._replace(count=self.count, size=self.raw.tell())
+
+    def close(self) -> EntryIndex:
+        """Write the last block. Returns index of complete entry"""
+        if self.pickler is not None:
+            self._write_block()
+        return self.index._replace(complete=True)
+
+
+def iterparse(path, key: str = None) -> typing.Iterator:
+    """The same as `items.Packet.iterparse()`, but items of a file
+    with the same content are taken from cache without parsing.
+    `key` is `file_hash(path)` if it's known already."""
+    cache = PacketCache()
+    key = key or file_hash(path)
+    stream = cache.load(key)
+    if stream is not None:
+        logger.info(f'Parsed packet is taken from cache: {path}')
+        return stream
+    return cache.store(key, _iterparse(path))
+
+
+def parse_to_cache(path, key: str, deadline: float = None) -> EntryIndex or None:
+    """Parse file to cache until `time.monotonic()` reaches `deadline`, see `PacketCache.build()`.
+    Parsing interrupted by the deadline is continued by the next call: items stored already
+    are parsed again to skip them, but they are not pickled and written.
+    Returns index of the entry, it isn't `complete` if parsing is interrupted. None if items cannot be cached."""
+    cache = PacketCache()
+    index = cache.load_index(key)
+    if index is not None and os.path.exists(cache._entry_path(key)):
+        return index._replace(complete=True)  # entries are saved when complete only
+    logger.info(f'Packet is parsed to cache: {path}')
+    return cache.build(key, lambda start: itertools.islice(_iterparse(path), start, None), deadline)
+
+
+def iterparse_from(path, key: str, start: int) -> tuple or None:
+    """Items of file beginning from position `start` and the last container before it,
+    see `PacketCache.seek()`. If file is not cached yet, it's parsed to cache as a whole,
+    so an import continued from `start` doesn't parse and skip the items before it.
+    None if parsed items cannot be cached."""
+    if parse_to_cache(path, key) is None:
+        return None
+    return PacketCache().seek(key, start)
+
+
+def _iterparse(path) -> typing.Iterator:
+    with open_source(path) as f:
+        yield from items.Packet.iterparse(f, keep_xml_elements=False)
@@ -1,5 +1,6 @@
 import os
 from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from appconf import AppConf
 
 
@@ -10,3 +11,42 @@ class CMLAppCong(AppConf):
     MAX_EXEC_TIME = 60
     USE_ZIP = False
     FILE_LIMIT = 0
+
+    IMPORT_MODE = 'sync'  # 'sync', 'thread', 'sliced' (requires PARSE_CACHE) or 'queue'
+    IMPORT_THREADS = 1
+    WORKER_POLL_INTERVAL = 2  # seconds between checks of job queue by idle `cml_worker`
+    JOB_TIMEOUT = 300  # seconds without heartbeat of running job, then it's failed or queued again
+
+    IMPORT_BATCH_SIZE = 1000
+    KEEP_XML_ELEMENTS = True
+    # Parse products and offers by process pool if greater than 1.
+    # Ignored if PARSE_CACHE is set or parsing is streamed (batches delegate or 'sliced' IMPORT_MODE)
+    PARSE_PROCESSES = 0
+
+    PARSE_CACHE = False
+    # Cache is unpickled, so it must be outside of MEDIA_ROOT and not writable by untrusted parties
+    PARSE_CACHE_ROOT = None  # required with PARSE_CACHE
+    PARSE_CACHE_MAX_SIZE = 1024 ** 3
+    SPECULATIVE_PARSE = False  # parse uploaded xml files to parse cache before import request
+    SPECULATIVE_PARSE_THREADS = 1
+    SPECULATIVE_PARSE_TIMEOUT = 30  # seconds import waits for start of queued speculative parsing, then parses itself
+
+    SKIP_IDENTICAL_IMPORTS = False
+    SKIP_UNCHANGED_ITEMS = False
+    TRACK_REMOVED_PRODUCTS = False
+    TRACK_UNCHANGED_FILES = False  # keep hashes of imported images, so re-uploaded ones are `FileState.UNCHANGED`
+    # Index keeps catalogue data, so it must be outside of MEDIA_ROOT
+    INDEX_PATH = None  # required with SKIP_UNCHANGED_ITEMS, TRACK_REMOVED_PRODUCTS or TRACK_UNCHANGED_FILES
+
+    AUTH_CACHE_TTL = 60  # seconds, 0 disables cache of basic auth credentials
+    AUTH_CACHE_SIZE = 256
+
+    DELEGATE_SCOPE = 'request'  # 'request' or 'exchange': user delegate instance is shared by requests of exchange
+    DELEGATE_EXCHANGES = 4  # max count of instances kept by 'exchange' scope
+    DELEGATE_EXCHANGE_TTL = 600  # seconds, exchange is ended if its instance is unused
+
+    def configure(self):
+        if self.configured_data['IMPORT_MODE'] == 'sliced' and not self.configured_data['PARSE_CACHE']:
+            # Otherwise each request parses the file again to skip the imported items
+            raise ImproperlyConfigured('CML_PARSE_CACHE is required by sliced import mode')
+        return self.configured_data
@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -
+"""Local index of imported items.
+
+Index is a sqlite database on local disk (`settings.CML_INDEX_PATH`).
+It keeps fingerprints of imported items, so unchanged items can be skipped
+by the next import of the same file, uids of products of the last full
+catalogue, so removed products can be found without queries to project models,
+and hashes of imported images, so images uploaded again with the same content
+are reported as `FileState.UNCHANGED`.
+"""
+from __future__ import absolute_import
+import itertools
+import os
+import sqlite3
+import threading
+import typing
+from django.core.exceptions import ImproperlyConfigured
+from .conf import settings
+from .items import ItemBase, FileState, Catalogue, Product
+
+_WRITE_ROWS = 1000  # rows are written by chunks
+
+
+class LocalIndex(object):
+    def __init__(self, path: str = None):
+        self.path = path or settings.CML_INDEX_PATH
+        if not self.path:
+            raise ImproperlyConfigured('CML_INDEX_PATH is required by local index. '
+                                       'Set it to a file outside of MEDIA_ROOT')
+        self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute('CREATE TABLE IF NOT EXISTS fingerprints ('
+                         'kind TEXT, scope TEXT, uid TEXT, fp BLOB, '
+                         'PRIMARY KEY (kind, scope, uid)) WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS seen_uids ('
+                         'scope TEXT, uid TEXT, PRIMARY KEY (scope, uid)) WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS current_uids ('
+                         'scope TEXT, uid TEXT, PRIMARY KEY (scope, uid)) WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS file_hashes ('
+                         'path TEXT PRIMARY KEY, hash TEXT) WITHOUT ROWID')
+            conn.execute('CREATE TABLE IF NOT EXISTS uploaded_files ('
+                         'path TEXT PRIMARY KEY, hash TEXT, stamp TEXT, unchanged INTEGER) WITHOUT ROWID')
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get_fingerprint(self, kind: str, scope: str, uid: str) -> bytes or None:
+        row = self.conn.execute('SELECT fp FROM fingerprints WHERE kind=? AND scope=? AND uid=?',
+                                (kind, scope, uid)).fetchone()
+        return None if row is None else row[0]
+
+    def set_fingerprints(self, kind: str, scope: str, rows: typing.Iterable[typing.Tuple[str, bytes]]):
+        """Write pairs (uid, fingerprint). Changes are visible for this connection until `commit()`"""
+        self.conn.executemany('INSERT OR REPLACE INTO fingerprints (kind, scope, uid, fp) VALUES (?, ?, ?, ?)',
+                              ((kind, scope, uid, fp) for uid, fp in rows))
+
+    def reset_current_uids(self, scope: str):
+        self.conn.execute('DELETE FROM current_uids WHERE scope=?', (scope, ))
+
+    def add_current_uids(self, scope: str, uids: typing.Iterable[str]):
+        """Uids of the catalogue being imported. They are kept until `replace_seen_uids()`,
+        so import may be continued by another connection"""
+        self.conn.executemany('INSERT OR IGNORE INTO current_uids (scope, uid) VALUES (?, ?)',
+                              ((scope, uid) for uid in uids))
+
+    def replace_seen_uids(self, scope: str) -> {str}:
+        """Replace uids seen in `scope` by current ones. Returns uids which are absent now"""
+        conn = self.conn
+        current = 'SELECT uid FROM current_uids WHERE scope=?'
+        removed = {uid for uid, in conn.execute(
+            f'SELECT uid FROM seen_uids WHERE scope=? AND uid NOT IN ({current})', (scope, scope))}
+        conn.execute(f'DELETE FROM seen_uids WHERE scope=? AND uid NOT IN ({current})', (scope, scope))
+        conn.execute('INSERT OR IGNORE INTO seen_uids (scope, uid) '
+                     'SELECT scope, uid FROM current_uids WHERE scope=?', (scope, ))
+        conn.execute('DELETE FROM current_uids WHERE scope=?', (scope, ))
+        return removed
+
+    def set_uploaded_file(self, path: str, file_hash: str, stamp: str):
+        """Hash of uploaded file is compared with hash of the file imported before.
+        `stamp` of file (see `items.FileRef.get_stamp()`) tells if the file is replaced since upload"""
+        self.conn.execute('INSERT OR REPLACE INTO uploaded_files (path, hash, stamp, unchanged) '
+                          'VALUES (?, ?, ?, EXISTS (SELECT 1 FROM file_hashes WHERE path=? AND hash=?))',
+                          (path, file_hash, stamp, path, file_hash))
+
+    def is_unchanged_file(self, path: str, stamp: str) -> bool:
+        row = self.conn.execute('SELECT unchanged FROM uploaded_files WHERE path=? AND stamp=?',
+                                (path, stamp)).fetchone()
+        return row is not None and bool(row[0])
+
+    def save_uploaded_files(self):
+        """Uploaded files are imported, their hashes are compared with the next uploads"""
+        self.conn.execute('INSERT OR REPLACE INTO file_hashes (path, hash) SELECT path, hash FROM uploaded_files')
+
+    def commit(self):
+        if self._conn is not None:
+            self._conn.commit()
+
+    def rollback(self):
+        if self._conn is not None:
+            self._conn.rollback()
+
+    def close(self):
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+_local = threading.local()
+
+
+def get_thread_index() -> LocalIndex:
+    """Index of current thread, e.g. to check states of files of imported items"""
+    index = getattr(_local, 'index', None)
+    if index is None or index.path != settings.CML_INDEX_PATH:
+        if index is not None:
+            index.close()
+        index = _local.index = LocalIndex()
+    return index
+
+
+class ChangesFilter(object):
+    """Filter out items which were imported already with the same fingerprint.
+
+    Fingerprints of passed items are saved by `commit()` after successful import.
+    Without `index` all items are passed.
+    """
+
+    def __init__(self, index: LocalIndex or None, kind: str, scope: str, uid_attr='uid'):
+        self.index = index
+        self.kind = kind
+        self.scope = scope
+        self.uid_attr = uid_attr
+        self.changed = 0
+        self.skipped = 0
+        self._rows = []
+
+    def filter(self, items: typing.Iterable[ItemBase]) -> typing.Iterator[ItemBase]:
+        for it in items:
+            if self.index is not None:
+                uid = getattr(it, self.uid_attr)
+                fp = it.fingerprint()
+                if fp == self.index.get_fingerprint(self.kind, self.scope, uid) and not self._has_new_files(it):
+                    self.skipped += 1
+                    continue
+                self._rows.append((uid, fp))
+                if len(self._rows) >= _WRITE_ROWS:
+                    self._flush()
+            self.changed += 1
+            yield it
+
+    @staticmethod
+    def _has_new_files(it: ItemBase) -> bool:
+        """Item with uploaded files is passed anyway, because files are imported with the item"""
+        refs = itertools.chain(getattr(it, 'images', ()), getattr(it, 'files', ()))
+        return any(fr.get_state() == FileState.UPDATED for fr in refs)
+
+    def _flush(self):
+        self.index.set_fingerprints(self.kind, self.scope, self._rows)
+        self._rows = []
+
+    def flush(self):
+        """Write fingerprints of passed items. They are saved by commit of index"""
+        if self.index is not None and self._rows:
+            self._flush()
+
+
+class RemovedTracker(object):
+    """Find products of the previous full catalogue which are absent in the current one.
+
+    Uids of each full catalogue are kept by `scope` (uid of catalogue).
+    """
+
+    def __init__(self, index: LocalIndex, scope: str):
+        self.index = index
+        self.scope = scope
+        self._uids = []
+
+    def track(self, cat: Catalogue, products: typing.Iterable[Product],
+              resumed=False) -> typing.Iterator[Product]:
+        """Pass `products` through. When they are exhausted, `cat.removed_uids` is set.
+        If `resumed`, uids passed by interrupted import of the catalogue are kept."""
+        index = self.index
+        if not resumed:
+            index.reset_current_uids(self.scope)
+        for it in products:
+            self._uids.append(it.uid)
+            if len(self._uids) >= _WRITE_ROWS:
+                self.flush()
+            yield it
+        self.flush()
+        cat.removed_uids = index.replace_seen_uids(self.scope)
+
+    def flush(self):
+        """Write uids of passed products. Called by interrupted import before commit of index"""
+        if self._uids:
+            self.index.add_current_uids(self.scope, self._uids)
+            self._uids = []
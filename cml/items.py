@@ -1,13 +1,19 @@
 # -*- coding: utf-8 -
 from __future__ import absolute_import
 import os
+import typing
+import hashlib
+import functools
+import contextlib
+import contextvars
 from decimal import Decimal
 from datetime import datetime
 from enum import Enum, IntEnum
 from pathlib import Path
+from types import MappingProxyType
 from . import logger
 from .conf import settings
-from .xml import XmlElement
+from .xml import XmlElement, XmlField, XmlFields
 
 
 def time_from_string(s: str) -> datetime.time:
@@ -27,6 +33,71 @@ def date_to_string(dt: datetime.date) -> str:
     return dt.isoformat()
 
 
+class ParseContext(object):
+    """State shared by parsers of items during single parse of packet.
+
+    :param keep_xml_elements: keep `xml_element` reference in parsed items.
+        While any item refers to its element, the whole xml tree stays in memory.
+        Default is `settings.CML_KEEP_XML_ELEMENTS`.
+
+    Context also holds intern tables, so values which repeat in every offer
+    (uids of price types and stocks, currency names, units, prices) are shared
+    by items instead of being created for each occurrence. See `shared()`.
+    Tables are dropped by `release()` when parsing ends.
+    """
+
+    def __init__(self, keep_xml_elements: bool = None):
+        if keep_xml_elements is None:
+            keep_xml_elements = settings.CML_KEEP_XML_ELEMENTS
+        self.keep_xml_elements = keep_xml_elements
+        self.tables: {typing.Callable: dict} = {}  # converter -> {raw value: converted value}
+        self.units: {tuple: Unit} = {}
+
+    def get_shared(self, converter: typing.Callable[[str], any], raw: str) -> any:
+        table = self.tables.get(converter)
+        if table is None:
+            table = self.tables[converter] = {}
+        res = table.get(raw)
+        if res is None:
+            res = table[raw] = converter(raw)
+        return res
+
+    def release(self):
+        self.tables = {}
+        self.units = {}
+
+    @contextlib.contextmanager
+    def activate(self):
+        token = _parse_context.set(self)
+        try:
+            yield self
+        finally:
+            _parse_context.reset(token)
+
+    @classmethod
+    def current(cls) -> 'ParseContext' or None:
+        return _parse_context.get()
+
+
+_parse_context = contextvars.ContextVar('cml_parse_context', default=None)
+
+
+def shared(converter: typing.Callable[[str], any]) -> typing.Callable[[str], any]:
+    """Wrap `converter` of immutable values, so equal raw values give the same object
+    during parsing of packet"""
+    @functools.wraps(converter)
+    def convert(raw: str):
+        ctx = _parse_context.get()
+        if ctx is None:
+            return converter(raw)
+        return ctx.get_shared(converter, raw)
+    return convert
+
+
+shared_str = shared(str)
+shared_decimal = shared(Decimal)
+
+
 class Packet(object):
     """Represent packet with current supported version.
     Has methods for parsing and packing xml"""
@@ -41,16 +112,128 @@ class Packet(object):
         self.docs: [Document] = []
 
     @classmethod
-    def parse(cls, source: str or bytes) -> 'Packet':
+    def parse(cls, source: str or bytes, keep_xml_elements: bool = None, processes: int = None) -> 'Packet':
+        """Parse whole packet.
+
+        If `keep_xml_elements` is false, parsed items don't refer to xml
+        and the tree is freed right after parsing. See `ParseContext`.
+        If `processes` (`settings.CML_PARSE_PROCESSES` by default) is greater than 1,
+        products and offers are parsed by process pool. See `cml.parallel`.
+        """
+        processes = settings.CML_PARSE_PROCESSES if processes is None else processes
+        if processes > 1:
+            from . import parallel
+            return parallel.parse(source, processes, keep_xml_elements)
+
         el = XmlElement.parse(source)
-        return cls.parse_xml(el)
+        ctx = ParseContext(keep_xml_elements)
+        try:
+            with ctx.activate():
+                return cls.parse_xml(el)
+        finally:
+            ctx.release()
+
+    _stream_tags = ('КоммерческаяИнформация', 'Классификатор', 'Каталог', 'Товары', 'Товар',
+                    'ПакетПредложений', 'Предложения', 'Предложение', 'Документ')
+
+    @classmethod
+    def iterparse(cls, source: str or bytes,
+                  keep_xml_elements: bool = None) -> typing.Iterator['Packet' or ItemBase]:
+        """Parse packet iteratively. Memory usage doesn't depend on size of source.
+
+        Yields objects in the document order:
+        `Packet` without content first, then `Classifier`, `Catalogue` with empty `products`
+        followed by each of its `Product`, `OffersPack` with empty `offers` followed by
+        each of its `Offer`, and each `Document`.
+
+        Xml elements are released after processing,
+        so `xml_element` of yielded objects refers to empty elements.
+        """
+        ctx = ParseContext(keep_xml_elements)
+
+        def parse(parse_xml, el_: XmlElement):
+            # Context is activated per item, because caller runs between yields
+            with ctx.activate():
+                return parse_xml(el_)
+
+        root = None
+        headers = set()  # containers which headers were already yielded
+
+        try:
+            for event, el in XmlElement.iterparse(source, cls._stream_tags):
+                if root is None:
+                    root = el.el
+                    yield parse(cls.parse_xml_header, el)
+                    continue
+
+                parent = el.el.getparent()
+                name = el.name
+
+                if event == 'start':
+                    # Items list begins, so header elements of container are complete
+                    if name in ('Товары', 'Предложения') and parent.getparent() is root:
+                        container = el.getparent()
+                        if container.name == 'Каталог':
+                            headers.add(parent)
+                            yield parse(Catalogue.parse_xml_header, container)
+                        elif container.name == 'ПакетПредложений':
+                            headers.add(parent)
+                            yield parse(OffersPack.parse_xml_header, container)
+                    continue
+
+                if parent is root:
+                    if name == 'Классификатор':
+                        yield parse(Classifier.parse_xml, el)
+                    elif name == 'Каталог' and el.el not in headers:
+                        yield parse(Catalogue.parse_xml_header, el)
+                    elif name == 'ПакетПредложений' and el.el not in headers:
+                        yield parse(OffersPack.parse_xml_header, el)
+                    elif name == 'Документ':
+                        yield parse(Document.parse_xml, el)
+                    headers.discard(el.el)
+                    el.release()
+                elif name in ('Товар', 'Предложение') and parent.getparent() in headers:
+                    if name == 'Товар':
+                        yield parse(Product.parse_xml, el)
+                    else:
+                        yield parse(Offer.parse_xml, el)
+                    el.release()
+        finally:
+            ctx.release()
+
+    @classmethod
+    def from_items(cls, stream: typing.Iterable['Packet' or ItemBase]) -> 'Packet':
+        """Assemble packet from objects yielded by `iterparse()`"""
+        pack = None
+        for it in stream:
+            if isinstance(it, Packet):
+                pack = it
+            elif isinstance(it, Classifier):
+                pack.classifier = it
+            elif isinstance(it, Catalogue):
+                pack.catalogue = it
+            elif isinstance(it, Product):
+                pack.catalogue.products.append(it)
+            elif isinstance(it, OffersPack):
+                pack.offers_pack = it
+            elif isinstance(it, Offer):
+                pack.offers_pack.offers.append(it)
+            elif isinstance(it, Document):
+                pack.docs.append(it)
+        return pack
 
     def compose(self) -> bytes:
         el = self.compose_xml()
         return el.compose()
 
+    def compose_stream(self, docs: typing.Iterable['Document'] = None) -> typing.Iterator[bytes]:
+        """Compose packet by chunks. Documents are composed one by one while iterating,
+        so `docs` may be a generator. Default is `self.docs`."""
+        el = self.compose_xml_header()
+        return el.compose_stream(doc.compose_xml() for doc in (self.docs if docs is None else docs))
+
     @classmethod
-    def parse_xml(cls, el: XmlElement) -> 'Packet':
+    def parse_xml_header(cls, el: XmlElement) -> 'Packet':
         ver = el.get_attr('ВерсияСхемы', converter=str)
         if ver != "2.08":
             logger.warning('Version of scheme is no 2.08. Errors unattended possibly')
@@ -58,13 +241,19 @@ class Packet(object):
         pack = cls()
         pack.version = ver
         pack.create_date = el.get_attr('ДатаФормирования', converter=datetime.fromisoformat)
+        return pack
+
+    @classmethod
+    def parse_xml(cls, el: XmlElement) -> 'Packet':
+        pack = cls.parse_xml_header(el)
         pack.classifier = el.find('Классификатор', converter_xml=Classifier.parse_xml, required=False)
         pack.catalogue = el.find('Каталог', converter_xml=Catalogue.parse_xml, required=False)
         pack.offers_pack = el.find('ПакетПредложений', converter_xml=OffersPack.parse_xml, required=False)
         pack.docs = el.findall('Документ', converter_xml=Document.parse_xml)
         return pack
 
-    def compose_xml(self, tag='КоммерческаяИнформация') -> XmlElement:
+    def compose_xml_header(self, tag='КоммерческаяИнформация') -> XmlElement:
+        """Compose all but documents"""
         el = XmlElement(tag)
         el.set_attr('ВерсияСхемы', '2.08')
         el.set_attr('ДатаФормирования', self.create_date.isoformat(timespec='seconds'))
@@ -74,6 +263,10 @@ class Packet(object):
             el.append(self.catalogue.compose_xml())
         if self.offers_pack:
             el.append(self.offers_pack.compose_xml())
+        return el
+
+    def compose_xml(self, tag='КоммерческаяИнформация') -> XmlElement:
+        el = self.compose_xml_header(tag)
         for doc in self.docs:
             el.append(doc.compose_xml())
         return el
@@ -81,14 +274,90 @@ class Packet(object):
 
 # Base element for any xml parsing
 class ItemBase(object):
+    # Subclasses without own __slots__ have __dict__ as usual.
+    # Items which are created for each product or offer define __slots__ to be compact
+    __slots__ = ('xml_element', )
+
     def __init__(self, xml_element=None, *args, **kwargs):
+        if xml_element is not None:
+            ctx = _parse_context.get()
+            keep = settings.CML_KEEP_XML_ELEMENTS if ctx is None else ctx.keep_xml_elements
+            if not keep:
+                xml_element = None
         self.xml_element = xml_element
 
+    def fingerprint(self) -> bytes:
+        """Stable hash of parsed fields. Equal items of different parses have equal fingerprints"""
+        out = []
+        _canonical(self, out)
+        return hashlib.blake2b('\x1f'.join(out).encode(), digest_size=16).digest()
+
+
+def _canonical(value, out: list):
+    """Append canonical representation of parsed `value` to `out`"""
+    if isinstance(value, (list, tuple)):
+        out.append('[')
+        for v in value:
+            _canonical(v, out)
+        out.append(']')
+    elif isinstance(value, (dict, MappingProxyType)):
+        out.append('{')
+        for k in sorted(value, key=repr):
+            out.append(repr(k))
+            _canonical(value[k], out)
+        out.append('}')
+    elif isinstance(value, ItemBase):
+        attrs = dict(getattr(value, '__dict__', {}))
+        for cls in type(value).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if isinstance(getattr(cls, name.lstrip('_'), None), _LazyDefault):
+                    name = name.lstrip('_')  # default is created, so fingerprint doesn't depend on access
+                if name not in attrs and hasattr(value, name):
+                    attrs[name] = getattr(value, name)
+        out.append(type(value).__name__)
+        for name in sorted(attrs):
+            if name != 'xml_element':
+                out.append(name)
+                _canonical(attrs[name], out)
+    elif isinstance(value, FileRef):
+        out.append(str(value.path))
+    else:
+        out.append(repr(value))
+
 
 def as_bool(value: str) -> bool:
     return value == 'true'
 
 
+# Shared default of compact items. Decimal is immutable, so it's never changed by users of items
+_decimal_zero = Decimal()
+
+
+class _LazyDefault(object):
+    """Attribute of compact item, which mutable default value is created on the first access.
+    Value is kept by slot `_<name>`, so items don't share defaults and don't keep unused ones"""
+
+    def __init__(self, factory: typing.Callable):
+        self.factory = factory
+        self.slot = None
+
+    def __set_name__(self, owner, name):
+        self.slot = '_' + name
+
+    def __get__(self, obj, owner=None):
+        if obj is None:
+            return self
+        try:
+            return getattr(obj, self.slot)
+        except AttributeError:
+            value = self.factory()
+            setattr(obj, self.slot, value)
+            return value
+
+    def __set__(self, obj, value):
+        setattr(obj, self.slot, value)
+
+
 #
 # Classifier section
 #
@@ -105,17 +374,19 @@ class Classifier(ItemBase):
         self.categories: [Category] = []  # Don't use this data for naming product groups
         self.units: [Unit] = []
 
+    xml_fields = XmlFields(lambda: (
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Наименование', 'name', converter=str),
+        XmlField('Владелец', 'owner', converter_xml=Partner.parse_xml, many=True),
+        XmlField('Группы/Группа', 'groups', converter_xml=Group.parse_xml, many=True),
+        XmlField('Свойства/Свойство', 'props', converter_xml=Property.parse_xml, many=True),
+        XmlField('Категории/Категория', 'categories', converter_xml=Category.parse_xml, many=True),
+        XmlField('ЕдиницыИзмерения/ЕдиницаИзмерения', 'units', converter_xml=Unit.parse_xml, many=True),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement) -> 'Classifier':
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.name = el.find('Наименование', converter=str)
-        it.owner = el.findall('Владелец', converter_xml=Partner.parse_xml)
-        it.groups = el.findall('Группы/Группа', converter_xml=Group.parse_xml)
-        it.props = el.findall('Свойства/Свойство', converter_xml=Property.parse_xml)
-        it.categories = el.findall('Категории/Категория', converter_xml=Category.parse_xml)
-        it.units = el.findall('ЕдиницыИзмерения/ЕдиницаИзмерения', converter_xml=Unit.parse_xml)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
     def compose_xml(self, tag='Классификатор') -> XmlElement:
         el = XmlElement(tag)
@@ -143,11 +414,14 @@ class Partner(ItemBase):
         self.name = ''
         self.fields = {}
 
+    xml_fields = XmlFields((
+        XmlField('Ид', 'uid', converter=str, default=''),
+        XmlField('Наименование', 'name', converter=str, default=''),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement) -> 'Partner':
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str, default='')
-        it.name = el.find('Наименование', converter=str, default='')
+        it = cls.xml_fields.parse(el, cls(el))
         # for eli in el.findall('*'):
         #     it.fields[eli.tag] = eli.text
         return it
@@ -161,14 +435,16 @@ class Group(ItemBase):
         self.description = ''
         self.groups: [Group] = []
 
+    xml_fields = XmlFields(lambda: (
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Наименование', 'name', converter=str),
+        XmlField('Описание', 'description', converter=str, required=False),
+        XmlField('Группы/Группа', 'groups', converter_xml=Group.parse_xml, many=True),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement):
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.name = el.find('Наименование', converter=str)
-        it.description = el.find('Описание', converter=str, required=False)
-        it.groups = el.findall('Группы/Группа', converter_xml=Group.parse_xml)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
     def __repr__(self):
         return f'{self.name}: {self.groups}'
@@ -199,20 +475,24 @@ class Property(ItemBase):
         else:
             return f'{self.name}: {self.value_type}'
 
+    xml_fields = XmlFields((
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Наименование', 'name', converter=str),
+        XmlField('ТипЗначений', 'value_type', converter=ValueType),
+        XmlField('Множественное', 'is_multi', converter=as_bool, default=False),
+        XmlField('Обязательное', 'is_required', converter=as_bool, default=False),
+        XmlField('ДляТоваров', 'for_products', converter=as_bool),
+        XmlField('ВариантыЗначений/*/Значение', 'variants', converter=str, many=True),
+        XmlField('ВариантыЗначений/Справочник', 'variants_list', many=True),  # converted below
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement):
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.name = el.find('Наименование', converter=str)
-        it.value_type = el.find('ТипЗначений', converter=ValueType)
-        it.is_multi = el.find('Множественное', converter=as_bool, default=False)
-        it.is_required = el.find('Обязательное', converter=as_bool, default=False)
-        it.for_products = el.find('ДляТоваров', converter=as_bool)
-
-        it.variants = el.findall('ВариантыЗначений/*/Значение', converter=str)
+        it = cls.xml_fields.parse(el, cls(el))
         if it.value_type == ValueType.LIST:
-            it.variants_list = el.findall('ВариантыЗначений/Справочник',
-                                          converter_xml=PropertyVariant.parse_xml)
+            it.variants_list = [PropertyVariant.parse_xml(el_var) for el_var in it.variants_list]
+        else:
+            it.variants_list = []
         return it
 
 
@@ -225,12 +505,14 @@ class PropertyVariant(ItemBase):
     def __repr__(self):
         return str(self.value)
 
+    xml_fields = XmlFields((
+        XmlField('ИдЗначения', 'uid', converter=str),
+        XmlField('Значение', 'value', converter=str),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement):
-        it = cls(el)
-        it.uid = el.find('ИдЗначения', converter=str)
-        it.value = el.find('Значение', converter=str)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
 
 class Category(ItemBase):
@@ -240,19 +522,23 @@ class Category(ItemBase):
         self.name = ''
         self.property_ids: [str] = []  # Some of these property id could not be present in Classifier().props
 
+    xml_fields = XmlFields((
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Наименование', 'name', converter=str),
+        XmlField('Свойства/Ид', 'property_ids', converter=str, many=True),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement):
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.name = el.find('Наименование', converter=str)
-        it.property_ids = el.findall('Свойства/Ид', converter=str)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
     def __repr__(self):
         return f'{self.name}'
 
 
 class Unit(ItemBase):
+    __slots__ = ('unit_id', 'name_full', 'abbr_intern', 'name_intern')
+
     def __init__(self, *args, **kwargs):
         super(Unit, self).__init__(*args, **kwargs)  # type: ignore
         self.unit_id: int = 796  # Piece code
@@ -261,6 +547,19 @@ class Unit(ItemBase):
 
     @classmethod
     def parse_xml_ref(cls, el: XmlElement):
+        ctx = _parse_context.get()
+        if ctx is None:
+            return cls._parse_xml_ref(el)
+
+        # Equal units are shared, so the unit refers to the first of equal elements
+        key = (el.el.get('Код'), el.el.get('НаименованиеПолное'), el.el.get('МеждународноеСокращение'))
+        it = ctx.units.get(key)
+        if it is None:
+            it = ctx.units[key] = cls._parse_xml_ref(el)
+        return it
+
+    @classmethod
+    def _parse_xml_ref(cls, el: XmlElement):
         it = cls(el)
         it.unit_id = el.get_attr('Код', converter=int)
         it.name_full = el.get_attr('НаименованиеПолное')
@@ -274,13 +573,15 @@ class Unit(ItemBase):
         el.set_attr('МеждународноеСокращение', self.abbr_intern)
         return el
 
+    xml_fields = XmlFields((
+        XmlField('Код', 'unit_id', converter=int),
+        XmlField('НаименованиеПолное', 'name_full', converter=str),
+        XmlField('МеждународноеСокращение', 'name_intern', converter=str),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement):
-        it = cls(el)
-        it.unit_id = el.find('Код', converter=int)
-        it.name_full = el.find('НаименованиеПолное', converter=str)
-        it.name_intern = el.find('МеждународноеСокращение', converter=str)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
     def compose_xml(self, tag='ЕдиницаИзмерения'):
         el = XmlElement(tag)
@@ -306,17 +607,34 @@ class Catalogue(ItemBase):
         self.name = ''
         self.owner = {}
         self.products: [Product] = []
+        # Uids of products of the previous full catalogue which are absent in this one.
+        # It's set while import if `settings.CML_TRACK_REMOVED_PRODUCTS` and not `has_changes_only`
+        self.removed_uids: {str} or None = None
+
+    xml_fields_header = XmlFields((
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('ИдКлассификатора', 'classify_id', converter=str),
+        XmlField('Наименование', 'name', converter=str),
+        XmlField('Владелец', 'owner', converter_xml=Partner.parse_xml, many=True),
+    ))
+    xml_fields = XmlFields(lambda: Catalogue.xml_fields_header.fields + (
+        XmlField('Товары/Товар', 'products', converter_xml=Product.parse_xml, many=True),
+    ))
 
     @classmethod
-    def parse_xml(cls, el: XmlElement):
+    def _parse_xml(cls, el: XmlElement, xml_fields: XmlFields):
         it = cls(el)
-        it.has_changes_only = el.get_attr('СодержитТолькоИзменения', converter=bool, default=False)
-        it.uid = el.find('Ид', converter=str)
-        it.classify_id = el.find('ИдКлассификатора', converter=str)
-        it.name = el.find('Наименование', converter=str)
-        it.owner = el.findall('Владелец', converter_xml=Partner.parse_xml)
-        it.products = el.findall('Товары/Товар', converter_xml=Product.parse_xml)
-        return it
+        it.has_changes_only = el.get_attr('СодержитТолькоИзменения', converter=as_bool, default=False)
+        return xml_fields.parse(el, it)
+
+    @classmethod
+    def parse_xml_header(cls, el: XmlElement):
+        """Parse all but products"""
+        return cls._parse_xml(el, cls.xml_fields_header)
+
+    @classmethod
+    def parse_xml(cls, el: XmlElement):
+        return cls._parse_xml(el, cls.xml_fields)
 
     def compose_xml(self) -> XmlElement:
         el = XmlElement('Каталог')
@@ -340,6 +658,16 @@ class ProductStatus(Enum):
 
 
 class Product(ItemBase):
+    __slots__ = ('status', 'uid', 'vendor_code', 'code', 'name', '_unit', 'group_uids', 'category_uid', 'desc',
+                 '_prop_values', '_requisites', '_files', '_images', '_taxes', 'sku_id', 'tax_name')
+
+    unit: 'Unit' = _LazyDefault(Unit)
+    prop_values: ['PropertyValue'] = _LazyDefault(list)
+    requisites: {str, str} = _LazyDefault(dict)
+    files: ['FileRef'] = _LazyDefault(list)
+    images: ['FileRef'] = _LazyDefault(list)  # Order is important. First record represent main image
+    taxes: ['Tax'] = _LazyDefault(list)
+
     def __init__(self, *args, **kwargs):
         super(Product, self).__init__(*args, **kwargs)  # type: ignore
         self.status = ProductStatus.NEW
@@ -347,14 +675,9 @@ class Product(ItemBase):
         self.vendor_code = ''
         self.code = ''
         self.name = ''
-        self.unit = Unit()
         self.group_uids: [str] or None = None  # Note: if this is None, add product to the global group
         self.category_uid = ''
         self.desc = ''
-        self.prop_values: [PropertyValue] = []
-        self.requisites: {str, str} = {}
-        self.files: [FileRef] = []
-        self.images: [FileRef] = []  # Order is important. First record represent main image
 
         self.sku_id = ''
         self.tax_name = ''
@@ -363,47 +686,50 @@ class Product(ItemBase):
         return self.name
 
     @staticmethod
-    def _imp_requisites(el: XmlElement) -> {str, str}:
-        res = {}
-        for el_req in el.findall('ЗначенияРеквизитов/ЗначениеРеквизита'):
-            id_ = el_req.find('Наименование', converter=str)
-            val = el_req.find('Значение', converter=str)
-            res[id_] = val
-        return res
+    def _parse_requisite(el: XmlElement) -> (str, str):
+        id_ = el.find('Наименование', converter=shared_str)
+        val = el.find('Значение', converter=str)
+        return id_, val
+
+    xml_fields = XmlFields(lambda: (
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Артикул', 'vendor_code', converter=str),
+        XmlField('Код', 'code', converter=str),
+        XmlField('Наименование', 'name', converter=str),
+        XmlField('БазоваяЕдиница', 'unit', converter_xml=Unit.parse_xml_ref),
+        XmlField('Группы/Ид', 'group_uids', converter=shared_str, many=True),
+        XmlField('Категория', 'category_uid', converter=shared_str),
+        XmlField('Описание', 'desc', converter=str, default=''),
+        XmlField('ЗначенияСвойств/ЗначенияСвойства', 'prop_values', converter_xml=PropertyValue.parse_xml, many=True),
+        XmlField('ЗначенияРеквизитов/ЗначениеРеквизита', 'requisites', converter_xml=Product._parse_requisite,
+                 many=True),
+        XmlField('Картинка', 'images', converter=FileRef, many=True),  # files and images are split below
+        XmlField('СтавкиНалогов/СтавкаНалога', 'taxes', converter_xml=Tax.parse_xml, many=True),
+    ))
 
     @classmethod
     def parse_xml(cls, el: XmlElement):
         it = cls(el)
         it.status = el.get_attr('Статус', converter=ProductStatus, default=ProductStatus.CHANGED)
-        it.uid = el.find('Ид', converter=str)
-        it.vendor_code = el.find('Артикул', converter=str)
-        it.code = el.find('Код', converter=str)
-        it.name = el.find('Наименование', converter=str)
-        it.unit = el.find('БазоваяЕдиница', converter_xml=Unit.parse_xml_ref)
-        it.group_uids = el.findall('Группы/Ид', converter=str)
-        it.category_uid = el.find('Категория', converter=str)
-        it.desc = el.find('Описание', converter=str, default='')
-
-        pvals = el.findall('ЗначенияСвойств/ЗначенияСвойства', converter_xml=PropertyValue.parse_xml)
-        it.prop_values = [pval for pval in pvals if not pval.is_empty()]
-
-        it.requisites = cls._imp_requisites(el)
-        # files, images
-        for fr in el.findall('Картинка', converter=FileRef):
-            if fr.is_image_type():
-                it.images.append(fr)
-            else:
-                it.files.append(fr)
-        it.taxes = el.findall('СтавкиНалогов/СтавкаНалога', converter_xml=Tax.parse_xml)
+        cls.xml_fields.parse(el, it)
 
+        it.prop_values = [pval for pval in it.prop_values if not pval.is_empty()]
+        it.requisites = dict(it.requisites)
+        # files, images
+        refs = it.images
+        it.images = [fr for fr in refs if fr.is_image_type()]
+        it.files = [fr for fr in refs if not fr.is_image_type()]
         return it
 
 
 class PropertyValue(ItemBase):
+    __slots__ = ('uid', '_values')
+
+    values: [str] = _LazyDefault(list)
+
     def __init__(self, *args, **kwargs):
         super(PropertyValue, self).__init__(*args, **kwargs)  # type: ignore
         self.uid = ''
-        self.values: [str] = []
 
     def is_empty(self):
         return len(self.values) == 0
@@ -414,17 +740,20 @@ class PropertyValue(ItemBase):
     def __repr__(self):
         return f'{self.uid}[0..{len(self.values)})={self.get_value()}'
 
+    xml_fields = XmlFields((
+        XmlField('Ид', 'uid', converter=shared_str),
+        XmlField('Значение', 'values', converter=str, many=True),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement) -> 'PropertyValue':
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.values = el.findall('Значение', converter=str)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
 
 class FileState(IntEnum):
-    UPDATED = 1   # Replace file
-    PREVIOUS = 2  # Don't do anything
+    UPDATED = 1    # Replace file
+    PREVIOUS = 2   # Don't do anything
+    UNCHANGED = 3  # File is uploaded again with the same content, see `settings.CML_TRACK_UNCHANGED_FILES`
 
 
 class FileRef(object):
@@ -444,11 +773,23 @@ class FileRef(object):
     def is_image_type(self):
         return self.path.suffix in self._image_suffixes
 
+    def get_stamp(self) -> str or None:
+        """Size and modification time of uploaded file. None if file is absent"""
+        try:
+            st = os.stat(self.full_path)
+        except OSError:
+            return None
+        return f'{st.st_size}:{st.st_mtime_ns}'
+
     def get_state(self) -> FileState:
-        if os.path.exists(self.full_path):
-            return FileState.UPDATED
-        else:
+        stamp = self.get_stamp()
+        if stamp is None:
             return FileState.PREVIOUS
+        if settings.CML_TRACK_UNCHANGED_FILES and self.is_image_type():
+            from .index import get_thread_index
+            if get_thread_index().is_unchanged_file(str(self.path), stamp):
+                return FileState.UNCHANGED
+        return FileState.UPDATED
 
 
 class Tax(ItemBase):
@@ -457,12 +798,14 @@ class Tax(ItemBase):
         self.name = ''
         self.value = Decimal()
 
+    xml_fields = XmlFields((
+        XmlField('Наименование', 'name', converter=shared_str),
+        XmlField('Ставка', 'value', converter=shared_decimal),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement) -> 'Tax':
-        it = cls(el)
-        it.name = el.find('Наименование', converter=str)
-        it.value = el.find('Ставка', converter=Decimal)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
 
 #
@@ -484,18 +827,33 @@ class OffersPack(ItemBase):
         self.stocks: [Stock] = []
         self.offers: [Offer] = []
 
+    xml_fields_header = XmlFields(lambda: (
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Наименование', 'name', converter=str),
+        XmlField('ИдКаталога', 'catalogue_uid', converter=str),
+        XmlField('ИдКлассификатора', 'classify_uid', converter=str),
+        XmlField('Владелец', 'owner', converter_xml=Partner.parse_xml),
+        XmlField('ТипыЦен/ТипЦены', 'price_types', converter_xml=PriceType.parse_xml, many=True),
+        XmlField('Склады/Склад', 'stocks', converter_xml=Stock.parse_xml, many=True),
+    ))
+    xml_fields = XmlFields(lambda: OffersPack.xml_fields_header.fields + (
+        XmlField('Предложения/Предложение', 'offers', converter_xml=Offer.parse_xml, many=True),
+    ))
+
     @classmethod
-    def parse_xml(cls, el: XmlElement):
+    def _parse_xml(cls, el: XmlElement, xml_fields: XmlFields):
         it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.name = el.find('Наименование', converter=str)
-        it.catalogue_uid = el.find('ИдКаталога', converter=str)
-        it.classify_uid = el.find('ИдКлассификатора', converter=str)
-        it.owner = el.find('Владелец', converter_xml=Partner.parse_xml)
-        it.price_types = el.findall('ТипыЦен/ТипЦены', converter_xml=PriceType.parse_xml)
-        it.stocks = el.findall('Склады/Склад', converter_xml=Stock.parse_xml)
-        it.offers = el.findall('Предложения/Предложение', converter_xml=Offer.parse_xml)
-        return it
+        it.has_changes_only = el.get_attr('СодержитТолькоИзменения', converter=as_bool, default=False)
+        return xml_fields.parse(el, it)
+
+    @classmethod
+    def parse_xml_header(cls, el: XmlElement):
+        """Parse all but offers"""
+        return cls._parse_xml(el, cls.xml_fields_header)
+
+    @classmethod
+    def parse_xml(cls, el: XmlElement):
+        return cls._parse_xml(el, cls.xml_fields)
 
     def compose_xml(self) -> XmlElement:
         el = XmlElement('ПакетПредложений')
@@ -512,15 +870,17 @@ class PriceType(ItemBase):
         self.tax_name = ''
         self.tax_in_sum = False
 
+    xml_fields = XmlFields((
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Наименование', 'name', converter=str),
+        XmlField('Валюта', 'currency_name', converter=str),
+        XmlField('Налог/Наименование', 'tax_name', converter=str),
+        XmlField('Налог/УчтеноВСумме', 'tax_in_sum', converter=as_bool),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement):
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.name = el.find('Наименование', converter=str)
-        it.currency_name = el.find('Валюта', converter=str)
-        it.tax_name = el.find('Налог/Наименование', converter=str)
-        it.tax_in_sum = el.find('Налог/УчтеноВСумме', converter=as_bool)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
 
 class Stock(ItemBase):
@@ -532,12 +892,14 @@ class Stock(ItemBase):
         self.addr_details = {}
         self.phones: [PhoneNumber] = []
 
+    xml_fields = XmlFields((
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Наименование', 'name', converter=str),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement):
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.name = el.find('Наименование', converter=str)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
 
 class PhoneNumber(ItemBase):
@@ -549,72 +911,82 @@ class PhoneNumber(ItemBase):
 
 
 class Offer(ItemBase):
+    __slots__ = ('product_uid', 'name', 'vendor_code', '_prices', '_stocks', 'stock_count', '_unit')
+
+    prices: ['Price'] = _LazyDefault(list)
+    stocks: ['StockCount'] = _LazyDefault(list)
+    unit: Unit = _LazyDefault(Unit)
+
     def __init__(self, *args, **kwargs):
         super(Offer, self).__init__(*args, **kwargs)  # type: ignore
         self.product_uid = ''
         self.name = ''
         self.vendor_code = ''
-
-        self.prices: [Price] = []
-        self.stocks: [StockCount] = []
         self.stock_count = 0
-        self.unit = Unit()
+
+    xml_fields = XmlFields(lambda: (
+        XmlField('Ид', 'product_uid', converter=str),
+        XmlField('Наименование', 'name', converter=str),
+        XmlField('Артикул', 'vendor_code', converter=str, default=''),
+        XmlField('Цены/Цена', 'prices', converter_xml=Price.parse_xml, many=True),
+        XmlField('Склад', 'stocks', converter_xml=StockCount.parse_xml, many=True),
+        XmlField('Количество', 'stock_count', converter=int),
+        XmlField('БазоваяЕдиница', 'unit', converter_xml=Unit.parse_xml_ref),
+    ))
 
     @classmethod
     def parse_xml(cls, el: XmlElement):
-        it = cls(el)
-        it.product_uid = el.find('Ид', converter=str)
-        it.name = el.find('Наименование', converter=str)
-        it.vendor_code = el.find('Артикул', converter=str, default='')
+        it = cls.xml_fields.parse(el, cls(el))
 
         # Filter zero prices. Sometimes 1C exports zero prices for unsetted price types
-        prices = el.findall('Цены/Цена', converter_xml=Price.parse_xml)
-        it.prices = [it_1 for it_1 in prices if it_1.price != 0]
-        it.stocks = el.findall('Склад', converter_xml=StockCount.parse_xml)
-        it.stock_count = el.find('Количество', converter=int)
-        it.unit = el.find('БазоваяЕдиница', converter_xml=Unit.parse_xml_ref)
-
+        it.prices = [it_1 for it_1 in it.prices if it_1.price != 0]
         return it
 
 
 class Price(ItemBase):
+    __slots__ = ('price_type_uid', 'price', 'currency_name', 'unit_name', 'mul', 'desc', 'description', 'uid',
+                 'ratio')
+
     def __init__(self, *args, **kwargs):
         super(Price, self).__init__(*args, **kwargs)  # type: ignore
         self.price_type_uid = ''
-        self.price = Decimal()
+        self.price = _decimal_zero
         self.currency_name = ''
         self.unit_name = ''
         self.mul = 1
 
+        self.desc = ''
         self.description = ''
         self.uid = ''
-        self.price = Decimal()
-        self.unit_name = ''
-        self.ratio = Decimal()
+        self.ratio = _decimal_zero
+
+    xml_fields = XmlFields((
+        XmlField('Представление', 'desc', converter=str),
+        XmlField('ИдТипаЦены', 'uid', converter=shared_str),
+        XmlField('ЦенаЗаЕдиницу', 'price', converter=shared_decimal),
+        XmlField('Валюта', 'currency_name', converter=shared_str),
+        XmlField('Единица', 'unit_name', converter=shared_str),
+        XmlField('Коэффициент', 'ratio', converter=shared_decimal),
+    ))
 
     @classmethod
     def parse_xml(cls, el: XmlElement):
-        it = cls(el)
-        it.desc = el.find('Представление', converter=str)
-        it.uid = el.find('ИдТипаЦены', converter=str)
-        it.price = el.find('ЦенаЗаЕдиницу', converter=Decimal)
-        it.currency_name = el.find('Валюта', converter=str)
-        it.unit_name = el.find('Единица', converter=str)
-        it.ratio = el.find('Коэффициент', converter=Decimal)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
 
 class StockCount(ItemBase):
+    __slots__ = ('stock_uid', 'count')
+
     def __init__(self, *args, **kwargs):
         super(StockCount, self).__init__(*args, **kwargs)  # type: ignore
         self.stock_uid = ''
-        self.count = Decimal()
+        self.count = _decimal_zero
 
     @classmethod
     def parse_xml(cls, el: XmlElement) -> 'StockCount':
         it = cls(el)
-        it.stock_uid = el.get_attr('ИдСклада', converter=str)
-        it.count = el.get_attr('КоличествоНаСкладе', converter=Decimal)
+        it.stock_uid = el.get_attr('ИдСклада', converter=shared_str)
+        it.count = el.get_attr('КоличествоНаСкладе', converter=shared_decimal)
         return it
 
 #
@@ -668,26 +1040,27 @@ class Document(ItemBase):
     def __repr__(self):
         return f'Document: "{self.doc_type.value}" from: ({self.counterparty_role.value}) {self.uid}'
 
-    @classmethod
-    def parse_xml(cls, el: XmlElement):
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.number = el.find('Номер', converter=str)
+    xml_fields = XmlFields(lambda: (
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Номер', 'number', converter=str),
         # Date and time
-        it.date = el.find('Дата', converter=date_from_string)
-        it.time = el.find('Время', converter=time_from_string, required=False)
+        XmlField('Дата', 'date', converter=date_from_string),
+        XmlField('Время', 'time', converter=time_from_string, required=False),
 
-        it.doc_type = el.find('ХозОперация', converter=DocumentType)
-        it.counterparty_role = el.find('Роль', converter=CounterpartyRole)
-        it.counterparties = el.findall('Контрагенты/Контрагент', converter_xml=Counterparty.parse_xml)
-        it.products = el.findall('Товары/Товар', converter_xml=ProductRef.parse_xml)
+        XmlField('ХозОперация', 'doc_type', converter=DocumentType),
+        XmlField('Роль', 'counterparty_role', converter=CounterpartyRole),
+        XmlField('Контрагенты/Контрагент', 'counterparties', converter_xml=Counterparty.parse_xml, many=True),
+        XmlField('Товары/Товар', 'products', converter_xml=ProductRef.parse_xml, many=True),
 
-        it.currency_name = el.find('Валюта', converter=str)
-        it.currency_rate = el.find('Курс', converter=Decimal)
-        it.sum = el.find('Сумма', converter=Decimal)
-        it.comment = el.find('Комментарий', converter=str)
+        XmlField('Валюта', 'currency_name', converter=shared_str),
+        XmlField('Курс', 'currency_rate', converter=Decimal),
+        XmlField('Сумма', 'sum', converter=Decimal),
+        XmlField('Комментарий', 'comment', converter=str),
+    ))
 
-        return it
+    @classmethod
+    def parse_xml(cls, el: XmlElement):
+        return cls.xml_fields.parse(el, cls(el))
 
     def compose_xml(self) -> XmlElement:
         el = XmlElement('Документ')
@@ -717,22 +1090,27 @@ class Document(ItemBase):
 
 
 class ProductRef(ItemBase):
+    __slots__ = ('product_uid', 'product_name', '_unit', 'price', 'quantity', 'sum', 'uid', 'name')
+
+    unit: Unit = _LazyDefault(Unit)
+
     def __init__(self, *args, **kwargs):
         super(ProductRef, self).__init__(*args, **kwargs)  # type: ignore
         self.product_uid = ''
         self.product_name: str or None = None
-        self.unit = Unit()
-        self.price = Decimal()
-        self.quantity = Decimal()
-        self.sum = Decimal()
+        self.price = _decimal_zero
+        self.quantity = _decimal_zero
+        self.sum = _decimal_zero
+
+    xml_fields = XmlFields((
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Наименование', 'name', converter=str, required=False),
+        XmlField('БазоваяЕдиница', 'unit', converter=Unit.parse_xml_ref),
+    ))
 
     @classmethod
     def parse_xml(cls, el: XmlElement) -> 'ProductRef':
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.name = el.find('Наименование', converter=str, required=False)
-        it.unit = el.find('БазоваяЕдиница', converter=Unit.parse_xml_ref)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
     def compose_xml(self, tag='Товар') -> XmlElement:
         el = XmlElement(tag)
@@ -779,13 +1157,16 @@ class Address(ItemBase):
         el.append(XmlElement('Значение')).text = val
         return el
 
+    xml_fields = XmlFields(lambda: (
+        XmlField('Представление', 'content', converter=str),
+        XmlField('Комментарий', 'comment', converter=str, default=''),
+        XmlField('АдресноеПоле', 'fields', converter_xml=Address._parse_addr_field, many=True),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement) -> 'Address':
-        it = cls(el)
-        it.content = el.find('Представление', converter=str)
-        it.comment = el.find('Комментарий', converter=str, default='')
-        fields = el.findall('АдресноеПоле', converter_xml=cls._parse_addr_field)
-        it.fields = {k: v for k, v in fields}
+        it = cls.xml_fields.parse(el, cls(el))
+        it.fields = {k: v for k, v in it.fields}
         return it
 
     def compose_xml(self, tag='Адрес') -> XmlElement:
@@ -811,16 +1192,18 @@ class Counterparty(ItemBase):
         self.last_name = ''
         self.address: Address or None = None
 
+    xml_fields = XmlFields((
+        XmlField('Ид', 'uid', converter=str),
+        XmlField('Роль', 'role', converter=CounterpartyRole),
+        XmlField('ПолноеНаименование', 'full_name', converter=str),
+        XmlField('Имя', 'name', converter=str),
+        XmlField('Фамилия', 'last_name', converter=str),
+        XmlField('Адрес', 'address', converter=Address.parse_xml),
+    ))
+
     @classmethod
     def parse_xml(cls, el: XmlElement) -> 'Counterparty':
-        it = cls(el)
-        it.uid = el.find('Ид', converter=str)
-        it.role = el.find('Роль', converter=CounterpartyRole)
-        it.full_name = el.find('ПолноеНаименование', converter=str)
-        it.name = el.find('Имя', converter=str)
-        it.last_name = el.find('Фамилия', converter=str)
-        it.address = el.find('Адрес', converter=Address.parse_xml)
-        return it
+        return cls.xml_fields.parse(el, cls(el))
 
     def compose_xml(self, tag='Контрагент') -> XmlElement:
         el = XmlElement(tag)
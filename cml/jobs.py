@@ -0,0 +1,267 @@
+# -*- coding: utf-8 -
+"""Queue of import jobs in database.
+
+With `settings.CML_IMPORT_MODE = 'queue'` the import request only adds `ExchangeJob`.
+Jobs are taken by `cml_worker` command, which may be run by several processes on any node
+with access to the database and to `settings.CML_UPLOAD_ROOT`.
+
+File of job is moved to directory of the job, archive is linked there, so the next exchanges
+may upload files with the same names while the job is queued. The directory is deleted
+when the job is finished.
+"""
+from __future__ import absolute_import
+import contextlib
+import datetime
+import os
+import re
+import shutil
+import socket
+import time
+from pathlib import Path
+from django.db import close_old_connections, transaction
+from django.db.models import Exists, OuterRef, Q
+from django.utils import timezone
+from . import logger
+from . import archive, cache, items
+from .conf import settings
+from .models import Exchange, ExchangeJob, JobState
+
+
+# Catalogue imports are run before offers imports
+PRIORITY = {
+    'catalogue': 10,
+    'offers': 0,
+}
+
+JOBS_DIR = 'jobs'  # directory of files of queued jobs in `settings.CML_UPLOAD_ROOT`
+
+
+def read_header(source) -> items.Catalogue or items.OffersPack or None:
+    """Header of the first catalogue or offers pack of file. Products and offers are not parsed"""
+    with archive.open_source(source) as f:
+        with contextlib.closing(items.Packet.iterparse(f, keep_xml_elements=False)) as stream:
+            for it in stream:
+                if isinstance(it, (items.Catalogue, items.OffersPack)):
+                    return it
+    return None
+
+
+def enqueue(exchange: Exchange, file_name: str, source, file_hash='') -> ExchangeJob:
+    """Add job of file import. Queued offers jobs superseded by the new one are skipped"""
+    header = read_header(source)
+    if isinstance(header, items.Catalogue):
+        kind, catalogue_uid = 'catalogue', header.uid
+    elif isinstance(header, items.OffersPack):
+        kind, catalogue_uid = 'offers', header.catalogue_uid
+    else:
+        kind, catalogue_uid = '', ''
+
+    with transaction.atomic():
+        job = ExchangeJob.objects.create(  # type: ignore[attr-defined]
+            exchange=exchange,
+            file_name=file_name,
+            file_hash=file_hash,
+            kind=kind,
+            catalogue_uid=catalogue_uid,
+            has_changes_only=header is not None and header.has_changes_only,
+            priority=PRIORITY.get(kind, 0),
+        )
+        keep_source(job, source)
+        if kind == 'offers' and catalogue_uid and not job.has_changes_only:
+            supersede_offers(job)
+    return job
+
+
+def get_jobs_root() -> str:
+    return os.path.join(items.FileRef.base_path, JOBS_DIR)
+
+
+def get_job_path(job_id: int) -> str:
+    """Directory of files of job"""
+    return os.path.join(get_jobs_root(), str(job_id))
+
+
+def keep_source(job: ExchangeJob, source):
+    """Move file of job to its directory. Archive is hard linked, its other files may be imported
+    by the next jobs. If link is not possible, e.g. on other device, the archive is copied"""
+    job_path = get_job_path(job.pk)
+    os.makedirs(job_path, exist_ok=True)
+    if isinstance(source, archive.ArchiveMember):
+        dst = os.path.join(job_path, os.path.basename(source.archive_path))
+        try:
+            os.link(source.archive_path, dst)
+        except OSError:
+            shutil.copyfile(source.archive_path, dst)
+    else:
+        shutil.move(str(source), os.path.join(job_path, os.path.basename(job.file_name)))
+
+
+def get_source(job: ExchangeJob) -> 'Path or archive.ArchiveMember or None':
+    """File of job kept by `keep_source()`"""
+    job_path = Path(get_job_path(job.pk))
+    path = job_path / os.path.basename(job.file_name)
+    if path.is_file():
+        return path
+    for archive_path in job_path.glob('*.zip'):
+        return archive.ArchiveMember(archive_path, str(items.FileRef(job.file_name).path))
+    return None
+
+
+def delete_source(job_id: int):
+    """Delete directory of job and directory of jobs, if it's empty"""
+    shutil.rmtree(get_job_path(job_id), ignore_errors=True)
+    try:
+        os.rmdir(get_jobs_root())
+    except OSError:
+        pass
+
+
+def _file_prefix(file_name: str) -> str:
+    """Kind of offers file by its name, e.g. 'prices' of 'prices0_1.xml'.
+    Offers, prices and rests of the same catalogue are imported by separate files"""
+    return re.match(r'[^\W\d_]*', os.path.basename(file_name)).group().lower()
+
+
+def supersede_offers(job: ExchangeJob) -> [int]:
+    """Skip queued offers jobs of previous exchanges of the catalogue of `job`, which has full offers pack.
+    Only files of the same kind are superseded, see `_file_prefix()`.
+    Returns ids of superseded jobs"""
+    old = ExchangeJob.objects.select_for_update(skip_locked=True).filter(  # type: ignore[attr-defined]
+        state=str(JobState.QUEUED),
+        kind='offers',
+        catalogue_uid=job.catalogue_uid,
+        pk__lt=job.pk,
+    ).exclude(exchange_id=job.exchange_id)  # files of one exchange complement each other
+    prefix = _file_prefix(job.file_name)
+    ids = [pk for pk, file_name in old.values_list('pk', 'file_name') if _file_prefix(file_name) == prefix]
+    if not ids:
+        return []
+
+    # Jobs claimed by workers meanwhile are not changed
+    ExchangeJob.objects.filter(pk__in=ids, state=str(JobState.QUEUED)).update(  # type: ignore[attr-defined]
+        state=str(JobState.SUPERSEDED),
+        dt_finished=timezone.now()
+    )
+    superseded = ExchangeJob.objects.filter(pk__in=ids, state=str(JobState.SUPERSEDED))  # type: ignore[attr-defined]
+    ids = list(superseded.values_list('pk', flat=True))
+    msg = f'Import skipped: superseded by offers of exchange {job.exchange_id}'
+    Exchange.objects.filter(pk__in=superseded.values('exchange_id')).update(  # type: ignore[attr-defined]
+        job_state=str(JobState.DONE),
+        report=msg
+    )
+    transaction.on_commit(lambda: [delete_source(pk) for pk in ids])
+    logger.info(f'{msg}. Jobs: {ids}')
+    return ids
+
+
+def get_worker_name() -> str:
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def requeue_stale() -> int:
+    """Queue again running jobs without heartbeat for `settings.CML_JOB_TIMEOUT`, e.g. if worker is killed.
+    Returns count of queued jobs"""
+    stale = timezone.now() - datetime.timedelta(seconds=settings.CML_JOB_TIMEOUT)
+    running = ExchangeJob.objects.filter(state=str(JobState.RUNNING))  # type: ignore[attr-defined]
+    ids = list(running.filter(
+        Q(exchange__job_heartbeat__lt=stale) | Q(exchange__job_heartbeat__isnull=True, dt_started__lt=stale)
+    ).values_list('pk', flat=True))
+    if not ids:
+        return 0
+
+    count = running.filter(pk__in=ids).update(state=str(JobState.QUEUED), worker='', dt_started=None)
+    Exchange.objects.filter(jobs__pk__in=ids, job_state=str(JobState.RUNNING)).update(  # type: ignore[attr-defined]
+        job_state=str(JobState.QUEUED)
+    )
+    logger.warning(f'Stale import jobs are queued again: {ids}')
+    return count
+
+
+def claim(worker: str = None) -> ExchangeJob or None:
+    """Take the queued job with the greatest priority. Jobs locked by other workers are skipped.
+    Offers jobs wait for unfinished catalogue jobs of their exchange.
+    Stale running jobs are queued again before"""
+    requeue_stale()
+    catalogue_pending = ExchangeJob.objects.filter(  # type: ignore[attr-defined]
+        exchange=OuterRef('exchange'),
+        kind='catalogue',
+        state__in=[str(JobState.QUEUED), str(JobState.RUNNING)],
+    )
+    with transaction.atomic():
+        job = ExchangeJob.objects.select_for_update(skip_locked=True).filter(  # type: ignore[attr-defined]
+            state=str(JobState.QUEUED)
+        ).exclude(
+            Q(kind='offers') & Exists(catalogue_pending)
+        ).order_by('-priority', 'pk').first()
+        if job is None:
+            return None
+
+        # Conditional update keeps claim exclusive on databases without row locks, e.g. sqlite
+        fields = dict(state=str(JobState.RUNNING), worker=worker or get_worker_name(), dt_started=timezone.now())
+        if not ExchangeJob.objects.filter(pk=job.pk, state=str(JobState.QUEUED)).update(**fields):  # type: ignore[attr-defined]
+            return None
+        for name, value in fields.items():
+            setattr(job, name, value)
+    return job
+
+
+def run(job: ExchangeJob):
+    """Import file of the job. Result is saved to the job and its `Exchange`"""
+    from .views import ProtocolView
+
+    source = get_source(job)
+    msg = None
+    if source is None:
+        msg = f'File not found: {job.file_name}'
+    elif job.file_hash and cache.file_hash(source) != job.file_hash:
+        msg = f'File is changed since import was queued: {job.file_name}'
+    try:
+        if msg is not None:
+            logger.error(f'Import job {job.pk}: {msg}')
+            Exchange.objects.filter(pk=job.exchange_id).update(  # type: ignore[attr-defined]
+                job_state=str(JobState.FAILED),
+                report=msg
+            )
+            state = str(JobState.FAILED)
+        else:
+            user_id = Exchange.objects.filter(pk=job.exchange_id).values_list(  # type: ignore[attr-defined]
+                'user_id', flat=True).first()
+            # Uploaded files are not deleted, the next exchanges may upload them already
+            ProtocolView.run_import_job(job.exchange_id, source, job.file_hash or None, user_id, delete_files=False)
+            state = Exchange.objects.filter(pk=job.exchange_id).values_list(  # type: ignore[attr-defined]
+                'job_state', flat=True).first()
+    finally:
+        delete_source(job.pk)
+
+    job.state = state or str(JobState.FAILED)
+    job.dt_finished = timezone.now()
+    job.save(update_fields=['state', 'dt_finished'])
+
+
+def run_worker(once=False, max_jobs: int = None, poll_interval: float = None) -> int:
+    """Run queued jobs until `max_jobs` are done. If `once`, stop when queue is empty.
+    Returns count of done jobs"""
+    worker = get_worker_name()
+    poll_interval = settings.CML_WORKER_POLL_INTERVAL if poll_interval is None else poll_interval
+    count = 0
+    while max_jobs is None or count < max_jobs:
+        close_old_connections()
+        job = claim(worker)
+        if job is None:
+            if once:
+                break
+            time.sleep(poll_interval)
+            continue
+
+        logger.info(f'Import job {job.pk} started by {worker}: {job.file_name}')
+        try:
+            run(job)
+        except Exception as e:
+            logger.error(f'Import job {job.pk} failed: {e}', exc_info=True)
+            ExchangeJob.objects.filter(pk=job.pk).update(  # type: ignore[attr-defined]
+                state=str(JobState.FAILED),
+                dt_finished=timezone.now()
+            )
+        close_old_connections()
+        count += 1
+    return count
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from cml import jobs
+
+
+class Command(BaseCommand):
+    help = 'Runs import jobs queued by exchange requests (settings.CML_IMPORT_MODE = \'queue\')'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true',
+                            help='Exit when queue is empty')
+        parser.add_argument('--max-jobs', type=int, default=None,
+                            help='Exit after the number of jobs')
+        parser.add_argument('--poll-interval', type=float, default=None,
+                            help='Seconds between checks of empty queue')
+
+    def handle(self, once=False, max_jobs=None, poll_interval=None, **options):
+        try:
+            count = jobs.run_worker(once=once, max_jobs=max_jobs, poll_interval=poll_interval)
+        except KeyboardInterrupt:
+            return
+        self.stdout.write(f'Done jobs: {count}')
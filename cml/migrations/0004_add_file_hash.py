@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cml', '0003_add_operation'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchange',
+            name='file_hash',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
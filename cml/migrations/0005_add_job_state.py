@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cml', '0004_add_file_hash'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchange',
+            name='job_state',
+            field=models.CharField(blank=True, choices=[('', 'NONE'), ('queued', 'QUEUED'), ('running', 'RUNNING'), ('done', 'DONE'), ('failed', 'FAILED')], default='', max_length=15),
+        ),
+        migrations.AddField(
+            model_name='exchange',
+            name='progress',
+            field=models.CharField(blank=True, default='', max_length=250),
+        ),
+    ]
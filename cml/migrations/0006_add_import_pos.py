@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:28
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cml', '0005_add_job_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchange',
+            name='import_pos',
+            field=models.IntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cml', '0006_add_import_pos'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ExchangeJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('state', models.CharField(choices=[('', 'NONE'), ('queued', 'QUEUED'), ('running', 'RUNNING'), ('done', 'DONE'), ('failed', 'FAILED')], default='queued', max_length=15)),
+                ('priority', models.IntegerField(default=0)),
+                ('dt_created', models.DateTimeField(auto_now_add=True)),
+                ('dt_started', models.DateTimeField(blank=True, null=True)),
+                ('dt_finished', models.DateTimeField(blank=True, null=True)),
+                ('file_name', models.CharField(max_length=250)),
+                ('file_hash', models.CharField(blank=True, default='', max_length=64)),
+                ('worker', models.CharField(blank=True, default='', max_length=250)),
+                ('exchange', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='jobs', to='cml.exchange')),
+            ],
+            options={
+                'verbose_name': 'Exchange job',
+                'verbose_name_plural': 'Exchange jobs',
+                'ordering': ['-priority', 'pk'],
+            },
+        ),
+        migrations.AddIndex(
+            model_name='exchangejob',
+            index=models.Index(fields=['state', '-priority', 'id'], name='cml_exchang_state_0092fa_idx'),
+        ),
+    ]
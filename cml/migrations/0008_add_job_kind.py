@@ -0,0 +1,38 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cml', '0007_add_exchange_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchangejob',
+            name='catalogue_uid',
+            field=models.CharField(blank=True, default='', max_length=250),
+        ),
+        migrations.AddField(
+            model_name='exchangejob',
+            name='has_changes_only',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='exchangejob',
+            name='kind',
+            field=models.CharField(blank=True, default='', max_length=15),
+        ),
+        migrations.AlterField(
+            model_name='exchange',
+            name='job_state',
+            field=models.CharField(blank=True, choices=[('', 'NONE'), ('queued', 'QUEUED'), ('running', 'RUNNING'), ('done', 'DONE'), ('failed', 'FAILED'), ('superseded', 'SUPERSEDED')], default='', max_length=15),
+        ),
+        migrations.AlterField(
+            model_name='exchangejob',
+            name='state',
+            field=models.CharField(choices=[('', 'NONE'), ('queued', 'QUEUED'), ('running', 'RUNNING'), ('done', 'DONE'), ('failed', 'FAILED'), ('superseded', 'SUPERSEDED')], default='queued', max_length=15),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:54
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cml', '0008_add_job_kind'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchange',
+            name='file_size',
+            field=models.BigIntegerField(default=0),
+        ),
+    ]
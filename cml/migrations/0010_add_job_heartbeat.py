@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 02:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cml', '0009_add_file_size'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchange',
+            name='job_heartbeat',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:29
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cml', '0010_add_job_heartbeat'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='exchange',
+            name='job_state',
+            field=models.CharField(blank=True, choices=[('', 'NONE'), ('queued', 'QUEUED'), ('running', 'RUNNING'), ('parsing', 'PARSING'), ('done', 'DONE'), ('failed', 'FAILED'), ('superseded', 'SUPERSEDED')], default='', max_length=15),
+        ),
+        migrations.AlterField(
+            model_name='exchangejob',
+            name='state',
+            field=models.CharField(choices=[('', 'NONE'), ('queued', 'QUEUED'), ('running', 'RUNNING'), ('parsing', 'PARSING'), ('done', 'DONE'), ('failed', 'FAILED'), ('superseded', 'SUPERSEDED')], default='queued', max_length=15),
+        ),
+    ]
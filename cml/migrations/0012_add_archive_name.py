@@ -0,0 +1,18 @@
+# Generated by Django 3.2.25 on 2026-10-17 03:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cml', '0011_add_job_parsing_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='exchange',
+            name='archive_name',
+            field=models.CharField(blank=True, default='', max_length=250),
+        ),
+    ]
@@ -18,6 +18,24 @@ class ExchangeState(Enum):
         return self.value
 
 
+class JobState(Enum):
+    """State of background import job of exchange"""
+    NONE    = '' # noqa
+    QUEUED  = 'queued' # noqa
+    RUNNING = 'running' # noqa
+    PARSING = 'parsing' # noqa
+    DONE    = 'done' # noqa
+    FAILED  = 'failed' # noqa
+    SUPERSEDED = 'superseded' # noqa
+
+    @classmethod
+    def choices(cls):
+        return tuple((str(st), st.name) for st in cls)
+
+    def __str__(self):
+        return self.value
+
+
 class Exchange(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL,
                              on_delete=models.SET_NULL,
@@ -30,6 +48,9 @@ class Exchange(models.Model):
 
     operation = models.CharField(max_length=30, default='', null=True)
     file_name = models.CharField(max_length=250, default='', null=True)
+    file_hash = models.CharField(max_length=64, default='', blank=True)  # SHA-256 of imported file
+    file_size = models.BigIntegerField(default=0)  # size of uploaded file, parts are appended to it
+    archive_name = models.CharField(max_length=250, default='', blank=True)  # zip archive uploaded by exchange
 
     c_up = models.IntegerField(default=0)
     c_up_xml = models.IntegerField(default=0)
@@ -44,7 +65,44 @@ class Exchange(models.Model):
 
     report = models.CharField(max_length=2048, default='')
 
+    job_state = models.CharField(max_length=15,
+                                 choices=JobState.choices(),
+                                 default=str(JobState.NONE),
+                                 blank=True)
+    progress = models.CharField(max_length=250, default='', blank=True)  # status message of running job
+    import_pos = models.IntegerField(default=0)  # position in stream of items to continue sliced import
+    job_heartbeat = models.DateTimeField(null=True, blank=True)  # updated by running job, see `CML_JOB_TIMEOUT`
+
     class Meta:
         verbose_name = 'Exchange log entry'
         verbose_name_plural = 'Exchange logs'
         ordering = ['-dt_action']
+
+
+class ExchangeJob(models.Model):
+    """Import of uploaded file queued for `cml_worker` command"""
+    exchange = models.ForeignKey(Exchange,
+                                 on_delete=models.CASCADE,
+                                 related_name='jobs')
+    state = models.CharField(max_length=15,
+                             choices=JobState.choices(),
+                             default=str(JobState.QUEUED))
+    priority = models.IntegerField(default=0)  # jobs with greater priority are taken first
+    dt_created = models.DateTimeField(auto_now_add=True)
+    dt_started = models.DateTimeField(null=True, blank=True)
+    dt_finished = models.DateTimeField(null=True, blank=True)
+
+    file_name = models.CharField(max_length=250)  # relative to `settings.CML_UPLOAD_ROOT`
+    file_hash = models.CharField(max_length=64, default='', blank=True)
+    kind = models.CharField(max_length=15, default='', blank=True)  # 'catalogue', 'offers' or ''
+    catalogue_uid = models.CharField(max_length=250, default='', blank=True)
+    has_changes_only = models.BooleanField(default=False)
+    worker = models.CharField(max_length=250, default='', blank=True)  # host and pid of worker process
+
+    class Meta:
+        verbose_name = 'Exchange job'
+        verbose_name_plural = 'Exchange jobs'
+        ordering = ['-priority', 'pk']
+        indexes = [
+            models.Index(fields=['state', '-priority', 'id']),
+        ]
@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -
+"""Parallel parsing of packet by process pool.
+
+Lists of products and offers are found in bytes of the document and split into chunks
+at boundaries of `Товар`/`Предложение` elements. Chunks are parsed by `Product.parse_xml`
+and `Offer.parse_xml` in worker processes and merged in the document order.
+The rest of the document is parsed by `items.Packet.parse()` with empty lists.
+
+Files are mapped to memory instead of reading, and workers read their chunks from the file
+by offsets, so the document is not kept in memory of the main process.
+
+Parsed products and offers don't refer to xml elements, because elements can't be passed
+between processes. Values shared by `items.ParseContext` are shared within a chunk only.
+Documents in encodings which are not ASCII-compatible are parsed serially.
+"""
+from __future__ import absolute_import
+import io
+import mmap
+import os
+import re
+import typing
+from concurrent.futures import ProcessPoolExecutor
+from lxml import etree
+from . import logger
+from .items import Packet, ParseContext, Product, Offer
+from .xml import XmlElement
+
+MIN_CHUNK_SIZE = 256 * 1024
+_CHUNKS_PER_PROCESS = 4  # more chunks than processes to balance load
+
+# (container, list, item, parse_xml)
+_LISTS = (
+    ('Каталог', 'Товары', 'Товар', Product.parse_xml),
+    ('ПакетПредложений', 'Предложения', 'Предложение', Offer.parse_xml),
+)
+
+_declaration_re = re.compile(rb'^(\xef\xbb\xbf)?<\?xml[^>]*\?>')
+_encoding_re = re.compile(rb'encoding\s*=\s*["\']([A-Za-z0-9._-]+)["\']')
+
+
+def _tag_re(name: str, encoding: str, pattern: str) -> typing.Pattern:
+    # Name is matched with any namespace prefix as group `name`
+    return re.compile(pattern.format(name=r'(?P<name>(?:[\w.-]+:)?' + re.escape(name) + ')').encode(encoding))
+
+
+def _get_encoding(data: bytes) -> str or None:
+    """Encoding of document if it's ASCII-compatible, so tags can be found in bytes"""
+    m = _declaration_re.match(data)
+    encoding = 'UTF-8'
+    if m is not None:
+        enc = _encoding_re.search(m.group(0))
+        if enc is not None:
+            encoding = enc.group(1).decode()
+    try:
+        if '<>/="'.encode(encoding) != b'<>/="':
+            return None
+        for names in _LISTS:
+            for name in names[:3]:
+                name.encode(encoding)
+    except (LookupError, UnicodeError):
+        return None
+    return encoding
+
+
+def _find_list(data: bytes, encoding: str, container: str,
+               list_name: str) -> typing.Tuple[int, int, typing.Match] or None:
+    """Find content of list of items in `container`. Returns (start, end, start tag of list)"""
+    m = _tag_re(container, encoding, r'<{name}[\s>]').search(data)
+    if m is None:
+        return None
+    container_end = _tag_re(container, encoding, r'</{name}\s*>').search(data, m.end())
+    start = _tag_re(list_name, encoding, r'<{name}(\s[^>]*)?>').search(data, m.end())
+    if container_end is None or start is None or start.end() > container_end.start():
+        return None
+    end = _tag_re(list_name, encoding, r'</{name}\s*>').search(data, start.end(), container_end.start())
+    if end is None:
+        return None
+    return start.end(), end.start(), start
+
+
+def _split(data: bytes, start: int, end: int, close_re: typing.Pattern,
+           size: int) -> typing.Iterator[typing.Tuple[int, int]]:
+    """Split data[start:end] into ranges of about `size` bytes after closing tags of items"""
+    pos = start
+    while pos < end:
+        m = close_re.search(data, min(pos + size, end), end)
+        cut = end if m is None else m.end()
+        yield pos, cut
+        pos = cut
+
+
+def _read_chunk(chunk: bytes or tuple) -> bytes:
+    """Bytes of chunk, which is given by bytes or by (path, start, end) of file"""
+    if isinstance(chunk, tuple):
+        path, start, end = chunk
+        with open(path, 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+    return chunk
+
+
+def _parse_chunk(head: bytes, chunk: bytes or tuple, tail: bytes, list_index: int) -> list:
+    """Parse items of chunk wrapped by root and list elements. Runs in worker process"""
+    _, _, item_name, parse_xml = _LISTS[list_index]
+    root = XmlElement(etree.fromstring(head + _read_chunk(chunk) + tail))
+    ns = root.ns
+    ctx = ParseContext(keep_xml_elements=False)
+    try:
+        with ctx.activate():
+            return [parse_xml(XmlElement(el, ns))
+                    for el in root.el[0]
+                    if isinstance(el.tag, str) and etree.QName(el).localname == item_name]
+    finally:
+        ctx.release()
+
+
+def _get_path(source) -> str or None:
+    """Path of regular file of `source` at its start, so the file can be mapped to memory and read by workers"""
+    if isinstance(source, (str, os.PathLike)):
+        path = os.fspath(source)
+    else:
+        path = getattr(source, 'name', None)
+        try:
+            if not isinstance(path, str) or source.tell() != 0:
+                return None
+            source.fileno()
+        except (AttributeError, OSError, io.UnsupportedOperation):
+            return None  # e.g. member of archive
+    return path if os.path.isfile(path) else None
+
+
+def parse(source, processes: int, keep_xml_elements: bool = None) -> Packet:
+    """Parse packet like `items.Packet.parse()` using `processes` worker processes"""
+    path = _get_path(source)
+    if path is None:
+        return _parse(source.read(), None, processes, keep_xml_elements)
+
+    with open(path, 'rb') as f:
+        try:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except ValueError:  # empty file can't be mapped
+            return _parse(b'', None, processes, keep_xml_elements)
+    with data:
+        return _parse(data, path, processes, keep_xml_elements)
+
+
+def _parse(data: bytes or mmap.mmap, path: str or None, processes: int, keep_xml_elements: bool) -> Packet:
+    """Parse document `data`. If `path` of the file is given, workers read chunks from it"""
+    encoding = _get_encoding(data)
+    root_tag = None
+    found = []
+    if encoding is not None:
+        root_tag = _tag_re('КоммерческаяИнформация', encoding, r'<{name}(\s[^>]*)?>').search(data)
+    if root_tag is not None:
+        for i, (container, list_name, _, _) in enumerate(_LISTS):
+            res = _find_list(data, encoding, container, list_name)
+            if res is not None:
+                found.append((i, res))
+    if not found:
+        logger.debug('Parallel parse is not applicable, packet is parsed serially')
+        return Packet.parse(path if path is not None else io.BytesIO(data), keep_xml_elements, processes=1)
+
+    declaration = _declaration_re.match(data)
+    declaration = declaration.group(0) if declaration is not None else b''
+    root_tail = b'</' + root_tag.group('name') + b'>'
+
+    # The document without products and offers
+    header = io.BytesIO()
+    pos = 0
+    for _, (start, end, _) in found:
+        header.write(data[pos:start])
+        pos = end
+    header.write(data[pos:])
+
+    with ProcessPoolExecutor(processes) as executor:
+        futures = []
+        for i, (start, end, list_tag) in found:
+            item_name = _LISTS[i][2]
+            head = declaration + root_tag.group(0) + list_tag.group(0)
+            tail = b'</' + list_tag.group('name') + b'>' + root_tail
+            size = max(MIN_CHUNK_SIZE, (end - start) // (processes * _CHUNKS_PER_PROCESS))
+            close_re = _tag_re(item_name, encoding, r'</{name}\s*>')
+            futures.append([executor.submit(_parse_chunk, head,
+                                            (path, pos, cut) if path is not None else data[pos:cut], tail, i)
+                            for pos, cut in _split(data, start, end, close_re, size)])
+
+        # Header is parsed meanwhile
+        header.seek(0)
+        pack = Packet.parse(header, keep_xml_elements, processes=1)
+        for (i, _), chunks in zip(found, futures):
+            parsed = [it for f in chunks for it in f.result()]
+            if i == 0 and pack.catalogue is not None:
+                pack.catalogue.products = parsed
+            elif i == 1 and pack.offers_pack is not None:
+                pack.offers_pack.offers = parsed
+    return pack
@@ -41,7 +41,11 @@ class UserDelegate(utils.AbstractUserDelegate):
         pass
 
     def import_catalogue(self, cat: items.Catalogue):
-        """update_or_create products from catalogue, delete all others if need"""
+        """update_or_create products from catalogue, delete all others if need.
+        Delete others only if not cat.has_changes_only: with settings.CML_SKIP_UNCHANGED_ITEMS
+        unchanged products are skipped, and the catalogue is passed with has_changes_only = True.
+        Uids of products removed since the previous full catalogue are in cat.removed_uids,
+        if settings.CML_TRACK_REMOVED_PRODUCTS is set"""
         # Update statistics:
         # self.c_del_img += 1
         # self.c_saved_img += 1
@@ -51,10 +55,28 @@ class UserDelegate(utils.AbstractUserDelegate):
         """update_or_create prices of loaded products from catalogue"""
         pass
 
+    # Uncomment these methods to receive products and offers by batches
+    # of settings.CML_IMPORT_BATCH_SIZE while the file is being parsed.
+    # They are called instead of import_catalogue and import_offers.
+    # With settings.CML_IMPORT_MODE = 'sliced' they may be called again by the next request
+    # for the rest of batches of the same catalogue or offers pack.
+    #
+    # def import_catalogue_batches(self, cat: items.Catalogue, batches):
+    #     """cat.products is empty. Use bulk_create/bulk_update for each batch of products"""
+    #     for products in batches:
+    #         pass
+    #     # cat.removed_uids is known after all batches (see settings.CML_TRACK_REMOVED_PRODUCTS)
+    #
+    # def import_offers_batches(self, off_pack: items.OffersPack, batches):
+    #     """off_pack.offers is empty. Use bulk_create/bulk_update for each batch of offers"""
+    #     for offers in batches:
+    #         pass
+
     def import_document(self, doc: items.Document):
         """Import document such an order or delivery. See doc.doc_type"""
         pass
 
     def export_orders(self) -> [items.Document]:
-        """Create documents-orders for sending back. """
+        """Create documents-orders for sending back.
+        Generator is allowed, so orders may be read from database one by one"""
         pass
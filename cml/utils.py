@@ -1,12 +1,95 @@
 # -*- coding: utf-8 -
 from __future__ import absolute_import
+import collections
 import importlib
 import inspect
+import itertools
+import threading
+import time
+import typing
 from . import logger
 from . import items, xml
 from .conf import settings
 
 
+def batched(iterable: typing.Iterable, size: int) -> typing.Iterator[list]:
+    """Split `iterable` into lists of `size` items. The last list may be shorter."""
+    batch = []
+    for it in iterable:
+        batch.append(it)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+class ItemsStream(object):
+    """Iterator over objects of `items.Packet.iterparse()` with look ahead.
+    `pos` is count of objects taken from the stream, `source` may begin at position `pos` already"""
+
+    _empty = object()
+
+    def __init__(self, source: typing.Iterable, pos=0):
+        self._it = iter(source)
+        self._next = self._empty
+        self.pos = pos
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._next is not self._empty:
+            it, self._next = self._next, self._empty
+        else:
+            it = next(self._it)
+        self.pos += 1
+        return it
+
+    def peek(self):
+        """The next object without taking it. None if stream is exhausted"""
+        if self._next is self._empty:
+            try:
+                self._next = next(self._it)
+            except StopIteration:
+                return None
+        return self._next
+
+    def take(self, cls: type) -> typing.Iterator:
+        """Iterate over the following objects while they are instances of `cls`"""
+        for it in self:
+            if not isinstance(it, cls):
+                self._next = it
+                self.pos -= 1
+                return
+            yield it
+
+    def skip(self, count: int) -> 'items.Catalogue or items.OffersPack or None':
+        """Skip `count` objects, e.g. imported by interrupted import.
+        Returns the last skipped container, which products or offers may follow"""
+        container = None
+        for it in itertools.islice(self, count):
+            if isinstance(it, (items.Catalogue, items.OffersPack)):
+                container = it
+        return container
+
+
+# Resolved delegate classes by (base class, module name)
+_child_classes: typing.Dict[tuple, type] = {}
+
+# (delegate instance, time of last use) of current exchanges by user id, the least recently used first
+_exchange_delegates: 'collections.OrderedDict[typing.Any, tuple]' = collections.OrderedDict()
+_exchange_lock = threading.Lock()
+
+
+def _end_exchange(ud: 'AbstractUserDelegate'):
+    try:
+        ud.on_exchange_end()
+    except Exception as e:
+        # Exchange is finished anyway
+        logger.error(f'User delegate on_exchange_end: {e}', exc_info=True)
+
+
 class AbstractUserDelegate(object):
     def __init__(self):
         pass
@@ -20,6 +103,15 @@ class AbstractUserDelegate(object):
                          'You can create pipeline file by command: python manage.py cmlpipelines')
             raise
 
+        # Module is imported and scanned once per process
+        key = (cls, module_name)
+        user_delegate_class = _child_classes.get(key)
+        if user_delegate_class is None:
+            user_delegate_class = _child_classes[key] = cls._find_child_class(module_name)
+        return user_delegate_class
+
+    @classmethod
+    def _find_child_class(cls, module_name: str) -> type:
         try:
             user_module = importlib.import_module(module_name)
         except ImportError as e:
@@ -48,6 +140,54 @@ class AbstractUserDelegate(object):
         user_delegate_class = cls.get_child_class()
         return user_delegate_class(*args, **kwargs)  # type: ignore
 
+    @classmethod
+    def get_exchange_instance(cls, user_id) -> 'AbstractUserDelegate':
+        """
+        Instance shared by requests and import jobs of the current exchange of user in this process.
+        `on_exchange_start()` is called for new instance.
+        Instance unused for `CML_DELEGATE_EXCHANGE_TTL` seconds is ended, and at most
+        `CML_DELEGATE_EXCHANGES` instances are kept, the least recently used one is ended.
+        """
+        now = time.monotonic()
+        ended = []
+        try:
+            with _exchange_lock:
+                ud, used = _exchange_delegates.pop(user_id, (None, now))
+                if ud is not None and now - used > settings.CML_DELEGATE_EXCHANGE_TTL:
+                    ended.append(ud)
+                    ud = None
+                if ud is not None:
+                    _exchange_delegates[user_id] = (ud, now)
+                    return ud
+
+            # Instance is started without the lock, so a slow start doesn't block requests of other users
+            started = cls.get_child_instance()
+            started.on_exchange_start()
+            with _exchange_lock:
+                ud, _ = _exchange_delegates.pop(user_id, (started, now))
+                if ud is not started:
+                    # Concurrent request of the user has started instance meanwhile
+                    ended.append(started)
+                _exchange_delegates[user_id] = (ud, now)
+                while len(_exchange_delegates) > max(settings.CML_DELEGATE_EXCHANGES, 1):
+                    ended.append(_exchange_delegates.popitem(last=False)[1][0])
+            return ud
+        finally:
+            for old in ended:
+                _end_exchange(old)
+
+    @classmethod
+    def end_exchange_instance(cls, user_id):
+        """Release instance of the finished exchange of user. `on_exchange_end()` is called"""
+        with _exchange_lock:
+            ud, _ = _exchange_delegates.pop(user_id, (None, 0))
+        if ud is not None:
+            _end_exchange(ud)
+
+    def is_implemented(self, method_name: str) -> bool:
+        """Check if optional method is overridden by user delegate"""
+        return getattr(type(self), method_name) is not getattr(AbstractUserDelegate, method_name)
+
     #
     # Section: user delegate methods
     # These methods are called
@@ -59,15 +199,42 @@ class AbstractUserDelegate(object):
         raise NotImplementedError()
 
     def import_catalogue(self, cat: items.Catalogue):
+        """
+        With `CML_SKIP_UNCHANGED_ITEMS` products unchanged since the previous import are skipped,
+        and `cat.has_changes_only` is True even for a full catalogue,
+        so the catalogue is not a complete snapshot. Removed products are in `cat.removed_uids`
+        if `CML_TRACK_REMOVED_PRODUCTS` is set.
+        """
         raise NotImplementedError()
 
     def import_offers(self, off_pack: items.OffersPack):
+        """The same as `import_catalogue()`: `off_pack.has_changes_only` is True if offers are filtered"""
+        raise NotImplementedError()
+
+    #
+    # Optional batch methods. If implemented, they are called instead of
+    # `import_catalogue` and `import_offers` respectively.
+    # `cat`/`off_pack` objects come with all fields but products/offers.
+    # Products/offers come in lists of `CML_IMPORT_BATCH_SIZE` items while xml parsing continues,
+    # so memory usage is limited by the batch size.
+    # `cat.removed_uids` is set when batches are exhausted.
+    # In sliced import mode (`CML_IMPORT_MODE = 'sliced'`) batches stop when time of request is over,
+    # and the method is called again by the next request with the same `cat`/`off_pack`
+    # and the rest of batches. Without batch methods the time is checked between containers only,
+    # so a catalogue or offers package is imported by a single request regardless of its size.
+    #
+
+    def import_catalogue_batches(self, cat: items.Catalogue, batches: typing.Iterator[typing.List[items.Product]]):
+        raise NotImplementedError()
+
+    def import_offers_batches(self, off_pack: items.OffersPack, batches: typing.Iterator[typing.List[items.Offer]]):
         raise NotImplementedError()
 
     def import_document(self, doc: items.Document):
         raise NotImplementedError()
 
-    def export_orders(self) -> [items.Document]:
+    def export_orders(self) -> typing.Iterable[items.Document]:
+        """Documents for sending back. Generator is allowed, documents are composed while sending"""
         raise NotImplementedError()
 
     def get_report(self) -> str:  # noqa
@@ -76,3 +243,21 @@ class AbstractUserDelegate(object):
         This method calls after each whole operation import/export
         """
         return 'OK'
+
+    #
+    # Optional hooks of exchange scope (`CML_DELEGATE_SCOPE = 'exchange'`).
+    # One instance serves all requests and import jobs of exchange in the process,
+    # so caches like uid->pk maps or group trees are built once per exchange.
+    # Requests of exchange may run in parallel, so the instance should be thread-safe.
+    # 1C starts session by init request for each file, so instance outlives sessions.
+    # Exchange is ended by sale success request, when instance is unused for `CML_DELEGATE_EXCHANGE_TTL`
+    # seconds, or when it's dropped by `CML_DELEGATE_EXCHANGES` limit.
+    #
+
+    def on_exchange_start(self):
+        """Called before the first use of instance by exchange"""
+        pass
+
+    def on_exchange_end(self):
+        """Called when exchange is finished. Caches of exchange should be released here"""
+        pass
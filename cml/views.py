@@ -1,18 +1,28 @@
 from __future__ import absolute_import
 import typing
+import contextlib
+import itertools
 import os
+import pathlib
 import shutil
 import datetime
-from django.core.files.uploadedfile import SimpleUploadedFile
+import hashlib
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
 from django.conf import settings
-from django.db import transaction
-from django.http import HttpRequest, HttpResponse
+from django.contrib.auth import get_user_model, login
+from django.db import connection, transaction
+from django.db.models import Case, F, Value, When
+from django.http import HttpRequest, HttpResponse, StreamingHttpResponse
 from django.utils import timezone
 from django.views.decorators.csrf import csrf_exempt
 from django.views.generic import View
 from . import logger
-from . import (auth, utils, items)
-from .models import Exchange, ExchangeState
+from . import (archive, auth, cache, jobs, utils, items)
+from .index import LocalIndex, ChangesFilter, RemovedTracker, get_thread_index
+from .models import Exchange, ExchangeState, JobState
 
 
 # Test configuration of delegate. If delegate was not configured,
@@ -22,6 +32,29 @@ RESPONSE_SUCCESS = 'success'
 RESPONSE_PROGRESS = 'progress'
 RESPONSE_ERROR = 'failure'
 
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# Fields of `Exchange` counted by `ProtocolView`
+COUNTERS = (
+    'c_up',
+    'c_up_xml',
+    'c_up_img',
+    'c_imp_classifier',
+    'c_imp_catalogue',
+    'c_imp_offers_pack',
+    'c_imp_doc',
+    'c_exp_doc',
+)
+
+_executor: ThreadPoolExecutor or None = None
+_executor_lock = threading.Lock()
+
+# Speculative parsing of uploaded files by path: (path, mtime, size) of parsed version, future and cancel event
+_prefetched: typing.Dict[str, typing.Tuple[tuple, Future, threading.Event]] = {}
+_prefetched_lock = threading.Lock()
+_prefetch_executor: ThreadPoolExecutor or None = None
+_PREFETCHED_MAX = 16
+
 
 @csrf_exempt
 @auth.has_perm_or_basicauth("cml.add_exchange")
@@ -49,6 +82,135 @@ def response_error(msg='') -> HttpResponse:
     return HttpResponse(res)
 
 
+def submit_job(fn, *args) -> Future:
+    """Run `fn` by thread pool of import jobs. Future gets result of `fn`"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=settings.CML_IMPORT_THREADS,
+                                           thread_name_prefix='cml-import')
+
+    def run():
+        try:
+            return fn(*args)
+        finally:
+            connection.close()  # each thread has own connection to database
+
+    return _executor.submit(run)
+
+
+@contextlib.contextmanager
+def job_heartbeat(exchange_id):
+    """Update heartbeat of import job of `Exchange` until exit.
+    Job without heartbeat for `settings.CML_JOB_TIMEOUT` seconds is considered dead, e.g. if process is restarted"""
+    stop = threading.Event()
+    interval = settings.CML_JOB_TIMEOUT / 5
+
+    def run():
+        try:
+            while not stop.wait(interval):
+                try:
+                    Exchange.objects.filter(pk=exchange_id).update(  # type: ignore[attr-defined]
+                        job_heartbeat=timezone.now())
+                except Exception as e:
+                    logger.warning(f'Cannot update heartbeat of import job: exchange={exchange_id} msg="{e}"')
+        finally:
+            connection.close()
+
+    thread = threading.Thread(target=run, name='cml-heartbeat', daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
+def is_job_stale(rec: Exchange) -> bool:
+    """Running import job of `rec` has no heartbeat for `settings.CML_JOB_TIMEOUT`"""
+    timeout = datetime.timedelta(seconds=settings.CML_JOB_TIMEOUT)
+    return rec.job_heartbeat is None or rec.job_heartbeat < timezone.now() - timeout
+
+
+def get_archive_name(rec: Exchange) -> str:
+    """Archive uploaded by exchange `rec` or the last one uploaded by its user.
+    Sessions are initialised by each import, so the archive is imported by the next sessions too"""
+    if rec.archive_name:
+        return rec.archive_name
+    return Exchange.objects.filter(user_id=rec.user_id).exclude(archive_name='').order_by(  # type: ignore[attr-defined]
+        '-pk').values_list('archive_name', flat=True).first() or ''
+
+
+def _file_key(path) -> tuple:
+    st = os.stat(path)
+    return str(path), st.st_mtime_ns, st.st_size
+
+
+def prefetch_parse(path):
+    """Parse uploaded file in background while the rest of files is uploaded.
+    Items are stored in parse cache, so import takes them without parsing. See `get_prefetched()`.
+    Parsing of a previous version of the file is cancelled.
+    Files are parsed by own thread pool, so they don't delay import jobs"""
+    global _prefetch_executor
+    cancelled = threading.Event()
+
+    def run() -> str or None:
+        file_hash = cache.file_hash(path)
+        for _ in cache.iterparse(path, file_hash):
+            if cancelled.is_set():
+                return None  # cache entry is not saved
+        return file_hash
+
+    key = _file_key(path)
+    with _prefetched_lock:
+        if _prefetch_executor is None:
+            _prefetch_executor = ThreadPoolExecutor(max_workers=settings.CML_SPECULATIVE_PARSE_THREADS,
+                                                    thread_name_prefix='cml-prefetch')
+        _cancel_prefetch(_prefetched.pop(key[0], None))
+        _prefetched[key[0]] = key, _prefetch_executor.submit(run), cancelled
+        while len(_prefetched) > _PREFETCHED_MAX:
+            _cancel_prefetch(_prefetched.pop(next(iter(_prefetched))))
+
+
+def _cancel_prefetch(prefetched: tuple or None):
+    if prefetched is not None:
+        _, future, cancelled = prefetched
+        cancelled.set()
+        future.cancel()
+
+
+def get_prefetched(path) -> str or None:
+    """Wait for background parsing of file started by `prefetch_parse()`.
+    Parsing which is not started in `settings.CML_SPECULATIVE_PARSE_TIMEOUT` seconds is cancelled,
+    a running one is awaited, because its result is ready sooner than of a new parsing.
+    Returns hash of file if parsed items of the same file version are in parse cache,
+    otherwise None and the file is parsed by import"""
+    try:
+        key = _file_key(path)
+    except OSError:
+        return None
+    with _prefetched_lock:
+        prefetched = _prefetched.pop(key[0], None)
+    if prefetched is None:
+        return None
+    if prefetched[0] != key:
+        _cancel_prefetch(prefetched)
+        return None
+    future = prefetched[1]
+    try:
+        try:
+            return future.result(timeout=settings.CML_SPECULATIVE_PARSE_TIMEOUT)
+        except FutureTimeoutError:
+            if future.cancel():
+                logger.info(f'Speculative parsing is not started in time: {path}')
+                return None
+            logger.info(f'Speculative parsing is running, its result is awaited: {path}')
+            return future.result()
+    except Exception as e:
+        logger.info(f'Speculative parsing failed: {path} {e}')
+        return None
+
+
 msg_err_srv = 'An internal error occurred. We already know about it. We will try to fix it soon.'
 
 
@@ -83,104 +245,202 @@ class HttpRequestAuth(HttpRequest):
 
 
 class ProtocolSession(object):
-    def __init__(self, pv: 'ProtocolView', user=None, create=True, operation='init', filename=''):
+    """
+    Exchange record of protocol request.
+
+    Changed fields and increments of counters are written by single UPDATE on exit.
+    If session is `lazy`, the record is not loaded until it's needed,
+    and existence of session is checked by the UPDATE.
+    Counters are saved as increments and state is changed only from `INIT`,
+    so requests of the session can run in parallel, e.g. uploads of images.
+    """
+    def __init__(self, pv: 'ProtocolView', user=None, create=True, operation='init', filename='', lazy=False):
         self._pv = pv
         self.user = user
         self.create = create
         self.operation = operation
         self.filename = filename
+        self.lazy = lazy and not create
+        self.report = None  # replaces report of user delegate
+        self.keep_report = False  # report of record is not changed, e.g. it's written by import job
         self._rec = None
+        self._fields = {}  # fields of `_rec` changed by session
+        self._counters = {}  # counters of `_rec` loaded by session
+        self._not_found = False  # lazy session has no record
+
+    @property
+    def record(self) -> Exchange:
+        if self._rec is None:
+            self._rec = self._get_record()
+            for name, value in self._fields.items():
+                setattr(self._rec, name, value)
+        return self._rec
+
+    @property
+    def job_state(self) -> str:
+        return self.record.job_state
+
+    def _get_record(self) -> Exchange:
+        try:
+            return Exchange.objects.get(state=ExchangeState.INIT, user=self.user)  # type: ignore[attr-defined]
+        except Exchange.DoesNotExist:  # type: ignore[attr-defined]
+            raise self._not_started()
+
+    @staticmethod
+    def _not_started() -> ClientException:
+        msg = 'Session has not been started. Try to make init request.'
+        logger.info(msg)
+        return ClientException(msg)
+
+    def _set(self, **fields):
+        if self._rec is not None:
+            for name, value in fields.items():
+                setattr(self._rec, name, value)
+        self._fields.update(fields)
+
+    def _update(self, **fields):
+        """Save fields of the record right now.
+        Only given fields are written, so changes made by import job or concurrent requests
+        meanwhile are not overwritten. State is changed only if the session is not finished yet"""
+        state = fields.get('state')
+        if self._rec is not None:
+            records = Exchange.objects.filter(pk=self._rec.pk)  # type: ignore[attr-defined]
+        else:
+            records = Exchange.objects.filter(user=self.user)  # type: ignore[attr-defined]
+        if self._rec is None or state is not None:
+            records = records.filter(state=ExchangeState.INIT)
+        if records.update(dt_action=timezone.now(), **fields):
+            return
+
+        if self._rec is None:
+            self._not_found = True
+            raise self._not_started()
+        if state is not None:
+            # Session is finished by concurrent request, the rest of fields are saved anyway
+            logger.info(f'Session {self._rec.pk} is finished already, state "{state}" is not saved')
+            fields = {name: value for name, value in fields.items() if name not in ('state', 'report')}
+            records = Exchange.objects.filter(pk=self._rec.pk)  # type: ignore[attr-defined]
+            records.update(dt_action=timezone.now(), **fields)
+
+    def flush(self):
+        """Save changed fields and counters before exit"""
+        fields = dict(self._fields)
+        fields.update(self._pv.get_counters(self._counters))
+        self._fields = {}
+        self._counters = {name: getattr(self._pv, name) for name in COUNTERS}
+        self._update(**fields)
 
     def close(self):
-        self._rec.state = ExchangeState.DONE
+        self._set(state=str(ExchangeState.DONE))
+
+    def abort(self, msg: str):
+        """Abort session after exit. E.g. if streamed response fails"""
+        self._update(
+            state=str(ExchangeState.ABORT),
+            report=msg
+        )
 
     def set_operation(self, operation, filename=None):
-        self._rec.operation = operation
-        self._rec.file_name = filename
-        self._rec.save()
+        self._set(operation=operation, file_name=filename)
+
+    def is_last_operation(self, operation, filename) -> bool:
+        rec = self.record
+        return rec.operation == operation and rec.file_name == filename
+
+    def set_file_hash(self, file_hash: str):
+        self._set(file_hash=file_hash)
+
+    def set_file_size(self, file_size: int):
+        self._set(file_size=file_size)
+
+    def set_archive(self, archive_name: str):
+        self._set(archive_name=archive_name)
+
+    def set_report(self, report: str):
+        self.report = report
+
+    def set_job_state(self, state: JobState, progress='', import_pos=0):
+        """Save state of import job. `import_pos` is position to continue sliced import"""
+        self._set(job_state=str(state), progress=progress, import_pos=import_pos)
+        self.flush()
+
+    def is_imported(self, file_hash: str) -> bool:
+        """Check if the file with the same name and content was imported successfully
+        by previous session of the operation"""
+        rec = self.record
+        prev = Exchange.objects.filter(  # type: ignore[attr-defined]
+            user=rec.user,
+            operation=rec.operation,
+            file_name=rec.file_name,
+        ).exclude(pk=rec.pk).order_by('-dt_start', '-pk').first()
+        return prev is not None and prev.state == str(ExchangeState.DONE) and prev.file_hash == file_hash
 
     def __enter__(self):
         """
         get or create `_rec`
         """
-        with transaction.atomic():
-            if self.create:
-                aa = Exchange.objects.filter(state=ExchangeState.INIT)  # type: ignore[attr-defined]
-                aa.filter(user=self.user).update(
-                    state=ExchangeState.ABORT,
-                    report='Replaced initialisation'
-                )
-                aa.exclude(user=self.user).update(
+        if self.create:
+            with transaction.atomic():
+                # Concurrent init requests of the user are serialised by lock of the user,
+                # so the user has the only initialised session
+                list(get_user_model().objects.select_for_update().filter(pk=self.user.pk).values_list('pk'))
+                Exchange.objects.filter(state=ExchangeState.INIT).update(  # type: ignore[attr-defined]
                     state=ExchangeState.ABORT,
-                    report=f'Aborted by another user: {self.user.username}'
+                    report=Case(
+                        When(user=self.user, then=Value('Replaced initialisation')),
+                        default=Value(f'Aborted by another user: {self.user.username}'),
+                    )
                 )
 
                 tz = timezone.get_current_timezone()
-                rec = Exchange.objects.create(  # type: ignore[attr-defined]
+                self._rec = Exchange.objects.create(  # type: ignore[attr-defined]
                     state=ExchangeState.INIT,
                     user=self.user,
-                    dt_start=datetime.datetime.now(tz=tz)
+                    dt_start=datetime.datetime.now(tz=tz),
+                    operation=self.operation,
+                    file_name=self.filename,
+                    report=self._pv.get_report(),
                 )
-            else:
-                try:
-                    rec = Exchange.objects.get(state=ExchangeState.INIT, user=self.user)  # type: ignore[attr-defined]
-                except Exception:
-                    msg = 'Session has not been started. Try to make init request.'
-                    logger.info(msg)
-                    raise ClientException(msg)
+        elif not self.lazy:
+            self._rec = self._get_record()
 
-        self._rec = rec
         pv = self._pv
-
-        if not self.create:
-            # Here load saved or default data into `self._rec`
-            pv.c_up = rec.c_up
-            pv.c_up_xml = rec.c_up_xml
-            pv.c_up_img = rec.c_up_img
-
-            pv.c_imp_classifier = rec.c_imp_classifier
-            pv.c_imp_catalogue = rec.c_imp_catalogue
-            pv.c_imp_offers_pack = rec.c_imp_offers_pack
-            pv.c_imp_doc = rec.c_imp_doc
-
-            pv.c_exp_doc = rec.c_exp_doc
-
+        if self._rec is not None:
+            # Here load saved or default data into `pv`
+            self._counters = {name: getattr(self._rec, name) for name in COUNTERS}
+            if not self.create:
+                for name, value in self._counters.items():
+                    setattr(pv, name, value)
+        else:
+            # Counters of lazy session are counted from zero, only increments are saved
+            self._counters = {name: getattr(pv, name) for name in COUNTERS}
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         suppress = False
-        rec = self._rec
         pv = self._pv
-        ud = pv.user_delegate
-
-        with transaction.atomic():
-            # Here save data into `rec`
-            rec.c_up = pv.c_up
-            rec.c_up_xml = pv.c_up_xml
-            rec.c_up_img = pv.c_up_img
 
-            rec.c_imp_classifier = pv.c_imp_classifier
-            rec.c_imp_catalogue = pv.c_imp_catalogue
-            rec.c_imp_offers_pack = pv.c_imp_offers_pack
-            rec.c_imp_doc = pv.c_imp_doc
+        # Counters are saved as increments, so counts of import job running meanwhile are kept
+        fields = dict(self._fields)
+        fields.update(pv.get_counters(self._counters))
 
-            rec.c_exp_doc = pv.c_exp_doc
+        if exc_type is not None:
+            fields['state'] = str(ExchangeState.ABORT)
+            fields['report'] = str(exc_val)  # register last error
+        elif self.keep_report:
+            pass
+        elif self.report is not None:
+            fields['report'] = self.report
+        else:
+            # Call user report function only if no exception
+            fields['report'] = pv.get_report()
 
-            if exc_type is not None:
-                rec.state = ExchangeState.ABORT
-                rec.report = str(exc_val)  # register last error
-            else:
-                # Call user report function only if no exception
-                try:
-                    rec.report = ud.get_report()
-                except Exception as e:
-                    msg = f'User delegate get_report: {e}'
-                    rec.report = msg
-                    logger.error(msg, exc_info=True)
-                    # result of operation will be OK.
-                    # This Exception is only server's problem that cannot abort process
+        if self.create and self._rec is not None:
+            # Fields of the record created by the session are written only if they are changed
+            fields = {name: value for name, value in fields.items() if getattr(self._rec, name) != value}
 
-            rec.save()
+        if fields and not self._not_found:
+            self._update(**fields)
 
         return suppress
 
@@ -210,7 +470,8 @@ class ProtocolView(View):
             ('sale', 'success'): self.api_success,
         }
 
-        self.user_delegate = utils.AbstractUserDelegate.get_child_instance()
+        self._user_delegate = None
+        self.user_id = None  # owner of exchange, scope of user delegate with `CML_DELEGATE_SCOPE = 'exchange'`
         self._check_cml_upload_root(items.FileRef.base_path)
         self.operation = None
 
@@ -225,6 +486,15 @@ class ProtocolView(View):
 
         self.c_exp_doc = 0
 
+        self.import_name = ''  # name of imported file, scope of fingerprints of items
+        self.job_id = None  # id of `Exchange` record, if import is run by background job
+        self.deadline = None  # `time.monotonic()` when import is interrupted to be continued by the next request
+        self.interrupted = False
+        self.parsed = None  # count of items parsed to cache, if parsing is interrupted by `deadline`
+        self._stream: utils.ItemsStream or None = None
+        self.index: LocalIndex or None = None
+        self.changes: [ChangesFilter] = []
+
     @staticmethod
     def _check_cml_upload_root(path: str):
         if not os.path.exists(path):
@@ -234,20 +504,286 @@ class ProtocolView(View):
                 logger.error(f'Cannot create upload directory: {path}')
                 raise
 
+    @property
+    def user_delegate(self) -> utils.AbstractUserDelegate:
+        if self._user_delegate is None:
+            if settings.CML_DELEGATE_SCOPE == 'exchange' and self.user_id is not None:
+                self._user_delegate = utils.AbstractUserDelegate.get_exchange_instance(self.user_id)
+            else:
+                self._user_delegate = utils.AbstractUserDelegate.get_child_instance()
+        return self._user_delegate
+
+    @user_delegate.setter
+    def user_delegate(self, value: utils.AbstractUserDelegate):
+        self._user_delegate = value
+
+    def get_counters(self, base: dict = None) -> dict:
+        """Increments of counters since `base` values as expressions for update of `Exchange`"""
+        base = base or {}
+        res = {}
+        for name in COUNTERS:
+            delta = getattr(self, name) - base.get(name, 0)
+            if delta:
+                res[name] = F(name) + delta
+        return res
+
+    def get_report(self) -> str:
+        """Report of user delegate with counts of changed items"""
+        try:
+            report = self.user_delegate.get_report()
+            changes_report = self.get_changes_report()
+            if changes_report:
+                report = f'{report}\n{changes_report}'
+            return report
+        except Exception as e:
+            msg = f'User delegate get_report: {e}'
+            logger.error(msg, exc_info=True)
+            # result of operation will be OK.
+            # This Exception is only server's problem that cannot abort process
+            return msg
+
+    def get_progress(self) -> str:
+        return (f'Imported: classifier={self.c_imp_classifier} catalogue={self.c_imp_catalogue} '
+                f'offers_pack={self.c_imp_offers_pack} doc={self.c_imp_doc}')
+
+    def _update_progress(self):
+        if self.job_id is not None:
+            Exchange.objects.filter(pk=self.job_id).update(progress=self.get_progress())  # type: ignore[attr-defined]
+
+    @classmethod
+    def run_import_job(cls, exchange_id, path, file_hash: str = None, user_id=None, delete_files=True):
+        """Import file in background. State and result of the job are saved to `Exchange` record.
+        `user_id` is owner of exchange, whose user delegate instance is used in exchange scope.
+        Uploaded files are deleted by `delete_files_after_import()` if `delete_files` is set"""
+        jobs = Exchange.objects.filter(pk=exchange_id)  # type: ignore[attr-defined]
+        jobs.update(job_state=str(JobState.RUNNING), job_heartbeat=timezone.now())
+        pv = cls()
+        pv.job_id = exchange_id
+        pv.user_id = user_id
+        try:
+            with job_heartbeat(exchange_id):
+                pv.import_file(path, file_hash)
+            if delete_files:
+                pv.delete_files_after_import(path)
+        except Exception as e:
+            logger.error(f'Import job failed: exchange={exchange_id} path={path} msg="{e}"', exc_info=True)
+            fields = dict(job_state=str(JobState.FAILED), report=f'Import failed: {e}')
+        else:
+            logger.info(f'Import job completed: exchange={exchange_id} path={path}')
+            fields = dict(job_state=str(JobState.DONE), report=pv.get_report())
+        jobs.update(progress=pv.get_progress(), **pv.get_counters(), **fields)
+
+    @staticmethod
+    def delete_files_after_import(source=None):
+        """Delete uploaded files. Archive of `source` is kept until all its xml files are imported"""
+        if settings.CML_DELETE_FILES_AFTER_IMPORT:
+            if isinstance(source, archive.ArchiveMember) and not archive.mark_imported(source):
+                logger.info(f'Files are kept for the rest of archive: {source.archive_path}')
+                return
+            try:
+                if os.path.exists(jobs.get_jobs_root()):
+                    # Files of queued import jobs are kept, see `jobs.keep_source()`
+                    for entry in os.scandir(items.FileRef.base_path):
+                        if entry.name == jobs.JOBS_DIR:
+                            continue
+                        if entry.is_dir(follow_symlinks=False):
+                            shutil.rmtree(entry.path)
+                        else:
+                            os.remove(entry.path)
+                else:
+                    shutil.rmtree(items.FileRef.base_path)
+            except OSError as e:
+                logger.warning(f'Cannot delete files after import: {e}')
+
     def import_pack(self, pack: items.Packet):
         if pack.classifier:
             self.user_delegate.import_classifier(pack.classifier)
             self.c_imp_classifier += 1
+            self._update_progress()
         if pack.catalogue:
-            self.user_delegate.import_catalogue(pack.catalogue)
-            self.c_imp_catalogue += 1
+            self._import_catalogue(pack.catalogue, iter(pack.catalogue.products))
         if pack.offers_pack:
-            self.user_delegate.import_offers(pack.offers_pack)
-            self.c_imp_offers_pack += 1
+            self._import_offers(pack.offers_pack, iter(pack.offers_pack.offers))
         for doc in pack.docs:
             self.user_delegate.import_document(doc)
             self.c_imp_doc += 1
 
+    def import_stream(self, stream: typing.Iterable, start=0) -> int or None:
+        """Import objects yielded by `items.Packet.iterparse()`.
+        If import is interrupted by `deadline`, returns position in `stream` to continue by `start`"""
+        stream = utils.ItemsStream(stream)
+        container = stream.skip(start)
+        return self._import_items(stream, container)
+
+    def _import_items(self, stream: utils.ItemsStream, container) -> int or None:
+        """Import the rest of `stream`. `container` is the last one before position of `stream`"""
+        self._stream = stream
+        # Import of container was interrupted, continue with the rest of its items
+        if isinstance(container, items.Catalogue) and isinstance(stream.peek(), items.Product):
+            self._import_catalogue(container, stream.take(items.Product), resumed=True)
+        elif isinstance(container, items.OffersPack) and isinstance(stream.peek(), items.Offer):
+            self._import_offers(container, stream.take(items.Offer))
+
+        while not self.interrupted:
+            it = next(stream, None)
+            if it is None:
+                break
+            if isinstance(it, items.Classifier):
+                self.user_delegate.import_classifier(it)
+                self.c_imp_classifier += 1
+                self._update_progress()
+            elif isinstance(it, items.Catalogue):
+                self._import_catalogue(it, stream.take(items.Product))
+            elif isinstance(it, items.OffersPack):
+                self._import_offers(it, stream.take(items.Offer))
+            elif isinstance(it, items.Document):
+                self.user_delegate.import_document(it)
+                self.c_imp_doc += 1
+            if self._is_time_over() and stream.peek() is not None:
+                self.interrupted = True
+
+        self._stream = None
+        return stream.pos if self.interrupted else None
+
+    def _is_time_over(self) -> bool:
+        return self.deadline is not None and time.monotonic() >= self.deadline
+
+    def _sliced(self, batches: typing.Iterator[list], cls: type) -> typing.Iterator[list]:
+        """Stop batches of stream items of `cls` when time is over"""
+        for batch in batches:
+            yield batch
+            if self._is_time_over() and isinstance(self._stream.peek(), cls):
+                self.interrupted = True
+                return
+
+    def import_file(self, path, file_hash: str = None, start=0) -> int or None:
+        """Parse and import file. Parsing is streamed if user delegate imports by batches
+        or import is limited by `deadline`.
+        Parsed items are cached if `settings.CML_PARSE_CACHE` is set.
+        `settings.CML_PARSE_PROCESSES` is used only if file is neither streamed nor cached.
+        `path` may be `archive.ArchiveMember`.
+        Returns position to continue by `start` if import is interrupted, see `import_stream()`"""
+        ud = self.user_delegate
+        stream_mode = ud.is_implemented('import_catalogue_batches') or ud.is_implemented('import_offers_batches') \
+            or self.deadline is not None
+        self.import_name = os.path.basename(str(path))
+        pos = None
+        try:
+            if settings.CML_PARSE_CACHE and self.deadline is not None:
+                pos = self._import_cached(path, file_hash or cache.file_hash(path), start)
+            elif settings.CML_PARSE_CACHE:
+                stream = cache.iterparse(path, file_hash)
+                if stream_mode:
+                    pos = self.import_stream(stream, start)
+                else:
+                    self.import_pack(items.Packet.from_items(stream))
+            else:
+                with archive.open_source(path) as f:
+                    if stream_mode:
+                        pos = self.import_stream(items.Packet.iterparse(f), start)
+                    else:
+                        self.import_pack(items.Packet.parse(f))
+            if pos is None and settings.CML_TRACK_UNCHANGED_FILES:
+                # Images uploaded so far are imported, the next uploads are compared with them
+                index = self._get_index()
+                index.save_uploaded_files()
+                index.commit()
+        finally:
+            if self.index is not None:
+                self.index.close()
+                self.index = None
+        return pos
+
+    def _import_cached(self, path, file_hash: str, start: int) -> int or None:
+        """Sliced import of items from parse cache. The file is parsed to cache by the first requests,
+        the next ones read items from position `start` without parsing and skipping the imported ones.
+        If parsing is interrupted by `deadline`, `parsed` is set and `start` is returned"""
+        index = cache.parse_to_cache(path, file_hash, self.deadline)
+        if index is not None and not index.complete:
+            self.parsed = index.count
+            return start
+        resumed = cache.PacketCache().seek(file_hash, start) if index is not None else None
+        if resumed is None:
+            logger.warning(f'Parsed packet is not cached, imported items are skipped. filename: {self.import_name}')
+            return self.import_stream(cache.iterparse(path, file_hash), start)
+        container, stream = resumed
+        return self._import_items(utils.ItemsStream(stream, start), container)
+
+    def _get_index(self) -> LocalIndex:
+        if self.index is None:
+            self.index = LocalIndex()
+        return self.index
+
+    @contextlib.contextmanager
+    def _changes_filter(self, kind: str, uid_attr='uid') -> typing.Iterator[ChangesFilter]:
+        """Filter of items which were not changed since the last import of the file.
+        Changes of local index are saved only if the import succeeds."""
+        changes = ChangesFilter(self._get_index() if settings.CML_SKIP_UNCHANGED_ITEMS else None,
+                                kind, self.import_name, uid_attr)
+        try:
+            yield changes
+            changes.flush()
+        except BaseException:
+            if self.index is not None:
+                self.index.rollback()
+            raise
+        if self.index is not None:
+            self.index.commit()
+        self.changes.append(changes)
+
+    def get_changes_report(self) -> str:
+        """Counts of changed and skipped items"""
+        return '\n'.join(f'{ch.kind}: changed={ch.changed} skipped={ch.skipped}'
+                         for ch in self.changes if ch.index is not None)
+
+    def _import_catalogue(self, cat: items.Catalogue, products: typing.Iterator[items.Product], resumed=False):
+        ud = self.user_delegate
+        tracker = None
+        with self._changes_filter('product') as changes:
+            if settings.CML_TRACK_REMOVED_PRODUCTS and not cat.has_changes_only:
+                # In batches mode `cat.removed_uids` is set when batches are exhausted
+                tracker = RemovedTracker(self._get_index(), cat.uid)
+                products = tracker.track(cat, products, resumed)
+            if changes.index is not None:
+                # Unchanged products are skipped, so the catalogue is not a complete snapshot
+                cat.has_changes_only = True
+
+            if ud.is_implemented('import_catalogue_batches'):
+                ud.import_catalogue_batches(cat, self._sliced(utils.batched(changes.filter(products),
+                                                                            settings.CML_IMPORT_BATCH_SIZE),
+                                                              items.Product))
+                if self.interrupted:
+                    if tracker is not None:
+                        tracker.flush()
+                    return
+                for _ in products:  # skip products not requested by user delegate
+                    pass
+            else:
+                cat.products = list(changes.filter(products))
+                ud.import_catalogue(cat)
+        self.c_imp_catalogue += 1
+        self._update_progress()
+
+    def _import_offers(self, off_pack: items.OffersPack, offers: typing.Iterator[items.Offer]):
+        ud = self.user_delegate
+        with self._changes_filter('offer', 'product_uid') as changes:
+            if changes.index is not None:
+                # Unchanged offers are skipped, so the offers pack is not complete
+                off_pack.has_changes_only = True
+            if ud.is_implemented('import_offers_batches'):
+                ud.import_offers_batches(off_pack, self._sliced(utils.batched(changes.filter(offers),
+                                                                              settings.CML_IMPORT_BATCH_SIZE),
+                                                                items.Offer))
+                if self.interrupted:
+                    return
+                for _ in offers:  # skip offers not requested by user delegate
+                    pass
+            else:
+                off_pack.offers = list(changes.filter(offers))
+                ud.import_offers(off_pack)
+        self.c_imp_offers_pack += 1
+        self._update_progress()
+
     # Check GET parameter filename and fix it, return (response, filename)
     @staticmethod
     def _get_param_filename(request: HttpRequestAuth) -> str:
@@ -258,8 +794,9 @@ class ProtocolView(View):
             raise ClientException(msg)
         return filename
 
-    def session(self, request: HttpRequestAuth, is_init=False):
-        return ProtocolSession(self, request.user, is_init)
+    def session(self, request: HttpRequestAuth, is_init=False, lazy=False, filename=None):
+        """Session of exchange. Record of new session (`is_init`) is created with `filename`"""
+        return ProtocolSession(self, request.user, is_init, operation=self.operation, filename=filename, lazy=lazy)
 
     # @csrf_exempt
     # @auth.has_perm_or_basicauth('cml.add_exchange')
@@ -271,6 +808,7 @@ class ProtocolView(View):
         p_type = request.GET.get('type')
         p_mode = request.GET.get('mode')
         self.operation = f'{p_type}_{p_mode}'
+        self.user_id = request.user.pk
 
         api_method = self.routes_map.get((p_type, p_mode))
         if not api_method:
@@ -295,12 +833,14 @@ class ProtocolView(View):
         logger.info(f'catalog_check_auth(user={request.user}): OK')
 
         session = request.session
+        if session.session_key is None:
+            # User is authenticated by cached basic auth credentials, see `auth.CredentialsCache`
+            login(request, request.user)
         res = '{}\n{}'.format(settings.SESSION_COOKIE_NAME, session.session_key)
         return response_success(res)
 
     def api_init(self, request: HttpRequestAuth):
-        with self.session(request, is_init=True) as cur:
-            cur.set_operation(self.operation)
+        with self.session(request, is_init=True):
             logger.info(f'OK: user={request.user}')
 
             result = 'zip={}\nfile_limit={}'.format(
@@ -316,32 +856,89 @@ class ProtocolView(View):
             logger.info(msg)
             return response_error(msg)
 
-        with self.session(request) as cur:
+        # Record is loaded only to check the last operation,
+        # otherwise the request costs the single UPDATE which also checks the session
+        with self.session(request, lazy=True) as cur:
             filename = self._get_param_filename(request)
+            # If file is bigger than CML_FILE_LIMIT, it's sent by consecutive requests with the same filename.
+            # All parts but the last one are full, so a file of not multiple size is complete
+            # and the request sends it again, e.g. after timeout of client
+            limited = settings.CML_FILE_LIMIT > 0
+            append = limited and cur.is_last_operation(self.operation, filename) \
+                and cur.record.file_size % settings.CML_FILE_LIMIT == 0
+            size = offset = cur.record.file_size if append else 0
             cur.set_operation(self.operation, filename)
 
             fref = items.FileRef(filename)
             folder_path = fref.full_path.parent
+            counters = {name: getattr(self, name) for name in COUNTERS}
 
-            temp_file = SimpleUploadedFile(filename, request.read())
+            self.c_up += 1
+            if fref.path.suffix == '.xml':
+                self.c_up_xml += 1
+            if fref.is_image_type():
+                self.c_up_img += 1
+
+            if limited:
+                # Size of received parts is saved after writing, so a part retried by 1C is not appended twice
+                cur.set_file_size(size)
+            else:
+                # Session is saved before writing, so the file is not written without a session
+                cur.flush()
+                cur.keep_report = True
+
+            # Hash of image is computed while streaming, so unchanged images can be reported by `FileRef.get_state()`
+            h = hashlib.sha256() if settings.CML_TRACK_UNCHANGED_FILES and fref.is_image_type() else None
             try:
                 if not os.path.exists(folder_path):
                     os.makedirs(folder_path)
 
-                f = open(fref.full_path, 'wb')
-                for chunk in temp_file.chunks():
-                    f.write(chunk)
+                if not append and os.path.exists(fref.full_path):
+                    # File is replaced, not overwritten, because archive may be linked by queued import job
+                    os.remove(fref.full_path)
+                with open(fref.full_path, 'ab' if append else 'wb') as f:
+                    if f.tell() > size:
+                        # Rest of part of failed request
+                        f.truncate(size)
+                        f.seek(size)
+                    for chunk in iter(lambda: request.read(UPLOAD_CHUNK_SIZE), b''):
+                        f.write(chunk)
+                        if h is not None:
+                            h.update(chunk)
+                    size = f.tell()
             except Exception as e:
                 logger.error(f'Cannot write to file. msg: {e}')
+                # Counted upload is reverted on exit
+                for name, value in counters.items():
+                    setattr(self, name, value)
+                cur.keep_report = False
                 return response_error('Cannot write to buffer file')
 
-            logger.info(f'File loaded: {fref.path}')
-
-            self.c_up += 1
-            if fref.path.suffix == '.xml':
-                self.c_up_xml += 1
-            if fref.is_image_type():
-                self.c_up_img += 1
+            logger.info(f'File {"part " if append else ""}loaded: {fref.path}')
+            if limited:
+                cur.set_file_size(size)
+                cur.flush()
+                cur.keep_report = True
+
+            if h is not None:
+                index = get_thread_index()
+                # Parts of file are hashed as a whole
+                file_hash = cache.file_hash(fref.full_path) if append else h.hexdigest()
+                index.set_uploaded_file(str(fref.path), file_hash, fref.get_stamp())
+                index.commit()
+
+            # A full part may be followed by the next one, so parsing is started by the last part
+            complete = not limited or size - offset < settings.CML_FILE_LIMIT
+            if fref.path.suffix == '.xml' and complete and settings.CML_SPECULATIVE_PARSE and settings.CML_PARSE_CACHE:
+                prefetch_parse(fref.full_path)
+            if fref.path.suffix == '.zip' and complete and settings.CML_USE_ZIP:
+                # Files are extracted at once, xml files are imported from the archive of the exchange
+                try:
+                    archive.get_index(str(fref.full_path))
+                except (OSError, zipfile.BadZipFile) as e:
+                    logger.error(f'Cannot extract archive. msg: {e}')
+                    return response_error('Cannot extract archive')
+                cur.set_archive(str(fref.path))
 
             if request.GET['type'] == 'sale':
                 # Here is a code for import orders statuses
@@ -353,42 +950,144 @@ class ProtocolView(View):
     def api_import(self, request: HttpRequestAuth):
         with self.session(request) as cur:
             filename = self._get_param_filename(request)
-            cur.set_operation(self.operation, filename)
+            rec = cur.record
+            start = 0
+            if rec.job_state and cur.is_last_operation(self.operation, filename):
+                if not rec.import_pos and rec.job_state != str(JobState.PARSING):
+                    # Import job of the file was started by previous request
+                    return self._poll_import_job(cur, filename)
+                # Sliced import is continued from position saved by previous request
+                start = rec.import_pos
+            else:
+                cur.set_operation(self.operation, filename)
 
-            fref = items.FileRef(filename)
-            if not fref.full_path.exists():
-                msg = f'File not found: {fref.path}'
+            source = self.find_source(filename, get_archive_name(rec) if settings.CML_USE_ZIP else '')
+            if source is None:
+                msg = f'File not found: {items.FileRef(filename).path}'
                 logger.info(msg)
                 return response_error(msg)
 
-            pack = items.Packet.parse(fref.full_path)
-            self.import_pack(pack)
+            if start:
+                file_hash = rec.file_hash
+            else:
+                # Parsing started after upload of the file is awaited
+                file_hash = (settings.CML_SPECULATIVE_PARSE and isinstance(source, pathlib.Path)
+                             and get_prefetched(source)) or cache.file_hash(source)
+                cur.set_file_hash(file_hash)
 
-            if settings.CML_DELETE_FILES_AFTER_IMPORT:
-                try:
-                    shutil.rmtree(items.FileRef.base_path)
-                except OSError as e:
-                    logger.warning(f'Cannot delete files after import: {e}')
+            if not start and settings.CML_SKIP_IDENTICAL_IMPORTS and cur.is_imported(file_hash):
+                msg = f'Import skipped: the same content was imported already. filename: {filename}'
+                logger.info(msg)
+                cur.set_report(msg)
+            elif settings.CML_IMPORT_MODE == 'thread':
+                # 1C repeats the request while response is `progress`
+                cur.set_job_state(JobState.QUEUED)
+                cur.keep_report = True
+                exchange_id, user_id = rec.pk, rec.user_id
+                transaction.on_commit(lambda: submit_job(self.run_import_job, exchange_id, source, file_hash, user_id))
+                logger.info(f'Import job started. filename: {filename}')
+                return response_progress(f'Import started: {filename}')
+            elif settings.CML_IMPORT_MODE == 'queue':
+                # Import is run by `cml_worker` command
+                cur.set_job_state(JobState.QUEUED)
+                cur.keep_report = True
+                jobs.enqueue(rec, filename, source, file_hash)
+                logger.info(f'Import job queued. filename: {filename}')
+                return response_progress(f'Import queued: {filename}')
+            elif settings.CML_IMPORT_MODE == 'sliced' or start:
+                # Import is limited by execution time of request and continued by the next one
+                self.deadline = time.monotonic() + settings.CML_MAX_EXEC_TIME
+                pos = self.import_file(source, file_hash, start)
+                if pos is not None and self.parsed is not None:
+                    progress = f'Parsed: items={self.parsed}'
+                    cur.set_job_state(JobState.PARSING, progress, pos)
+                    logger.info(f'Parsing interrupted by time limit. filename: {filename} items: {self.parsed}')
+                    return response_progress(f'Import parsing: {filename}\n{progress}')
+                if pos is not None:
+                    progress = self.get_progress()
+                    cur.set_job_state(JobState.RUNNING, progress, pos)
+                    logger.info(f'Import interrupted by time limit. filename: {filename} position: {pos}')
+                    return response_progress(f'Import running: {filename}\n{progress}')
+                cur.set_job_state(JobState.DONE, self.get_progress())
+            else:
+                self.import_file(source, file_hash)
+
+            self.delete_files_after_import(source)
 
             logger.info(f'Import completed. filename: {filename}')
             cur.close()
             return response_success()
 
+    @staticmethod
+    def find_source(filename: str, archive_name='') -> 'pathlib.Path or archive.ArchiveMember or None':
+        """Uploaded file to import. File of `archive_name` takes precedence over a file left by previous exchanges"""
+        fref = items.FileRef(filename)
+        if archive_name:
+            # Xml file is parsed straight from uploaded archive
+            member = archive.find_member(fref.path, items.FileRef(archive_name).full_path)
+            if member is not None:
+                return member
+        if fref.full_path.exists():
+            return fref.full_path
+        return None
+
+    @staticmethod
+    def _poll_import_job(cur: ProtocolSession, filename: str) -> HttpResponse:
+        # Report of the record is written by import job
+        cur.keep_report = True
+        rec = cur.record
+        if rec.job_state == str(JobState.DONE):
+            logger.info(f'Import completed. filename: {filename}')
+            cur.close()
+            return response_success()
+        if rec.job_state == str(JobState.FAILED):
+            cur.abort(rec.report)
+            return response_error(rec.report)
+        if rec.job_state == str(JobState.RUNNING) and is_job_stale(rec):
+            # Process of the job is restarted or killed, so it will never finish
+            msg = f'Import failed: job is not responding. filename: {filename}'
+            logger.error(msg)
+            cur.set_job_state(JobState.FAILED)
+            rec.jobs.filter(state=str(JobState.RUNNING)).update(  # type: ignore[attr-defined]
+                state=str(JobState.FAILED),
+                dt_finished=timezone.now()
+            )
+            cur.abort(msg)
+            return response_error(msg)
+        return response_progress(f'Import {rec.job_state}: {filename}\n{rec.progress}'.rstrip())
+
     def api_query(self, request: HttpRequestAuth):
-        with self.session(request, is_init=True) as cur:
-            cur.set_operation(self.operation, 'query')
+        with self.session(request, is_init=True, filename='query') as cur:
 
-            pack = items.Packet()
-            pack.docs = self.user_delegate.export_orders()
+            # `export_orders()` may return generator. Documents are composed one by one while sending.
+            # Take the first document here, so error of starting export is reported by response
+            docs = iter(self.user_delegate.export_orders())
+            first = next(docs, None)
+            if first is not None:
+                docs = itertools.chain((first, ), docs)
 
-            data = pack.compose()
+            pack = items.Packet()
             self.c_exp_doc += 1
 
-            logger.info(f'sale_success(user={request.user}): OK')
-            return HttpResponse(data, content_type='text/xml')
+            logger.info(f'sale_query(user={request.user}): OK')
+            return StreamingHttpResponse(self._stream_export(cur, pack.compose_stream(docs)),
+                                         content_type='text/xml')
+
+    @staticmethod
+    def _stream_export(cur: ProtocolSession, chunks: typing.Iterator[bytes]) -> typing.Iterator[bytes]:
+        try:
+            yield from chunks
+        except Exception as e:
+            # Response is already started, so just break it and register the error
+            msg = f'Export interrupted: {e}'
+            logger.error(msg, exc_info=True)
+            cur.abort(msg)
+            raise
 
     def api_success(self, request: HttpRequestAuth):
-        with self.session(request) as cur:
+        with self.session(request, lazy=True) as cur:
             cur.close()
             logger.info(f'sale_success(user={request.user}): OK')
-            return response_success()
+            res = response_success()
+        utils.AbstractUserDelegate.end_exchange_instance(request.user.pk)
+        return res
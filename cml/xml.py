@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -
+import re
 import typing
+import functools
 from io import BytesIO
 from lxml import etree
 
@@ -8,17 +10,59 @@ class XmlImportException(Exception):
     pass
 
 
+_simple_path_re = re.compile(r'^\w+(/(\w+|\*))*$')
+
+
+@functools.lru_cache(maxsize=1024)
+def _compile_path(path: str, ns: str or None) -> typing.Tuple[typing.Callable, typing.Callable] or None:
+    """Compile `path` for elements with default namespace `ns`.
+
+    Returns pair of functions (find, findall) taking lxml element
+    or None if `path` syntax is not supported here.
+    """
+    if not _simple_path_re.match(path):
+        return None
+
+    prefix = '' if ns is None else '{%s}' % ns
+    if '/' not in path:
+        tag = prefix + path
+
+        def find_one(el):
+            return next(el.iterchildren(tag), None)
+
+        def find_all(el):
+            return list(el.iterchildren(tag))
+    else:
+        steps = [step if step == '*' else prefix + step for step in path.split('/')]
+        find_all = etree.ETXPath('/'.join(steps))
+
+        def find_one(el):
+            res = find_all(el)
+            return res[0] if res else None
+
+    return find_one, find_all
+
+
 class XmlElement(object):
     """
     It's analogue of etree.Element().__class__.
     This class was created for fixing poor behavior of etree.Element() objects.
     """
 
-    def __init__(self, el):
+    _ns_unknown = object()
+
+    def __init__(self, el, ns=_ns_unknown):
         if isinstance(el, str):
             self.el = etree.Element(el)  # el is str = tag name
         else:
             self.el = el
+        self._ns = ns  # default namespace of document, shared with found elements
+
+    @property
+    def ns(self) -> str or None:
+        if self._ns is self._ns_unknown:
+            self._ns = self.el.nsmap.get(None)
+        return self._ns
 
     #
     # Section: Emulating
@@ -29,6 +73,23 @@ class XmlElement(object):
         et = etree.parse(source, parser=parser, base_url=base_url)
         return cls(et.getroot())
 
+    @classmethod
+    def iterparse(cls, source, tags: typing.Iterable[str],
+                  events=('start', 'end')) -> typing.Iterator[typing.Tuple[str, 'XmlElement']]:
+        """Parse `source` incrementally. Yields pairs (event, XmlElement).
+
+        Only elements with local names from `tags` are reported (in any namespace).
+        The tree is still being built while iterating: on "start" event only attributes
+        and preceding siblings of the element are guaranteed to be complete.
+        Call `release()` for processed elements to keep memory usage flat.
+        """
+        tags = ['{*}' + tag for tag in tags]
+        ns = cls._ns_unknown
+        for event, el in etree.iterparse(source, events=events, tag=tags):
+            it = cls(el, ns)
+            ns = it.ns
+            yield event, it
+
     def compose(self, encoding='UTF-8', xml_declaration=True) -> bytes:
         # return etree.tostring(self.el, encoding=encoding, xml_declaration=xml_declaration)
         f = BytesIO()
@@ -36,6 +97,35 @@ class XmlElement(object):
         et.write(f, encoding=encoding, xml_declaration=xml_declaration)
         return f.getvalue()
 
+    def compose_stream(self, children: typing.Iterable['XmlElement'], encoding='UTF-8', xml_declaration=True,
+                       chunk_size=64 * 1024) -> typing.Iterator[bytes]:
+        """Serialize incrementally this element with `children` appended after its own content.
+
+        Children are taken from the iterable one by one, so they are not kept in memory.
+        Yields chunks of about `chunk_size` bytes.
+        Result is equivalent to `compose()` of element with all children appended.
+        """
+        el = self.el
+        f = BytesIO()
+        with etree.xmlfile(f, encoding=encoding) as xf:
+            if xml_declaration:
+                xf.write_declaration()
+            with xf.element(el.tag, attrib=el.attrib, nsmap=el.nsmap):
+                if el.text:
+                    xf.write(el.text)
+                for child in el:
+                    xf.write(child)
+                for child in children:
+                    xf.write(child.el)
+                    xf.flush()
+                    if f.tell() >= chunk_size:
+                        yield f.getvalue()
+                        f.seek(0)
+                        f.truncate()
+        data = f.getvalue()
+        if data:
+            yield data
+
     @property
     def text(self):
         return self.el.text
@@ -56,10 +146,29 @@ class XmlElement(object):
             raise TypeError(f'tag must be a string')
         self.el.tag = value
 
+    @property
+    def name(self) -> str:
+        """Tag name without namespace"""
+        return etree.QName(self.el).localname
+
     def append(self, child: 'XmlElement') -> 'XmlElement':
         self.el.append(child.el)
         return child
 
+    def getparent(self) -> 'XmlElement' or None:
+        parent = self.el.getparent()
+        return None if parent is None else XmlElement(parent, self._ns)
+
+    def release(self):
+        """Free memory of processed element while iterative parsing.
+        Clears content of the element and removes its preceding siblings from the tree."""
+        el = self.el
+        el.clear(keep_tail=True)
+        parent = el.getparent()
+        if parent is not None:
+            while el.getprevious() is not None:
+                del parent[0]
+
     #
     # Section: Data extracting
     #
@@ -130,7 +239,17 @@ class XmlElement(object):
             default: (any) default value for return
         """
 
-        _el_res = self.el.find(path, namespaces=self.el.nsmap)
+        compiled = _compile_path(path, self.ns)
+        if compiled is None:
+            _el_res = self.el.find(path, namespaces=self.el.nsmap)
+        else:
+            _el_res = compiled[0](self.el)
+
+        return self._convert_found(path, _el_res, converter=converter, converter_xml=converter_xml,
+                                   required=required, default=default)
+
+    def _convert_found(self, path: str, _el_res, *, converter, converter_xml, required, default) -> any:
+        """Make result of `find()` by lxml element `_el_res` found by `path`"""
         if _el_res is None:
             if not required or default is not None:
                 return default
@@ -139,7 +258,7 @@ class XmlElement(object):
             raise XmlImportException(f'ElementNotFound: xpath="{xpath}/{path}"')
 
         if converter_xml is not None:
-            return converter_xml(XmlElement(_el_res))
+            return converter_xml(XmlElement(_el_res, self._ns))
 
         if converter is not None:
             raw = _el_res.text
@@ -156,7 +275,7 @@ class XmlElement(object):
                                          f'raw_value="{raw}" msg: {str(e)}')
             return res
 
-        return XmlElement(_el_res)
+        return XmlElement(_el_res, self._ns)
 
     def findall(self, path: str, *,
                 converter: typing.Callable[[str], any] = None,
@@ -176,8 +295,17 @@ class XmlElement(object):
                       or return empty collection.
         """
 
-        _els = self.el.findall(path, namespaces=self.el.nsmap)
+        compiled = _compile_path(path, self.ns)
+        if compiled is None:
+            _els = self.el.findall(path, namespaces=self.el.nsmap)
+        else:
+            _els = compiled[1](self.el)
+
+        return self._convert_found_all(path, _els, converter=converter, converter_xml=converter_xml,
+                                       required=required)
 
+    def _convert_found_all(self, path: str, _els: list, *, converter, converter_xml, required) -> [any]:
+        """Make result of `findall()` by list of lxml elements `_els` found by `path`"""
         _els_count = len(_els)
         if _els_count == 0:
             if not required:
@@ -188,7 +316,7 @@ class XmlElement(object):
         if converter_xml is not None:
             arr_res = []
             for el in _els:
-                arr_res.append(converter_xml(XmlElement(el)))
+                arr_res.append(converter_xml(XmlElement(el, self._ns)))
             return arr_res
 
         if converter is not None:
@@ -212,4 +340,113 @@ class XmlElement(object):
 
             return arr_res
 
-        return [XmlElement(_el) for _el in _els]
+        return [XmlElement(_el, self._ns) for _el in _els]
+
+
+class XmlField(object):
+    """Declaration of object attribute `attr` parsed from child elements found by `path`.
+    Arguments have the same meaning as in `XmlElement.find()`
+    or `XmlElement.findall()` if `many` is True."""
+
+    def __init__(self, path: str, attr: str, *,
+                 converter: typing.Callable[[str], any] = None,
+                 converter_xml: typing.Callable[['XmlElement'], any] = None,
+                 many=False,
+                 required: bool = None,
+                 default: any = None):
+        if not _simple_path_re.match(path):
+            raise ValueError(f'Unsupported path: "{path}"')
+
+        self.path = path
+        self.attr = attr
+        self.converter = converter
+        self.converter_xml = converter_xml
+        self.many = many
+        self.required = not many if required is None else required
+        self.default = default
+
+
+class XmlFields(object):
+    """Table of `XmlField` parsed by single pass over children of element.
+
+    Each child is dispatched by tag to the fields which paths start with it,
+    so the cost doesn't depend on the number of fields.
+    Fields are converted in the declaration order after the pass.
+
+    `fields` may be a function returning fields.
+    It is called on first parsing, so converters may refer to classes declared later.
+    """
+
+    def __init__(self, fields: typing.Iterable[XmlField] or typing.Callable[[], typing.Iterable[XmlField]]):
+        self._fields = fields
+        self._dispatch = {}  # {ns: dispatch tree}
+
+    @property
+    def fields(self) -> typing.Tuple[XmlField, ...]:
+        if callable(self._fields):
+            self._fields = tuple(self._fields())
+        return self._fields
+
+    def _get_dispatch(self, ns: str or None) -> dict:
+        """Get tree {tag: ([field indexes], {tag: ...})} of fields paths for namespace `ns`"""
+        tree = self._dispatch.get(ns)
+        if tree is None:
+            prefix = '' if ns is None else '{%s}' % ns
+            tree = {}
+            for i, field in enumerate(self.fields):
+                node = tree
+                steps = field.path.split('/')
+                for step in steps[:-1]:
+                    node = node.setdefault(step if step == '*' else prefix + step, ([], {}))[1]
+                step = steps[-1]
+                node.setdefault(step if step == '*' else prefix + step, ([], {}))[0].append(i)
+            self._dispatch[ns] = tree
+        return tree
+
+    @classmethod
+    def _walk(cls, el, tree: dict, found: [list]):
+        get_entry = tree.get
+        wildcard = get_entry('*')
+        for child in el:
+            entry = get_entry(child.tag)
+            if entry is not None:
+                indexes, subtree = entry
+                for i in indexes:
+                    found[i].append(child)
+                if subtree:
+                    cls._walk(child, subtree, found)
+
+            # Wildcard doesn't match comments and processing instructions
+            if wildcard is not None and isinstance(child.tag, str):
+                indexes, subtree = wildcard
+                for i in indexes:
+                    found[i].append(child)
+                if subtree:
+                    cls._walk(child, subtree, found)
+
+    def parse(self, el: XmlElement, obj: any) -> any:
+        """Set attributes of `obj` parsed from `el`. Returns `obj`"""
+        fields = self.fields
+        found = [[] for _ in fields]
+        self._walk(el.el, self._get_dispatch(el.ns), found)
+
+        for field, els in zip(fields, found):
+            if field.converter is str and not field.many and els and field.converter_xml is None:
+                # Fast path for the most common case
+                raw = els[0].text
+                setattr(obj, field.attr, field.default if raw is None else raw)
+                continue
+
+            if field.many:
+                value = el._convert_found_all(field.path, els,
+                                              converter=field.converter,
+                                              converter_xml=field.converter_xml,
+                                              required=field.required)
+            else:
+                value = el._convert_found(field.path, els[0] if els else None,
+                                          converter=field.converter,
+                                          converter_xml=field.converter_xml,
+                                          required=field.required,
+                                          default=field.default)
+            setattr(obj, field.attr, value)
+        return obj
@@ -1,14 +1,18 @@
 import os
+import re
 from setuptools import setup
 
 with open(os.path.join(os.path.dirname(__file__), 'README.rst')) as readme:
     README = readme.read()
 
+with open(os.path.join(os.path.dirname(__file__), 'cml', '__init__.py')) as init:
+    VERSION = re.search(r"^__version__ = '(.+)'$", init.read(), re.M).group(1)
+
 os.chdir(os.path.normpath(os.path.join(os.path.abspath(__file__), os.pardir)))
 
 setup(
     name='django-cml2',
-    version='1.0.0.4',
+    version=VERSION,
     description='Application for data exchange in CommerceML 2 standard. This is a new version with new architecture',
     long_description=README,
     author='Sergey Grunenko',
@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -
+from cml import items, utils
+
+
+class TestDelegate(utils.AbstractUserDelegate):
+    """Collects all imported objects"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)  # type: ignore
+        self.imported = []
+
+    def import_classifier(self, cl: items.Classifier):
+        self.imported.append(cl)
+
+    def import_catalogue(self, cat: items.Catalogue):
+        self.imported.append(cat)
+
+    def import_offers(self, off_pack: items.OffersPack):
+        self.imported.append(off_pack)
+
+    def import_document(self, doc: items.Document):
+        self.imported.append(doc)
+
+    def export_orders(self) -> [items.Document]:
+        return []
+
+
+class BatchTestDelegate(TestDelegate):
+    """Collects products and offers by batches"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)  # type: ignore
+        self.batches = []
+
+    def import_catalogue_batches(self, cat, batches):
+        self.imported.append(cat)
+        for batch in batches:
+            self.batches.append(batch)
+
+    def import_offers_batches(self, off_pack, batches):
+        self.imported.append(off_pack)
+        for batch in batches:
+            self.batches.append(batch)
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -
+from urllib.parse import urlencode
+from django.test import RequestFactory
+from cml.views import ProtocolView
+
+
+class ProtocolRequestsMixin(object):
+    """Requests of exchange protocol by `self.user`.
+    User delegate is `delegate` argument or `self.delegate`, otherwise it's created by settings"""
+
+    delegate = None
+
+    def _request(self, mode, data=b'', p_type='catalog', user=None, delegate=None, **params):
+        params = dict(type=p_type, mode=mode, **params)
+        if mode == 'file':
+            request = RequestFactory().post('/cml?' + urlencode(params), data=data,
+                                            content_type='application/octet-stream')
+        else:
+            request = RequestFactory().get('/cml', params)
+        request.user = user or self.user
+        pv = ProtocolView()
+        delegate = delegate or self.delegate
+        if delegate is not None:
+            pv.user_delegate = delegate
+        return pv.dispatch(request)
@@ -1,4 +1,5 @@
 import os
+import tempfile
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
@@ -61,4 +62,9 @@ USE_L10N = True
 
 USE_TZ = True
 
+MEDIA_ROOT = os.path.join(tempfile.gettempdir(), 'django-cml-tests')
+
 CML_PROJECT_PIPELINES = 'tests.test_utils'
+CML_USER_DELEGATE = 'tests.delegate'
+CML_PARSE_CACHE_ROOT = os.path.join(tempfile.gettempdir(), 'django-cml-tests-private', 'cache')
+CML_INDEX_PATH = os.path.join(tempfile.gettempdir(), 'django-cml-tests-private', 'index.sqlite3')
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -
+"""Generators of synthetic CML packets for tests and benchmarks"""
+from enum import Enum
+from io import BytesIO
+
+NAMESPACE = 'urn:1C.ru:commerceml_2'
+
+_HEADER = '<?xml version="1.0" encoding="UTF-8"?>\n' \
+          '<КоммерческаяИнформация{ns} ВерсияСхемы="2.08" ДатаФормирования="2023-05-04T12:00:00">\n'
+
+_CLASSIFIER = '''<Классификатор>
+<Ид>cl-1</Ид>
+<Наименование>Классификатор</Наименование>
+<Владелец><Ид>owner-1</Ид><Наименование>Owner</Наименование></Владелец>
+<Группы>
+<Группа><Ид>gr-1</Ид><Наименование>Group 1</Наименование>
+<Группы><Группа><Ид>gr-2</Ид><Наименование>Group 2</Наименование></Группа></Группы>
+</Группа>
+</Группы>
+<Свойства>
+<Свойство><Ид>prop-1</Ид><Наименование>Brand</Наименование><ТипЗначений>Справочник</ТипЗначений>
+<ВариантыЗначений>
+<Справочник><ИдЗначения>brand-1</ИдЗначения><Значение>Brand 1</Значение></Справочник>
+<Справочник><ИдЗначения>brand-2</ИдЗначения><Значение>Brand 2</Значение></Справочник>
+</ВариантыЗначений>
+<ДляТоваров>true</ДляТоваров></Свойство>
+<Свойство><Ид>prop-2</Ид><Наименование>Color</Наименование><ТипЗначений>Строка</ТипЗначений>
+<ДляТоваров>true</ДляТоваров></Свойство>
+</Свойства>
+</Классификатор>
+'''
+
+_PRODUCT = '''<Товар>
+<Ид>product-{i}</Ид>
+<Артикул>A-{i}</Артикул>
+<Код>{i}</Код>
+<Наименование>Product {i}</Наименование>
+<БазоваяЕдиница Код="796" НаименованиеПолное="Штука" МеждународноеСокращение="PCE">шт</БазоваяЕдиница>
+<Группы><Ид>gr-{group}</Ид></Группы>
+<Категория>cat-1</Категория>
+<Описание>Description of product {i}</Описание>
+<Картинка>import_files/{i}/product-{i}.jpg</Картинка>
+<ЗначенияСвойств>
+<ЗначенияСвойства><Ид>prop-1</Ид><Значение>brand-{group}</Значение></ЗначенияСвойства>
+<ЗначенияСвойства><Ид>prop-2</Ид><Значение/></ЗначенияСвойства>
+</ЗначенияСвойств>
+<СтавкиНалогов><СтавкаНалога><Наименование>НДС</Наименование><Ставка>20</Ставка></СтавкаНалога></СтавкиНалогов>
+<ЗначенияРеквизитов>
+<ЗначениеРеквизита><Наименование>ВидНоменклатуры</Наименование><Значение>Товар</Значение></ЗначениеРеквизита>
+<ЗначениеРеквизита><Наименование>Вес</Наименование><Значение>{i}</Значение></ЗначениеРеквизита>
+</ЗначенияРеквизитов>
+</Товар>
+'''
+
+_OFFERS_HEADER = '''<ПакетПредложений СодержитТолькоИзменения="{changes_only}">
+<Ид>offers-1</Ид>
+<Наименование>Offers</Наименование>
+<ИдКаталога>catalogue-1</ИдКаталога>
+<ИдКлассификатора>cl-1</ИдКлассификатора>
+<Владелец><Ид>owner-1</Ид><Наименование>Owner</Наименование></Владелец>
+<ТипыЦен>
+<ТипЦены><Ид>price-type-1</Ид><Наименование>Retail</Наименование><Валюта>руб</Валюта>
+<Налог><Наименование>НДС</Наименование><УчтеноВСумме>true</УчтеноВСумме></Налог></ТипЦены>
+</ТипыЦен>
+<Склады><Склад><Ид>stock-1</Ид><Наименование>Main</Наименование></Склад></Склады>
+<Предложения>
+'''
+
+_OFFER = '''<Предложение>
+<Ид>product-{i}</Ид>
+<Артикул>A-{i}</Артикул>
+<Наименование>Product {i}</Наименование>
+<БазоваяЕдиница Код="796" НаименованиеПолное="Штука" МеждународноеСокращение="PCE">шт</БазоваяЕдиница>
+<Цены>
+<Цена><Представление>{price} руб. за шт</Представление><ИдТипаЦены>price-type-1</ИдТипаЦены>
+<ЦенаЗаЕдиницу>{price}</ЦенаЗаЕдиницу><Валюта>руб</Валюта><Единица>шт</Единица><Коэффициент>1</Коэффициент></Цена>
+</Цены>
+<Количество>{count}</Количество>
+<Склад ИдСклада="stock-1" КоличествоНаСкладе="{count}"/>
+</Предложение>
+'''
+
+_DOCUMENT = '''<Документ>
+<Ид>doc-{i}</Ид>
+<Номер>{i}</Номер>
+<Дата>2023-05-04</Дата>
+<Время>12:00:00</Время>
+<ХозОперация>Заказ товара</ХозОперация>
+<Роль>Продавец</Роль>
+<Валюта>руб</Валюта>
+<Курс>1</Курс>
+<Сумма>100</Сумма>
+<Комментарий>Comment {i}</Комментарий>
+</Документ>
+'''
+
+
+def packet_xml(products=0, offers=0, docs=0, *,
+               classifier=True, namespace=False, changes_only=False) -> bytes:
+    """Build packet with `products` in catalogue, `offers` in offers pack and `docs` documents"""
+    f = BytesIO()
+    f.write(_HEADER.format(ns=f' xmlns="{NAMESPACE}"' if namespace else '').encode())
+    if classifier:
+        f.write(_CLASSIFIER.encode())
+
+    if products:
+        f.write(f'<Каталог СодержитТолькоИзменения="{str(changes_only).lower()}">\n'
+                '<Ид>catalogue-1</Ид>\n'
+                '<ИдКлассификатора>cl-1</ИдКлассификатора>\n'
+                '<Наименование>Catalogue</Наименование>\n'
+                '<Товары>\n'.encode())
+        for i in range(products):
+            f.write(_PRODUCT.format(i=i, group=i % 2 + 1).encode())
+        f.write('</Товары>\n</Каталог>\n'.encode())
+
+    if offers:
+        f.write(_OFFERS_HEADER.format(changes_only=str(changes_only).lower()).encode())
+        for i in range(offers):
+            f.write(_OFFER.format(i=i, price=100 + i % 50, count=i % 10).encode())
+        f.write('</Предложения>\n</ПакетПредложений>\n'.encode())
+
+    for i in range(docs):
+        f.write(_DOCUMENT.format(i=i).encode())
+
+    f.write('</КоммерческаяИнформация>\n'.encode())
+    return f.getvalue()
+
+
+def item_state(obj):
+    """Represent parsed object as comparable structure without references to xml"""
+    if isinstance(obj, (list, tuple)):
+        return [item_state(it) for it in obj]
+    if isinstance(obj, dict):
+        return {k: item_state(v) for k, v in obj.items()}
+    # Items are recognized by module, cml.items requires configured Django settings
+    if (type(obj).__module__ == 'cml.items' or hasattr(obj, '__dict__')) and not isinstance(obj, Enum):
+        attrs = dict(getattr(obj, '__dict__', {}))
+        for cls in type(obj).__mro__:  # compact items have __slots__ instead of __dict__
+            for name in getattr(cls, '__slots__', ()):
+                if name.startswith('_') and hasattr(cls, name[1:]):
+                    name = name[1:]  # slot of attribute with lazy default
+                if hasattr(obj, name):
+                    attrs.setdefault(name, getattr(obj, name))
+        return (type(obj).__name__, {k: item_state(v) for k, v in attrs.items()
+                                     if k != 'xml_element'})
+    return obj
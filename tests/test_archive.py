@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import zipfile
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from cml import archive, items
+from .delegate import TestDelegate
+from .protocol import ProtocolRequestsMixin
+from .synthetic import packet_xml
+
+
+def write_zip(path, members: dict):
+    with zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED) as zf:
+        for name, data in members.items():
+            zf.writestr(name, data)
+
+
+class ArchiveTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.zip_path = os.path.join(self.root, 'import.zip')
+        write_zip(self.zip_path, {
+            'import.xml': packet_xml(products=2),
+            'import_files/1/product-1.jpg': b'image',
+            '../outside.jpg': b'image',
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_find_member(self):
+        member = archive.find_member('import.xml', self.zip_path)
+        self.assertEqual(member, archive.ArchiveMember(self.zip_path, 'import.xml'))
+        self.assertEqual(len({member, archive.ArchiveMember(self.zip_path, 'import.xml')}), 1)
+        self.assertIsNone(archive.find_member('offers.xml', self.zip_path))
+        self.assertIsNone(archive.find_member('import.xml', os.path.join(self.root, 'other.zip')))
+
+        # Only not xml files are extracted, paths are kept inside of directory
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'import.xml')))
+        with open(os.path.join(self.root, 'import_files/1/product-1.jpg'), 'rb') as f:
+            self.assertEqual(f.read(), b'image')
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'outside.jpg')))
+
+    def test_indexed_once(self):
+        archive.find_member('import.xml', self.zip_path)
+        os.remove(os.path.join(self.root, 'import_files/1/product-1.jpg'))
+        archive.find_member('import.xml', self.zip_path)
+        self.assertFalse(os.path.exists(os.path.join(self.root, 'import_files/1/product-1.jpg')))
+
+        # New archive is uploaded
+        write_zip(self.zip_path, {'offers.xml': packet_xml(offers=1), 'import_files/1/product-1.jpg': b'new'})
+        self.assertIsNotNone(archive.find_member('offers.xml', self.zip_path))
+        self.assertIsNone(archive.find_member('import.xml', self.zip_path))
+        self.assertTrue(os.path.exists(os.path.join(self.root, 'import_files/1/product-1.jpg')))
+
+    def test_mark_imported(self):
+        write_zip(self.zip_path, {'import.xml': b'', 'offers.xml': b'', 'import_files/1/product-1.jpg': b''})
+        self.assertFalse(archive.mark_imported(archive.ArchiveMember(self.zip_path, 'offers.xml')))
+        self.assertTrue(archive.mark_imported(archive.ArchiveMember(self.zip_path, 'import.xml')))
+
+    def test_parse_member(self):
+        member = archive.find_member('import.xml', self.zip_path)
+        with archive.open_source(member) as f:
+            pack = items.Packet.parse(f)
+        self.assertEqual(len(pack.catalogue.products), 2)
+
+
+class ApiImportZipTestCase(ProtocolRequestsMixin, TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+        self.delegate = TestDelegate()
+        zip_path = os.path.join(items.FileRef.base_path, 'upload.zip')
+        os.makedirs(items.FileRef.base_path, exist_ok=True)
+        write_zip(zip_path, {
+            'import.xml': packet_xml(products=3),
+            'offers.xml': packet_xml(offers=2, classifier=False),
+            'import_files/1/product-1.jpg': b'image',
+        })
+        with open(zip_path, 'rb') as f:
+            self.data = f.read()
+        os.remove(zip_path)
+
+    def tearDown(self):
+        shutil.rmtree(items.FileRef.base_path, ignore_errors=True)
+
+    @override_settings(CML_USE_ZIP=True)
+    def test_import(self):
+        # Files left by previous exchanges are not imported
+        write_zip(os.path.join(items.FileRef.base_path, 'old.zip'), {'import.xml': packet_xml(products=1)})
+        with open(os.path.join(items.FileRef.base_path, 'offers.xml'), 'wb') as f:
+            f.write(packet_xml(offers=1, classifier=False))
+
+        self._request('init')
+        self.assertEqual(self._request('file', self.data, filename='upload.zip').content, b'success\n')
+        # Archive is extracted by upload
+        self.assertTrue(os.path.exists(os.path.join(items.FileRef.base_path, 'import_files/1/product-1.jpg')))
+        self.assertEqual(self._request('import', filename='import.xml').content, b'success\n')
+        cat = self.delegate.imported[1]
+        self.assertEqual(len(cat.products), 3)
+        self.assertEqual(cat.products[1].images[0].get_state(), items.FileState.UPDATED)
+
+        # Archive is kept for the next session
+        self._request('init')
+        self.assertEqual(self._request('import', filename='offers.xml').content, b'success\n')
+        self.assertEqual(len(self.delegate.imported[2].offers), 2)
+        # Files are deleted when all files of archive are imported
+        self.assertFalse(os.path.exists(items.FileRef.base_path))
+
+    @override_settings(CML_USE_ZIP=True)
+    def test_bad_archive(self):
+        self._request('init')
+        self.assertTrue(self._request('file', b'not zip', filename='upload.zip').content.startswith(b'failure'))
+
+    def test_disabled(self):
+        self._request('init')
+        self._request('file', self.data, filename='upload.zip')
+        self.assertTrue(self._request('import', filename='import.xml').content.startswith(b'failure'))
@@ -0,0 +1,107 @@
+# -*- coding: utf-8 -
+from __future__ import absolute_import
+import base64
+from unittest import mock
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser, Permission
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.http import HttpResponse
+from django.test import TestCase, RequestFactory, override_settings
+from cml import auth
+from cml.views import front_view
+
+
+@auth.has_perm_or_basicauth('cml.add_exchange')
+@auth.logged_in_or_basicauth()
+def view(request):
+    return HttpResponse('ok')
+
+
+class CredentialsCacheTestCase(TestCase):
+
+    def setUp(self):
+        auth.credentials_cache.clear()
+        self.addCleanup(auth.credentials_cache.clear)
+        self.user = get_user_model().objects.create_user('cml', password='secret')
+        self.user.user_permissions.add(Permission.objects.get(codename='add_exchange'))
+        patcher = mock.patch('cml.auth.authenticate', wraps=auth.authenticate)
+        self.authenticate = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @staticmethod
+    def _request(password='secret', username='cml'):
+        header = base64.b64encode(f'{username}:{password}'.encode()).decode()
+        request = RequestFactory().get('/cml', HTTP_AUTHORIZATION=f'Basic {header}')
+        SessionMiddleware(lambda r: None).process_request(request)
+        request.user = AnonymousUser()
+        return view(request).status_code
+
+    def test_cached(self):
+        for _ in range(3):
+            self.assertEqual(self._request(), 200)
+        self.assertEqual(self.authenticate.call_count, 1)
+
+        self.assertEqual(self._request('wrong'), 401)
+        self.assertEqual(self._request('wrong'), 401)
+        self.assertEqual(self.authenticate.call_count, 3)
+
+    def test_queries(self):
+        self.assertEqual(self._request(), 200)
+        # Only the user is loaded to check the password stamp. Session and `last_login` are not written
+        with self.assertNumQueries(1):
+            self.assertEqual(self._request(), 200)
+
+    def test_checkauth_session(self):
+        self.assertEqual(self._request(), 200)
+        header = base64.b64encode(b'cml:secret').decode()
+        request = RequestFactory().get('/cml', dict(type='catalog', mode='checkauth'),
+                                       HTTP_AUTHORIZATION=f'Basic {header}')
+        SessionMiddleware(lambda r: None).process_request(request)
+        request.user = AnonymousUser()
+        res = front_view(request)
+        self.assertEqual(self.authenticate.call_count, 1)
+        name, key = res.content.decode().split('\n')[1:3]
+        self.assertEqual(name, settings.SESSION_COOKIE_NAME)
+        self.assertEqual(request.session.session_key, key)
+        self.assertIsNotNone(key)
+
+    def test_password_changed(self):
+        self.assertEqual(self._request(), 200)
+        self.user.set_password('new')
+        self.user.save()
+        self.assertEqual(self._request(), 401)
+        self.assertEqual(self._request('new'), 200)
+        self.assertEqual(self.authenticate.call_count, 3)
+
+    def test_deactivated(self):
+        self.assertEqual(self._request(), 200)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self._request(), 401)
+
+    def test_permission(self):
+        get_user_model().objects.create_user('guest', password='secret')
+        self.assertEqual(self._request(username='guest'), 401)
+        self.assertEqual(self._request(username='guest'), 401)
+        self.assertEqual(self.authenticate.call_count, 1)
+
+    @override_settings(CML_AUTH_CACHE_SIZE=1)
+    def test_size(self):
+        get_user_model().objects.create_user('other', password='secret')
+        self._request()
+        self._request(username='other')
+        self._request()
+        self.assertEqual(self.authenticate.call_count, 3)
+
+    def test_ttl(self):
+        self._request()
+        with mock.patch('cml.auth.time.monotonic', return_value=auth.time.monotonic() + 61):
+            self._request()
+        self.assertEqual(self.authenticate.call_count, 2)
+
+    @override_settings(CML_AUTH_CACHE_TTL=0)
+    def test_disabled(self):
+        self._request()
+        self._request()
+        self.assertEqual(self.authenticate.call_count, 2)
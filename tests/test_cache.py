@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import mock
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, override_settings
+from cml import cache, items, utils, __version__
+from cml.views import ProtocolView
+from .delegate import TestDelegate, BatchTestDelegate
+from .synthetic import packet_xml, item_state
+
+
+class PacketCacheTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(CML_PARSE_CACHE_ROOT=self.root)
+        self.settings.enable()
+        self.path = self._write(packet_xml(products=5, offers=5, docs=1))
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root)
+
+    def _write(self, data: bytes) -> str:
+        fd, path = tempfile.mkstemp(suffix='.xml', dir=self.root)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        return path
+
+    def _entries(self):
+        return sorted(os.listdir(os.path.join(self.root, __version__)))
+
+    def test_same_items(self):
+        path = self._write(packet_xml(products=700, offers=700))  # items are pickled by blocks
+        with open(path, 'rb') as f:
+            expected = item_state(list(items.Packet.iterparse(f)))
+        self.assertEqual(item_state(list(cache.iterparse(path))), expected)
+
+        with mock.patch.object(items.Packet, 'iterparse', side_effect=AssertionError('Parsed again')):
+            self.assertEqual(item_state(list(cache.iterparse(path))), expected)
+
+    def test_shared_values(self):
+        list(cache.iterparse(self.path))
+        offers = [it for it in cache.iterparse(self.path) if isinstance(it, items.Offer)]
+        self.assertIs(offers[0].unit, offers[1].unit)
+
+    def test_not_exhausted(self):
+        stream = cache.iterparse(self.path)
+        next(stream)
+        stream.close()
+        self.assertEqual(self._entries(), [])
+
+    def test_eviction(self):
+        pc = cache.PacketCache()
+        for i, key in enumerate(('a', 'b', 'c')):
+            list(pc.store(key, ['item'] * 100))
+            os.utime(pc._entry_path(key), (i, i))
+        list(pc.load('a'))  # recently used
+        size = os.path.getsize(pc._entry_path('a'))
+
+        pc.max_size = size * 3
+        list(pc.store('d', ['item'] * 100))
+        self.assertEqual(self._entries(), ['a.blocks.gz', 'a.index.pickle', 'c.blocks.gz', 'c.index.pickle',
+                                           'd.blocks.gz', 'd.index.pickle'])
+
+    @mock.patch.object(cache, '_BLOCK_ITEMS', 3)
+    def test_seek(self):
+        with open(self.path, 'rb') as f:
+            parsed = list(items.Packet.iterparse(f))
+        key = cache.file_hash(self.path)
+        self.assertIsNone(cache.PacketCache().seek(key, 1))
+        for start in range(len(parsed) + 1):
+            stream = utils.ItemsStream(parsed)
+            container = stream.skip(start)
+            resumed = cache.iterparse_from(self.path, key, start)
+            self.assertIsNotNone(resumed)
+            self.assertEqual(item_state(resumed[0]), item_state(container))
+            self.assertEqual(item_state(list(resumed[1])), item_state(list(stream)))
+
+    @mock.patch.object(cache, '_BLOCK_ITEMS', 3)
+    def test_parse_resumed(self):
+        with open(self.path, 'rb') as f:
+            expected = item_state(list(items.Packet.iterparse(f)))
+        key = cache.file_hash(self.path)
+        pc = cache.PacketCache()
+        counts = []
+        while True:
+            index = cache.parse_to_cache(self.path, key, deadline=0)  # time is over after each block
+            if index.complete:
+                break
+            counts.append(index.count)
+            # Block written after the last saved index is dropped
+            with open(pc._entry_path(key + cache._PART), 'ab') as f:
+                f.write(b'garbage')
+            self.assertIsNone(pc.load(key))
+        self.assertEqual(counts, list(range(3, len(expected) + 1, 3)))
+        self.assertEqual(index.count, len(expected))
+        self.assertEqual(item_state(list(pc.load(key))), expected)
+        self.assertEqual(len(self._entries()), 2)  # partial entry is replaced
+
+    @mock.patch.object(cache, '_BLOCK_ITEMS', 3)
+    def test_seek_reads_block(self):
+        key = cache.file_hash(self.path)
+        list(cache.iterparse(self.path, key))
+        pc = cache.PacketCache()
+        offsets = pc.load_index(key).offsets
+        with open(pc._entry_path(key), 'r+b') as f:
+            f.write(b'\0' * offsets[2])  # blocks before the container are not read
+
+        container, stream = pc.seek(key, 13)
+        self.assertIsInstance(container, items.OffersPack)
+        self.assertEqual([type(it) for it in stream], [items.Offer, items.Document])
+
+    @override_settings(CML_PARSE_CACHE=True, CML_IMPORT_BATCH_SIZE=2)
+    def test_sliced(self):
+        ud = BatchTestDelegate()
+        pos, slices = 0, []
+        while pos is not None:
+            pv = ProtocolView()
+            pv.user_delegate = ud
+            pv.deadline = 0  # time is over after each batch
+            pos = pv.import_file(self.path, start=pos)
+            slices.append(pos)
+            # The next slices are read from cache
+            mock.patch.object(items.Packet, 'iterparse', side_effect=AssertionError('Parsed again')).start()
+            self.addCleanup(mock.patch.stopall)
+        self.assertEqual(slices, [1, 2, 5, 7, 11, 13, None])
+        self.assertEqual([len(batch) for batch in ud.batches], [2, 2, 1, 2, 2, 1])
+
+    @override_settings(CML_PARSE_CACHE=True)
+    def test_import_file(self):
+        for _ in range(2):
+            ud = TestDelegate()
+            pv = ProtocolView()
+            pv.user_delegate = ud
+            pv.import_file(self.path)
+            self.assertEqual([type(it) for it in ud.imported],
+                             [items.Classifier, items.Catalogue, items.OffersPack, items.Document])
+            self.assertEqual(len(ud.imported[1].products), 5)
+            self.assertEqual(len(ud.imported[2].offers), 5)
+        self.assertEqual(len(self._entries()), 2)  # entry and its index
+
+    def test_from_items(self):
+        data = packet_xml(products=5, offers=5, docs=2)
+        pack = items.Packet.from_items(items.Packet.iterparse(BytesIO(data)))
+        expected = items.Packet.parse(BytesIO(data))
+        self.assertEqual(item_state(vars(pack)), item_state(vars(expected)))
+
+
+class CacheRootTestCase(SimpleTestCase):
+
+    @override_settings(CML_PARSE_CACHE_ROOT=None)
+    def test_required(self):
+        with self.assertRaises(ImproperlyConfigured):
+            cache.PacketCache()
@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -
+from __future__ import absolute_import
+import os
+import shutil
+import threading
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import TestCase, override_settings
+from cml import items, utils
+from .delegate import TestDelegate
+from .protocol import ProtocolRequestsMixin
+from .synthetic import packet_xml
+
+
+class ScopeTestDelegate(TestDelegate):
+    """Counts calls of exchange hooks"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)  # type: ignore
+        self.started = 0
+        self.ended = 0
+
+    def on_exchange_start(self):
+        self.started += 1
+
+    def on_exchange_end(self):
+        self.ended += 1
+
+
+class ChildClassTestCase(TestCase):
+
+    def setUp(self):
+        utils._child_classes.clear()
+        self.addCleanup(utils._child_classes.clear)
+
+    def test_cached(self):
+        with mock.patch('cml.utils.importlib.import_module', wraps=utils.importlib.import_module) as import_module:
+            cls = utils.AbstractUserDelegate.get_child_class()
+            self.assertIs(utils.AbstractUserDelegate.get_child_class(), cls)
+            self.assertIsInstance(utils.AbstractUserDelegate.get_child_instance(), cls)
+        self.assertEqual(import_module.call_count, 1)
+
+    def test_settings_changed(self):
+        cls = utils.AbstractUserDelegate.get_child_class()
+        with override_settings(CML_USER_DELEGATE='tests.test_delegate'):
+            self.assertIsNot(utils.AbstractUserDelegate.get_child_class(), cls)
+
+
+@override_settings(CML_DELEGATE_SCOPE='exchange', CML_DELEGATE_EXCHANGES=2, CML_DELETE_FILES_AFTER_IMPORT=False)
+class ExchangeScopeTestCase(ProtocolRequestsMixin, TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+        self.delegates = []
+        patcher = mock.patch('cml.utils.AbstractUserDelegate.get_child_instance', side_effect=self._create)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(utils._exchange_delegates.clear)
+        self.addCleanup(shutil.rmtree, items.FileRef.base_path, ignore_errors=True)
+
+        for filename, data in (('import.xml', packet_xml(products=2)), ('offers.xml', packet_xml(offers=2))):
+            fref = items.FileRef(filename)
+            os.makedirs(fref.full_path.parent, exist_ok=True)
+            with open(fref.full_path, 'wb') as f:
+                f.write(data)
+
+    def _create(self):
+        ud = ScopeTestDelegate()
+        self.delegates.append(ud)
+        return ud
+
+    def test_import_steps(self):
+        # Each file is imported by own session
+        for filename in ('import.xml', 'offers.xml'):
+            self._request('init')
+            self.assertEqual(self._request('import', filename=filename).content, b'success\n')
+        self.assertEqual(len(self.delegates), 1)
+        ud = self.delegates[0]
+        self.assertEqual([type(it) for it in ud.imported if not isinstance(it, items.Classifier)],
+                         [items.Catalogue, items.OffersPack])
+        self.assertEqual((ud.started, ud.ended), (1, 0))
+
+        self._request('init', p_type='sale')
+        self._request('success', p_type='sale')
+        self.assertEqual((ud.started, ud.ended), (1, 1))
+
+    def test_ttl(self):
+        ud = utils.AbstractUserDelegate.get_exchange_instance(self.user.pk)
+        self.assertIs(utils.AbstractUserDelegate.get_exchange_instance(self.user.pk), ud)
+        with override_settings(CML_DELEGATE_EXCHANGE_TTL=-1):
+            self.assertIsNot(utils.AbstractUserDelegate.get_exchange_instance(self.user.pk), ud)
+        self.assertEqual(ud.ended, 1)
+
+    def test_limit(self):
+        users = [get_user_model().objects.create_user(f'cml-{i}') for i in range(3)]
+        for user in users:
+            utils.AbstractUserDelegate.get_exchange_instance(user.pk)
+        self.assertEqual([ud.ended for ud in self.delegates], [1, 0, 0])
+        self.assertIs(utils.AbstractUserDelegate.get_exchange_instance(users[2].pk), self.delegates[2])
+
+    def test_concurrent_start(self):
+        other = get_user_model().objects.create_user('cml-other')
+        starting, release = threading.Event(), threading.Event()
+        results = []
+
+        def slow_start(ud):
+            starting.set()
+            release.wait(10)
+
+        def get_instance():
+            results.append(utils.AbstractUserDelegate.get_exchange_instance(self.user.pk))
+
+        with mock.patch.object(ScopeTestDelegate, 'on_exchange_start', slow_start):
+            thread = threading.Thread(target=get_instance)
+            thread.start()
+            self.assertTrue(starting.wait(10))
+        # Requests are not blocked by the slow start
+        utils.AbstractUserDelegate.get_exchange_instance(other.pk)
+        ud = utils.AbstractUserDelegate.get_exchange_instance(self.user.pk)
+        release.set()
+        thread.join(10)
+
+        # Instance inserted first is shared, the other one is ended
+        self.assertIs(ud, self.delegates[2])
+        self.assertEqual(results, [ud])
+        self.assertEqual([d.ended for d in self.delegates], [1, 0, 0])
+
+    @override_settings(CML_DELEGATE_SCOPE='request')
+    def test_request_scope(self):
+        self._request('init')
+        self._request('import', filename='import.xml')
+        self.assertEqual(len(self.delegates), 2)
+        self.assertEqual(self.delegates[1].started, 0)
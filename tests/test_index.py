@@ -0,0 +1,286 @@
+# -*- coding: utf-8 -
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.test import SimpleTestCase, TestCase, override_settings
+from cml import items
+from cml.views import ProtocolView
+from .delegate import TestDelegate, BatchTestDelegate
+from .protocol import ProtocolRequestsMixin
+from .synthetic import packet_xml
+
+
+class FingerprintTestCase(SimpleTestCase):
+
+    def test_stable(self):
+        data = packet_xml(products=2, offers=2)
+        pack_1 = items.Packet.parse(BytesIO(data))
+        pack_2 = items.Packet.parse(BytesIO(data), keep_xml_elements=False)
+        products_1, products_2 = pack_1.catalogue.products, pack_2.catalogue.products
+        self.assertEqual(products_1[0].fingerprint(), products_2[0].fingerprint())
+        self.assertNotEqual(products_1[0].fingerprint(), products_1[1].fingerprint())
+        self.assertEqual(pack_1.offers_pack.offers[1].fingerprint(), pack_2.offers_pack.offers[1].fingerprint())
+
+    def test_changed(self):
+        data = packet_xml(offers=1)
+        offer = items.Packet.parse(BytesIO(data)).offers_pack.offers[0]
+        changed = items.Packet.parse(BytesIO(data.replace('<Количество>0<'.encode(), '<Количество>5<'.encode())))
+        self.assertNotEqual(offer.fingerprint(), changed.offers_pack.offers[0].fingerprint())
+
+
+class SkipUnchangedTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(CML_SKIP_UNCHANGED_ITEMS=True,
+                                          CML_INDEX_PATH=os.path.join(self.root, 'index', 'index.sqlite3'))
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root)
+
+    def _import(self, data: bytes, delegate=None, name='import.xml'):
+        path = os.path.join(self.root, name)
+        with open(path, 'wb') as f:
+            f.write(data)
+        pv = ProtocolView()
+        pv.user_delegate = delegate or TestDelegate()
+        pv.import_file(path)
+        return pv
+
+    def test_skip(self):
+        data = packet_xml(products=10, offers=10)
+        pv = self._import(data)
+        self.assertEqual(len(pv.user_delegate.imported[1].products), 10)
+        self.assertEqual(pv.get_changes_report(), 'product: changed=10 skipped=0\noffer: changed=10 skipped=0')
+
+        pv = self._import(data)
+        cat, off_pack = pv.user_delegate.imported[1:3]
+        self.assertEqual((len(cat.products), len(off_pack.offers)), (0, 0))
+        # Filtered full catalogue is not a complete snapshot
+        self.assertEqual((cat.has_changes_only, off_pack.has_changes_only), (True, True))
+        self.assertEqual(pv.get_changes_report(), 'product: changed=0 skipped=10\noffer: changed=0 skipped=10')
+
+        pv = self._import(data.replace(b'>Product 3<', b'>Product 3 new<'))
+        cat, off_pack = pv.user_delegate.imported[1:3]
+        self.assertEqual([it.uid for it in cat.products], ['product-3'])
+        self.assertEqual([it.product_uid for it in off_pack.offers], ['product-3'])
+
+        # Fingerprints are kept for each file
+        pv = self._import(data, name='import_1.xml')
+        self.assertEqual(len(pv.user_delegate.imported[1].products), 10)
+
+    def test_failed_import(self):
+        class FailingDelegate(TestDelegate):
+            def import_offers(self, off_pack):
+                raise RuntimeError('Failed')
+
+        data = packet_xml(products=3, offers=3)
+        with self.assertRaises(RuntimeError):
+            self._import(data, FailingDelegate())
+        pv = self._import(data)
+        cat, off_pack = pv.user_delegate.imported[1:3]
+        self.assertEqual((len(cat.products), len(off_pack.offers)), (0, 3))
+
+    @override_settings(CML_IMPORT_BATCH_SIZE=4)
+    def test_batches(self):
+        class StopDelegate(BatchTestDelegate):
+            def import_catalogue_batches(self, cat, batches):
+                self.batches.append(next(batches))
+
+        data = packet_xml(products=10)
+        self._import(data, StopDelegate())
+        ud = BatchTestDelegate()
+        self._import(data, ud)
+        # Products not requested by previous delegate are not saved as imported
+        self.assertEqual([it.uid for batch in ud.batches for it in batch],
+                         [f'product-{i}' for i in range(4, 10)])
+
+    def test_new_files(self):
+        data = packet_xml(products=2)
+        self._import(data)
+        fref = items.FileRef('import_files/1/product-1.jpg')
+        os.makedirs(fref.full_path.parent, exist_ok=True)
+        fref.full_path.touch()
+        try:
+            pv = self._import(data)
+        finally:
+            os.remove(fref.full_path)
+        self.assertEqual([it.uid for it in pv.user_delegate.imported[1].products], ['product-1'])
+
+
+@override_settings(CML_TRACK_REMOVED_PRODUCTS=True)
+class RemovedProductsTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(CML_INDEX_PATH=os.path.join(self.root, 'index.sqlite3'))
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root)
+
+    def _import(self, data: bytes, delegate=None):
+        path = os.path.join(self.root, 'import.xml')
+        with open(path, 'wb') as f:
+            f.write(data)
+        pv = ProtocolView()
+        pv.user_delegate = delegate or TestDelegate()
+        pv.import_file(path)
+        return pv.user_delegate
+
+    @staticmethod
+    def _without(data: bytes, *indexes) -> bytes:
+        for i in indexes:
+            data = data.replace(f'<Ид>product-{i}</Ид>'.encode(), f'<Ид>new-{i}</Ид>'.encode())
+        return data
+
+    def test_removed(self):
+        data = packet_xml(products=5)
+        cat = self._import(data).imported[1]
+        self.assertFalse(cat.has_changes_only)
+        self.assertEqual(cat.removed_uids, set())
+        self.assertEqual(self._import(self._without(data, 1, 3)).imported[1].removed_uids, {'product-1', 'product-3'})
+        self.assertEqual(self._import(data).imported[1].removed_uids, {'new-1', 'new-3'})
+
+    def test_changes_only(self):
+        data = packet_xml(products=5)
+        self._import(data)
+        cat = self._import(packet_xml(products=2, changes_only=True)).imported[1]
+        self.assertTrue(cat.has_changes_only)
+        self.assertIsNone(cat.removed_uids)
+        # Partial catalogue doesn't change the last full one
+        self.assertEqual(self._import(self._without(data, 4)).imported[1].removed_uids, {'product-4'})
+
+    def test_batches(self):
+        class Delegate(BatchTestDelegate):
+            def import_catalogue_batches(self, cat, batches):
+                super().import_catalogue_batches(cat, batches)
+                self.removed_uids = cat.removed_uids
+
+        data = packet_xml(products=25)
+        self._import(data)
+        ud = self._import(self._without(data, 0, 24), Delegate())
+        self.assertEqual(ud.removed_uids, {'product-0', 'product-24'})
+
+    @override_settings(CML_IMPORT_BATCH_SIZE=10)
+    def test_sliced(self):
+        class Delegate(BatchTestDelegate):
+            def import_catalogue_batches(self, cat, batches):
+                super().import_catalogue_batches(cat, batches)
+                self.removed_uids = cat.removed_uids
+
+        data = packet_xml(products=25)
+        self._import(data)
+        path = os.path.join(self.root, 'import.xml')
+        with open(path, 'wb') as f:
+            f.write(self._without(data, 0, 24))
+
+        ud = Delegate()
+        pos, slices = 0, []
+        while pos is not None:
+            pv = ProtocolView()
+            pv.user_delegate = ud
+            pv.deadline = 0  # time is over after each batch
+            pos = pv.import_file(path, start=pos)
+            slices.append(pos)
+        # Catalogue import is continued by the next slice with the rest of batches
+        self.assertEqual(slices, [1, 2, 13, 23, None])
+        self.assertEqual([len(batch) for batch in ud.batches], [10, 10, 5])
+        self.assertEqual(ud.removed_uids, {'product-0', 'product-24'})
+
+    def test_failed_import(self):
+        class FailingDelegate(TestDelegate):
+            def import_catalogue(self, cat):
+                raise RuntimeError('Failed')
+
+        data = packet_xml(products=3)
+        self._import(data)
+        with self.assertRaises(RuntimeError):
+            self._import(self._without(data, 0), FailingDelegate())
+        self.assertEqual(self._import(self._without(data, 1)).imported[1].removed_uids, {'product-1'})
+
+
+class FileStateTestDelegate(TestDelegate):
+    """Collects states of images of products"""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)  # type: ignore
+        self.states = {}
+
+    def import_catalogue(self, cat: items.Catalogue):
+        super().import_catalogue(cat)
+        for p in cat.products:
+            for image in p.images:
+                self.states[str(image.path)] = image.get_state()
+
+
+class UnchangedFilesTestCase(ProtocolRequestsMixin, TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.settings = override_settings(CML_TRACK_UNCHANGED_FILES=True, CML_DELETE_FILES_AFTER_IMPORT=False,
+                                          CML_INDEX_PATH=os.path.join(self.root, 'index.sqlite3'))
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        self.addCleanup(shutil.rmtree, self.root)
+        self.addCleanup(shutil.rmtree, items.FileRef.base_path, ignore_errors=True)
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+        self.delegate = TestDelegate()
+
+    def _exchange(self, images: dict, fail=False) -> dict:
+        """Upload images and catalogue, returns states of images seen by delegate"""
+        self._request('init')
+        for path, data in images.items():
+            self.assertEqual(self._request('file', data, filename=path).content, b'success\n')
+        self._request('file', packet_xml(products=2, offers=2), filename='import.xml')
+        ud = FileStateTestDelegate()
+        if fail:
+            # Offers are imported after catalogue
+            ud.import_offers = mock.Mock(side_effect=ValueError('Database is gone'))
+            with self.assertLogs('cml', 'ERROR'):
+                self._request('import', delegate=ud, filename='import.xml')
+        else:
+            self.assertEqual(self._request('import', delegate=ud, filename='import.xml').content, b'success\n')
+        return ud.states
+
+    def test_unchanged(self):
+        images = {'import_files/0/product-0.jpg': b'image-0', 'import_files/1/product-1.jpg': b'image-1'}
+        self.assertEqual(self._exchange(images), {
+            'import_files/0/product-0.jpg': items.FileState.UPDATED,
+            'import_files/1/product-1.jpg': items.FileState.UPDATED,
+        })
+
+        images['import_files/1/product-1.jpg'] = b'image-1 changed'
+        self.assertEqual(self._exchange(images), {
+            'import_files/0/product-0.jpg': items.FileState.UNCHANGED,
+            'import_files/1/product-1.jpg': items.FileState.UPDATED,
+        })
+
+        # File replaced after upload isn't reported as unchanged
+        fref = items.FileRef('import_files/0/product-0.jpg')
+        with open(fref.full_path, 'wb') as f:
+            f.write(b'image-0 replaced')
+        self.assertEqual(fref.get_state(), items.FileState.UPDATED)
+
+    def test_failed_import(self):
+        images = {'import_files/0/product-0.jpg': b'image-0'}
+        states = self._exchange(images, fail=True)
+        self.assertEqual(states['import_files/0/product-0.jpg'], items.FileState.UPDATED)
+        # Hashes are saved only by successful import
+        states = self._exchange(images)
+        self.assertEqual(states['import_files/0/product-0.jpg'], items.FileState.UPDATED)
+        states = self._exchange(images)
+        self.assertEqual(states['import_files/0/product-0.jpg'], items.FileState.UNCHANGED)
+
+    def test_disabled(self):
+        images = {'import_files/0/product-0.jpg': b'image-0'}
+        self._exchange(images)
+        with override_settings(CML_TRACK_UNCHANGED_FILES=False):
+            states = self._exchange(images)
+        self.assertEqual(states['import_files/0/product-0.jpg'], items.FileState.UPDATED)
@@ -0,0 +1,173 @@
+# -*- coding: utf-8 -
+from __future__ import absolute_import
+import gc
+import tracemalloc
+from decimal import Decimal
+from io import BytesIO
+from unittest import mock
+from django.test import SimpleTestCase, override_settings
+from cml import items
+from cml.xml import XmlElement
+from .synthetic import packet_xml, item_state
+
+
+class PacketIterparseTestCase(SimpleTestCase):
+
+    def _parse_both(self, **kwargs):
+        data = packet_xml(**kwargs)
+        return items.Packet.parse(BytesIO(data)), list(items.Packet.iterparse(BytesIO(data)))
+
+    def test_order(self):
+        _, stream = self._parse_both(products=3, offers=2, docs=1)
+        names = [type(it).__name__ for it in stream]
+        self.assertEqual(names, ['Packet', 'Classifier',
+                                 'Catalogue', 'Product', 'Product', 'Product',
+                                 'OffersPack', 'Offer', 'Offer',
+                                 'Document'])
+
+    def test_same_as_parse(self):
+        for namespace in (False, True):
+            pack, stream = self._parse_both(products=10, offers=10, docs=2, namespace=namespace)
+            cat = next(it for it in stream if isinstance(it, items.Catalogue))
+            off_pack = next(it for it in stream if isinstance(it, items.OffersPack))
+            products = [it for it in stream if isinstance(it, items.Product)]
+            offers = [it for it in stream if isinstance(it, items.Offer)]
+            docs = [it for it in stream if isinstance(it, items.Document)]
+
+            self.assertEqual(stream[0].version, pack.version)
+            self.assertEqual(stream[0].create_date, pack.create_date)
+            self.assertEqual(item_state(stream[1]), item_state(pack.classifier))
+            self.assertEqual(cat.products, [])
+            self.assertEqual(off_pack.offers, [])
+
+            cat.products = products
+            off_pack.offers = offers
+            self.assertEqual(item_state(cat), item_state(pack.catalogue))
+            self.assertEqual(item_state(off_pack), item_state(pack.offers_pack))
+            self.assertEqual(item_state(docs), item_state(pack.docs))
+
+    def test_release(self):
+        data = packet_xml(products=200, offers=200)
+        for it in items.Packet.iterparse(BytesIO(data)):
+            if isinstance(it, (items.Product, items.Offer)):
+                # Only the last processed sibling is kept in the tree and it is empty
+                prev = it.xml_element.el.getprevious()
+                if prev is not None:
+                    self.assertEqual(len(prev), 0)
+                    self.assertIsNone(prev.getprevious())
+
+
+def _xml_elements_count():
+    gc.collect()
+    return sum(1 for obj in gc.get_objects() if isinstance(obj, XmlElement))
+
+
+class KeepXmlElementsTestCase(SimpleTestCase):
+
+    def _retained(self, data, **kwargs):
+        """Parse packet and return it with size of memory allocated by python which stays in use"""
+        gc.collect()
+        tracemalloc.start()
+        try:
+            pack = items.Packet.parse(BytesIO(data), **kwargs)
+            gc.collect()
+            size, _ = tracemalloc.get_traced_memory()
+        finally:
+            tracemalloc.stop()
+        return pack, size
+
+    def test_same_items(self):
+        data = packet_xml(products=10, offers=10, docs=2)
+        kept = items.Packet.parse(BytesIO(data))
+        dropped = items.Packet.parse(BytesIO(data), keep_xml_elements=False)
+        self.assertIsNotNone(kept.catalogue.products[0].xml_element)
+        self.assertIsNone(dropped.catalogue.products[0].xml_element)
+        self.assertIsNone(dropped.offers_pack.offers[0].prices[0].xml_element)
+        self.assertEqual(item_state(kept.catalogue), item_state(dropped.catalogue))
+        self.assertEqual(item_state(kept.offers_pack), item_state(dropped.offers_pack))
+        self.assertEqual(item_state(kept.docs), item_state(dropped.docs))
+
+    def test_setting(self):
+        data = packet_xml(products=1)
+        with override_settings(CML_KEEP_XML_ELEMENTS=False):
+            self.assertIsNone(items.Packet.parse(BytesIO(data)).catalogue.xml_element)
+            self.assertIsNotNone(items.Packet.parse(BytesIO(data), keep_xml_elements=True).catalogue.xml_element)
+            products = [it for it in items.Packet.iterparse(BytesIO(data)) if isinstance(it, items.Product)]
+            self.assertIsNone(products[0].xml_element)
+
+    def test_memory(self):
+        data = packet_xml(products=2000, offers=2000)
+        before = _xml_elements_count()
+        pack, kept = self._retained(data)
+        self.assertGreater(_xml_elements_count(), before)
+        del pack
+        pack, dropped = self._retained(data, keep_xml_elements=False)
+        # Nothing refers to xml, so whole tree is freed
+        self.assertEqual(_xml_elements_count(), before)
+        # Memory of libxml2 is not traced, only python wrappers of elements are counted here
+        self.assertLess(dropped, kept * 0.8)
+
+
+class SharedValuesTestCase(SimpleTestCase):
+
+    def test_parse(self):
+        data = packet_xml(products=3, offers=3)
+        for pack in (items.Packet.parse(BytesIO(data)),
+                     items.Packet.parse(BytesIO(data), keep_xml_elements=False)):
+            of1, of2 = pack.offers_pack.offers[:2]
+            self.assertIsNot(of1.product_uid, of2.product_uid)
+            self.assertIs(of1.unit, of2.unit)
+            self.assertIs(of1.prices[0].uid, of2.prices[0].uid)
+            self.assertIs(of1.prices[0].currency_name, of2.prices[0].currency_name)
+            self.assertIs(of1.prices[0].ratio, of2.prices[0].ratio)
+            self.assertIs(of1.stocks[0].stock_uid, of2.stocks[0].stock_uid)
+            pr1, pr2 = pack.catalogue.products[:2]
+            self.assertIs(pr1.unit, pr2.unit)
+            self.assertIs(pr1.category_uid, pr2.category_uid)
+
+    def test_iterparse(self):
+        offers = [it for it in items.Packet.iterparse(BytesIO(packet_xml(offers=2)))
+                  if isinstance(it, items.Offer)]
+        self.assertIs(offers[0].unit, offers[1].unit)
+        self.assertIs(offers[0].prices[0].uid, offers[1].prices[0].uid)
+
+    def test_release(self):
+        created = []
+        with mock.patch.object(items.ParseContext, 'release', autospec=True,
+                               side_effect=items.ParseContext.release) as release:
+            items.Packet.parse(BytesIO(packet_xml(offers=2)))
+            created.append(release.call_args[0][0])
+            for _ in items.Packet.iterparse(BytesIO(packet_xml(offers=2))):
+                pass
+            created.append(release.call_args[0][0])
+        for ctx in created:
+            self.assertEqual(ctx.tables, {})
+            self.assertEqual(ctx.units, {})
+        self.assertIsNone(items.ParseContext.current())
+
+    def test_without_context(self):
+        self.assertEqual(items.shared_decimal('1.5'), Decimal('1.5'))
+        self.assertEqual(items.shared_str('руб'), 'руб')
+        self.assertEqual(items.shared_decimal.__name__, 'Decimal')
+
+
+class DefaultsTestCase(SimpleTestCase):
+
+    def test_not_shared(self):
+        ref_1, ref_2 = items.ProductRef(), items.ProductRef()
+        ref_1.unit.name_full = 'Упаковка'
+        self.assertEqual(ref_2.unit.name_full, 'Штука')
+        self.assertEqual(items.Offer().unit.name_full, 'Штука')
+
+        product = items.Product()
+        product.images.append(items.FileRef('import_files/1.jpg'))
+        product.requisites['ВидНоменклатуры'] = 'Товар'
+        self.assertEqual(items.Product().images, [])
+        self.assertEqual(items.Product().requisites, {})
+
+    def test_fingerprint(self):
+        # Default value created by access doesn't change fingerprint
+        offer = items.Offer()
+        fp = offer.fingerprint()
+        self.assertEqual(offer.unit.unit_id, 796)
+        self.assertEqual(offer.fingerprint(), fp)
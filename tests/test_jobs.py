@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -
+from __future__ import absolute_import
+import datetime
+import os
+import shutil
+from io import StringIO
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.test import TestCase, override_settings
+from django.utils import timezone
+from cml import items, jobs
+from cml.models import Exchange, ExchangeJob, ExchangeState, JobState
+from cml.views import ProtocolView
+from .delegate import TestDelegate
+from .protocol import ProtocolRequestsMixin
+from .synthetic import packet_xml
+
+
+@override_settings(CML_IMPORT_MODE='queue', CML_DELETE_FILES_AFTER_IMPORT=False)
+class ExchangeJobTestCase(ProtocolRequestsMixin, TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+        self.delegate = TestDelegate()
+        patcher = mock.patch('cml.utils.AbstractUserDelegate.get_child_instance', return_value=self.delegate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(shutil.rmtree, items.FileRef.base_path, ignore_errors=True)
+        self._write('import.xml', packet_xml(products=3, offers=2))
+
+    @staticmethod
+    def _write(filename, data):
+        fref = items.FileRef(filename)
+        os.makedirs(fref.full_path.parent, exist_ok=True)
+        with open(fref.full_path, 'wb') as f:
+            f.write(data)
+
+    def test_worker(self):
+        self._request('init')
+        res = self._request('import', filename='import.xml')
+        self.assertEqual(res.content, b'progress\nImport queued: import.xml')
+        res = self._request('import', filename='import.xml')
+        self.assertEqual(res.content, b'progress\nImport queued: import.xml')
+        self.assertEqual(self.delegate.imported, [])
+
+        out = StringIO()
+        call_command('cml_worker', once=True, stdout=out)
+        self.assertEqual(out.getvalue(), 'Done jobs: 1\n')
+        job = ExchangeJob.objects.get()
+        self.assertEqual(job.state, str(JobState.DONE))
+        self.assertIsNotNone(job.dt_finished)
+        self.assertEqual(len(self.delegate.imported), 3)
+
+        self.assertEqual(self._request('import', filename='import.xml').content, b'success\n')
+        rec = Exchange.objects.get()
+        self.assertEqual(rec.state, str(ExchangeState.DONE))
+        self.assertEqual((rec.c_imp_classifier, rec.c_imp_catalogue, rec.c_imp_offers_pack), (1, 1, 1))
+
+    def test_claim(self):
+        rec = Exchange.objects.create(user=self.user)
+        low = ExchangeJob.objects.create(exchange=rec, file_name='offers.xml')
+        high = ExchangeJob.objects.create(exchange=rec, file_name='import.xml', priority=1)
+        self.assertEqual(jobs.claim('worker-1'), high)
+        self.assertEqual(jobs.claim('worker-2'), low)
+        self.assertIsNone(jobs.claim('worker-1'))
+        low.refresh_from_db()
+        self.assertEqual((low.state, low.worker), (str(JobState.RUNNING), 'worker-2'))
+
+    def _enqueue(self, filename, data, exchange=None):
+        self._write(filename, data)
+        return jobs.enqueue(exchange or Exchange.objects.create(user=self.user), filename,
+                            items.FileRef(filename).full_path)
+
+    def test_priority(self):
+        offers = self._enqueue('offers.xml', packet_xml(offers=1))
+        catalogue = self._enqueue('import.xml', packet_xml(products=1))
+        self.assertEqual((offers.kind, offers.catalogue_uid), ('offers', 'catalogue-1'))
+        self.assertEqual((catalogue.kind, catalogue.catalogue_uid), ('catalogue', 'catalogue-1'))
+        self.assertEqual(jobs.claim(), catalogue)
+        self.assertEqual(jobs.claim(), offers)
+
+    def test_supersede(self):
+        running = self._enqueue('offers_0.xml', packet_xml(offers=1))
+        jobs.claim()
+        full = self._enqueue('offers_1.xml', packet_xml(offers=1))
+        changes = self._enqueue('offers_2.xml', packet_xml(offers=1, changes_only=True))
+        self.assertTrue(changes.has_changes_only)
+        other = self._enqueue('offers_3.xml', packet_xml(offers=1).replace(b'catalogue-1', b'catalogue-2'))
+        catalogue = self._enqueue('import.xml', packet_xml(products=1))
+        self.assertEqual(ExchangeJob.objects.filter(state=str(JobState.SUPERSEDED)).count(), 0)
+
+        last = self._enqueue('offers_4.xml', packet_xml(offers=1))
+        states = {job.pk: job.state for job in ExchangeJob.objects.all()}
+        self.assertEqual(states, {
+            running.pk: str(JobState.RUNNING),
+            full.pk: str(JobState.SUPERSEDED),
+            changes.pk: str(JobState.SUPERSEDED),
+            other.pk: str(JobState.QUEUED),
+            catalogue.pk: str(JobState.QUEUED),
+            last.pk: str(JobState.QUEUED),
+        })
+        rec = full.exchange
+        rec.refresh_from_db()
+        self.assertEqual(rec.job_state, str(JobState.DONE))
+        self.assertEqual(rec.report, f'Import skipped: superseded by offers of exchange {last.exchange_id}')
+
+    def test_supersede_files_of_exchange(self):
+        rec = Exchange.objects.create(user=self.user)
+        offers = self._enqueue('offers0_1.xml', packet_xml(offers=1), rec)
+        prices = self._enqueue('prices0_1.xml', packet_xml(offers=1), rec)
+        # The second file of the same exchange doesn't supersede the first one
+        second = self._enqueue('offers0_2.xml', packet_xml(offers=1), rec)
+        self.assertEqual(ExchangeJob.objects.filter(state=str(JobState.SUPERSEDED)).count(), 0)
+
+        last = self._enqueue('offers0_1.xml', packet_xml(offers=1))
+        states = {job.pk: job.state for job in ExchangeJob.objects.all()}
+        self.assertEqual(states, {
+            offers.pk: str(JobState.SUPERSEDED),
+            prices.pk: str(JobState.QUEUED),
+            second.pk: str(JobState.SUPERSEDED),
+            last.pk: str(JobState.QUEUED),
+        })
+
+    def test_offers_wait_catalogue(self):
+        rec = Exchange.objects.create(user=self.user)
+        other = self._enqueue('prices.xml', packet_xml(offers=1))
+        offers = self._enqueue('offers0_1.xml', packet_xml(offers=1), rec)
+        catalogue = ExchangeJob.objects.create(exchange=rec, file_name='import.xml', kind='catalogue',
+                                               priority=jobs.PRIORITY['catalogue'])
+        self.assertEqual(jobs.claim(), catalogue)
+        self.assertEqual(jobs.claim(), other)
+        self.assertIsNone(jobs.claim())  # catalogue of the exchange is running
+
+        ExchangeJob.objects.filter(pk=catalogue.pk).update(state=str(JobState.DONE))
+        self.assertEqual(jobs.claim(), offers)
+
+    def test_failure(self):
+        self._request('init')
+        self._request('import', filename='import.xml')
+        with mock.patch.object(self.delegate, 'import_catalogue', side_effect=ValueError('Database is gone')), \
+                self.assertLogs('cml', 'ERROR'):
+            self.assertEqual(jobs.run_worker(once=True), 1)
+        self.assertEqual(ExchangeJob.objects.get().state, str(JobState.FAILED))
+        res = self._request('import', filename='import.xml')
+        self.assertEqual(res.content, b'failure\nImport failed: Database is gone')
+
+    def test_file_not_found(self):
+        self._request('init')
+        self._request('import', filename='import.xml')
+        os.remove(jobs.get_source(ExchangeJob.objects.get()))
+        with self.assertLogs('cml', 'ERROR'):
+            jobs.run_worker(once=True)
+        self.assertEqual(self._request('import', filename='import.xml').content,
+                         b'failure\nFile not found: import.xml')
+
+    def test_uploaded_again(self):
+        self._request('init')
+        self._request('file', packet_xml(offers=2), filename='offers.xml')
+        self._request('import', filename='offers.xml')
+        job = ExchangeJob.objects.get()
+        # The next exchange uploads the file while the job is queued
+        self._request('init')
+        self._request('file', packet_xml(offers=3), filename='offers.xml')
+
+        self.assertEqual(jobs.run_worker(once=True), 1)
+        job.refresh_from_db()
+        self.assertEqual(job.state, str(JobState.DONE))
+        self.assertEqual(len(self.delegate.imported[-1].offers), 2)
+        # Only directory of the job is deleted
+        self.assertFalse(os.path.exists(jobs.get_jobs_root()))
+        self.assertTrue(items.FileRef('offers.xml').full_path.exists())
+
+    @override_settings(CML_DELETE_FILES_AFTER_IMPORT=True)
+    def test_files_of_jobs_kept(self):
+        job = self._enqueue('offers.xml', packet_xml(offers=1))
+        ProtocolView.delete_files_after_import()
+        self.assertFalse(items.FileRef('import.xml').full_path.exists())
+        self.assertTrue(jobs.get_source(job).exists())
+
+    def test_changed_file(self):
+        self._request('init')
+        self._request('import', filename='import.xml')
+        with open(jobs.get_source(ExchangeJob.objects.get()), 'ab') as f:
+            f.write(b'\n')
+        with self.assertLogs('cml', 'ERROR'):
+            jobs.run_worker(once=True)
+        self.assertEqual(self._request('import', filename='import.xml').content,
+                         b'failure\nFile is changed since import was queued: import.xml')
+        self.assertEqual(self.delegate.imported, [])
+
+    def test_stale_requeued(self):
+        rec = Exchange.objects.create(user=self.user)
+        job = ExchangeJob.objects.create(exchange=rec, file_name='import.xml')
+        self.assertEqual(jobs.claim('worker-1'), job)
+        Exchange.objects.filter(pk=rec.pk).update(job_state=str(JobState.RUNNING), job_heartbeat=timezone.now())
+        self.assertIsNone(jobs.claim('worker-2'))
+
+        # Worker is killed
+        stale = timezone.now() - datetime.timedelta(seconds=301)
+        Exchange.objects.filter(pk=rec.pk).update(job_heartbeat=stale)
+        with self.assertLogs('cml', 'WARNING'):
+            self.assertEqual(jobs.claim('worker-2'), job)
+        rec.refresh_from_db()
+        self.assertEqual(rec.job_state, str(JobState.QUEUED))
+
+    def test_stale_failed(self):
+        self._request('init')
+        self._request('import', filename='import.xml')
+        job = jobs.claim()
+        stale = timezone.now() - datetime.timedelta(seconds=301)
+        Exchange.objects.update(job_state=str(JobState.RUNNING), job_heartbeat=stale)
+        with self.assertLogs('cml', 'ERROR'):
+            res = self._request('import', filename='import.xml')
+        self.assertEqual(res.content, b'failure\nImport failed: job is not responding. filename: import.xml')
+        job.refresh_from_db()
+        self.assertEqual(job.state, str(JobState.FAILED))
+        rec = Exchange.objects.get()
+        self.assertEqual((rec.state, rec.job_state), (str(ExchangeState.ABORT), str(JobState.FAILED)))
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -
+from __future__ import absolute_import
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from unittest import mock
+from django.test import SimpleTestCase, override_settings
+from cml import items, parallel
+from .synthetic import packet_xml, item_state
+
+
+@mock.patch('cml.parallel.MIN_CHUNK_SIZE', 1024)
+class ParallelParseTestCase(SimpleTestCase):
+
+    def _assert_same(self, data: bytes):
+        serial = items.Packet.parse(BytesIO(data), keep_xml_elements=False)
+        pack = items.Packet.parse(BytesIO(data), keep_xml_elements=False, processes=2)
+        self.assertEqual(item_state(pack.__dict__), item_state(serial.__dict__))
+        return pack
+
+    def test_same_as_serial(self):
+        for namespace in (False, True):
+            pack = self._assert_same(packet_xml(products=50, offers=50, docs=2, namespace=namespace))
+            self.assertEqual(len(pack.catalogue.products), 50)
+            self.assertEqual(pack.offers_pack.offers[-1].product_uid, 'product-49')
+            self.assertEqual(len(pack.docs), 2)
+
+    def test_encoding(self):
+        data = packet_xml(products=20, offers=20).decode().replace('UTF-8', 'windows-1251')
+        self._assert_same(data.encode('cp1251'))
+
+    def test_file(self):
+        data = packet_xml(products=50, offers=50)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'import.xml')
+            with open(path, 'wb') as f:
+                f.write(data)
+            with mock.patch('cml.parallel.ProcessPoolExecutor', ThreadPoolExecutor), \
+                    mock.patch.object(ThreadPoolExecutor, 'submit', autospec=True,
+                                      side_effect=ThreadPoolExecutor.submit) as submit:
+                with open(path, 'rb') as f:
+                    pack = items.Packet.parse(f, keep_xml_elements=False, processes=2)
+            # Workers read chunks from the file by offsets
+            self.assertGreater(submit.call_count, 2)
+            for call in submit.call_args_list:
+                self.assertEqual(call.args[3][0], path)
+            self.assertEqual(len(pack.catalogue.products), 50)
+            self.assertEqual(pack.offers_pack.offers[-1].product_uid, 'product-49')
+            self.assertEqual(parallel._get_path(path), path)
+            with open(path, 'rb') as f:
+                self.assertEqual(parallel._get_path(f), path)
+                f.read(1)
+                self.assertIsNone(parallel._get_path(f))
+        self.assertIsNone(parallel._get_path(BytesIO(data)))
+
+    def test_split(self):
+        data = packet_xml(products=20)
+        start, end, _ = parallel._find_list(data, 'UTF-8', 'Каталог', 'Товары')
+        close_re = parallel._tag_re('Товар', 'UTF-8', r'</{name}\s*>')
+        chunks = [data[a:b] for a, b in parallel._split(data, start, end, close_re, 2000)]
+        self.assertGreater(len(chunks), 2)
+        self.assertEqual(b''.join(chunks), data[start:end])
+        for chunk in chunks[:-1]:
+            self.assertTrue(chunk.endswith('</Товар>'.encode()))
+
+    def test_serial_fallback(self):
+        with mock.patch('cml.parallel.ProcessPoolExecutor') as executor:
+            pack = items.Packet.parse(BytesIO(packet_xml(docs=1)), processes=2)
+            packet_utf16 = packet_xml(products=2).decode().replace('UTF-8', 'UTF-16').encode('utf-16')
+            self.assertEqual(len(items.Packet.parse(BytesIO(packet_utf16), processes=2).catalogue.products), 2)
+        executor.assert_not_called()
+        self.assertEqual(len(pack.docs), 1)
+
+    @override_settings(CML_PARSE_PROCESSES=2)
+    def test_setting(self):
+        with mock.patch('cml.parallel.parse') as parse:
+            items.Packet.parse(BytesIO(packet_xml(products=1)))
+        parse.assert_called_once()
@@ -0,0 +1,530 @@
+# -*- coding: utf-8 -
+from __future__ import absolute_import
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import Future
+from io import BytesIO
+from unittest import mock
+from django.contrib.auth import get_user_model
+from django.contrib.sessions.middleware import SessionMiddleware
+from django.core.exceptions import ImproperlyConfigured
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, RequestFactory, override_settings
+from cml import cache, items, views
+from cml.conf import CMLAppCong
+from cml.models import Exchange, ExchangeState, JobState
+from cml.views import ProtocolView
+from .delegate import TestDelegate, BatchTestDelegate
+from .protocol import ProtocolRequestsMixin
+from .synthetic import packet_xml
+
+
+class ImportFileTestCase(SimpleTestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp(suffix='.xml')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(packet_xml(products=25, offers=12, docs=1))
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def _import(self, delegate):
+        pv = ProtocolView()
+        pv.user_delegate = delegate
+        pv.import_file(self.path)
+        return pv
+
+    def test_whole_pack(self):
+        ud = TestDelegate()
+        pv = self._import(ud)
+        cat = ud.imported[1]
+        self.assertIsInstance(cat, items.Catalogue)
+        self.assertEqual(len(cat.products), 25)
+        self.assertEqual(len(ud.imported[2].offers), 12)
+        self.assertEqual((pv.c_imp_classifier, pv.c_imp_catalogue, pv.c_imp_offers_pack, pv.c_imp_doc),
+                         (1, 1, 1, 1))
+
+    @override_settings(CML_IMPORT_BATCH_SIZE=10)
+    def test_batches(self):
+        ud = BatchTestDelegate()
+        pv = self._import(ud)
+        self.assertEqual([type(it) for it in ud.imported],
+                         [items.Classifier, items.Catalogue, items.OffersPack, items.Document])
+        self.assertEqual([len(b) for b in ud.batches], [10, 10, 5, 10, 2])
+        self.assertEqual(ud.batches[0][0].uid, 'product-0')
+        self.assertIsInstance(ud.batches[3][0], items.Offer)
+        self.assertEqual((pv.c_imp_classifier, pv.c_imp_catalogue, pv.c_imp_offers_pack, pv.c_imp_doc),
+                         (1, 1, 1, 1))
+
+
+class ApiQueryTestCase(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+
+    def _query(self, export_orders):
+        request = RequestFactory().get('/cml', {'type': 'sale', 'mode': 'query'})
+        request.user = self.user
+        pv = ProtocolView()
+        pv.user_delegate = TestDelegate()
+        pv.user_delegate.export_orders = export_orders
+        return pv.dispatch(request)
+
+    @staticmethod
+    def _orders(count, fail_after=None):
+        for i in range(count):
+            if i == fail_after:
+                raise RuntimeError('Database is gone')
+            doc = items.Document()
+            doc.uid = f'order-{i}'
+            doc.number = str(i)
+            yield doc
+
+    def test_generator(self):
+        res = self._query(lambda: self._orders(3))
+        self.assertTrue(res.streaming)
+        pack = items.Packet.parse(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual([doc.uid for doc in pack.docs], ['order-0', 'order-1', 'order-2'])
+
+    def test_list(self):
+        res = self._query(lambda: list(self._orders(2)))
+        pack = items.Packet.parse(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual(len(pack.docs), 2)
+
+        res = self._query(lambda: [])
+        pack = items.Packet.parse(BytesIO(b''.join(res.streaming_content)))
+        self.assertEqual(pack.docs, [])
+
+    def test_error_before_start(self):
+        with self.assertLogs('cml', 'ERROR'):
+            res = self._query(lambda: self._orders(3, fail_after=0))
+        self.assertFalse(res.streaming)
+        self.assertTrue(res.content.startswith(b'failure'))
+
+    def test_error_while_streaming(self):
+        res = self._query(lambda: self._orders(3, fail_after=2))
+        with self.assertRaises(RuntimeError), self.assertLogs('cml', 'ERROR'):
+            b''.join(res.streaming_content)
+        rec = Exchange.objects.get(user=self.user)
+        self.assertEqual(rec.state, str(ExchangeState.ABORT))
+        self.assertIn('Database is gone', rec.report)
+
+
+class ApiImportTestCase(ProtocolRequestsMixin, TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+        self.delegate = TestDelegate()
+
+    def _exchange(self, data: bytes, filename='import.xml'):
+        fref = items.FileRef(filename)
+        os.makedirs(fref.full_path.parent, exist_ok=True)
+        with open(fref.full_path, 'wb') as f:
+            f.write(data)
+        self._request('init')
+        res = self._request('import', filename=filename)
+        self.assertTrue(res.content.startswith(b'success'))
+        return Exchange.objects.order_by('-pk').first()
+
+    def test_file_hash(self):
+        rec = self._exchange(packet_xml(products=1))
+        self.assertEqual(len(rec.file_hash), 64)
+        self.assertEqual(rec.state, str(ExchangeState.DONE))
+
+    @override_settings(CML_SKIP_IDENTICAL_IMPORTS=True)
+    def test_skip_identical(self):
+        data = packet_xml(products=2)
+        self._exchange(data)
+        self.assertEqual(len(self.delegate.imported), 2)
+
+        rec = self._exchange(data)
+        self.assertEqual(len(self.delegate.imported), 2)
+        self.assertIn('Import skipped', rec.report)
+        self.assertEqual(rec.state, str(ExchangeState.DONE))
+
+        # Another file name or content is imported
+        self._exchange(data, 'import_1.xml')
+        self.assertEqual(len(self.delegate.imported), 4)
+        self._exchange(packet_xml(products=3))
+        self.assertEqual(len(self.delegate.imported), 6)
+
+    @override_settings(CML_IMPORT_MODE='sliced', CML_MAX_EXEC_TIME=0, CML_IMPORT_BATCH_SIZE=2, CML_PARSE_CACHE=True)
+    def test_sliced(self):
+        self.delegate = BatchTestDelegate()
+        fref = items.FileRef('import.xml')
+        os.makedirs(fref.full_path.parent, exist_ok=True)
+        with open(fref.full_path, 'wb') as f:
+            f.write(packet_xml(products=5, offers=3))
+
+        self._request('init')
+        responses = []
+        while not responses or responses[-1].startswith(b'progress'):
+            responses.append(self._request('import', filename='import.xml').content)
+            self.assertLess(len(responses), 20, responses)
+        self.assertEqual(responses[-1], b'success\n')
+        self.assertEqual(responses[3], b'progress\nImport running: import.xml\n'
+                                       b'Imported: classifier=1 catalogue=0 offers_pack=0 doc=0')
+
+        self.assertEqual([len(batch) for batch in self.delegate.batches], [2, 2, 1, 2, 1])
+        rec = Exchange.objects.order_by('-pk').first()
+        self.assertEqual((rec.c_imp_classifier, rec.c_imp_catalogue, rec.c_imp_offers_pack), (1, 1, 1))
+        self.assertEqual((rec.job_state, rec.import_pos), (str(JobState.DONE), 0))
+        self.assertEqual(rec.state, str(ExchangeState.DONE))
+
+    @override_settings(CML_IMPORT_MODE='sliced', CML_MAX_EXEC_TIME=0, CML_PARSE_CACHE=True)
+    @mock.patch.object(cache, '_BLOCK_ITEMS', 3)
+    def test_sliced_parsing(self):
+        fref = items.FileRef('import.xml')
+        os.makedirs(fref.full_path.parent, exist_ok=True)
+        with open(fref.full_path, 'wb') as f:
+            f.write(packet_xml(products=6, offers=3))
+
+        self._request('init')
+        responses = []
+        # File is parsed to empty cache
+        with tempfile.TemporaryDirectory() as cache_root, override_settings(CML_PARSE_CACHE_ROOT=cache_root):
+            while not responses or responses[-1].startswith(b'progress'):
+                responses.append(self._request('import', filename='import.xml').content)
+                self.assertLess(len(responses), 20, responses)
+        # Each request parses a block of items to cache until time is over
+        self.assertEqual(responses[:3], [b'progress\nImport parsing: import.xml\nParsed: items=3',
+                                         b'progress\nImport parsing: import.xml\nParsed: items=6',
+                                         b'progress\nImport parsing: import.xml\nParsed: items=9'])
+        self.assertEqual(responses[-1], b'success\n')
+        self.assertEqual([type(it) for it in self.delegate.imported],
+                         [items.Classifier, items.Catalogue, items.OffersPack])
+        self.assertEqual(len(self.delegate.imported[1].products), 6)
+
+    @override_settings(CML_IMPORT_MODE='sliced')
+    def test_sliced_without_cache(self):
+        # Settings are checked once at startup
+        with self.assertRaisesMessage(ImproperlyConfigured, 'CML_PARSE_CACHE is required'):
+            CMLAppCong._configure()
+
+    def test_not_skipped_by_default(self):
+        data = packet_xml(products=2)
+        self._exchange(data)
+        self._exchange(data)
+        self.assertEqual(len(self.delegate.imported), 4)
+
+
+@override_settings(CML_IMPORT_MODE='thread', CML_DELETE_FILES_AFTER_IMPORT=False)
+class ImportJobTestCase(ProtocolRequestsMixin, TransactionTestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+        self.delegate = TestDelegate()
+        patcher = mock.patch('cml.utils.AbstractUserDelegate.get_child_instance', return_value=self.delegate)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        fref = items.FileRef('import.xml')
+        os.makedirs(fref.full_path.parent, exist_ok=True)
+        with open(fref.full_path, 'wb') as f:
+            f.write(packet_xml(products=3, offers=2))
+        self.addCleanup(shutil.rmtree, items.FileRef.base_path, ignore_errors=True)
+
+    @staticmethod
+    def _wait_jobs():
+        # Single thread of the pool runs jobs in order of submission
+        views.submit_job(lambda: None).result(timeout=30)
+
+    def test_progress(self):
+        self._request('init')
+        res = self._request('import', filename='import.xml')
+        self.assertTrue(res.content.startswith(b'progress\nImport started'))
+        self._wait_jobs()
+
+        rec = Exchange.objects.get(user=self.user)
+        self.assertEqual(rec.job_state, str(JobState.DONE))
+        self.assertIsNotNone(rec.job_heartbeat)
+        self.assertEqual(rec.state, str(ExchangeState.INIT))
+        self.assertEqual((rec.c_imp_classifier, rec.c_imp_catalogue, rec.c_imp_offers_pack), (1, 1, 1))
+        self.assertEqual(len(self.delegate.imported), 3)
+
+        res = self._request('import', filename='import.xml')
+        self.assertEqual(res.content, b'success\n')
+        rec = Exchange.objects.get(user=self.user)
+        self.assertEqual(rec.state, str(ExchangeState.DONE))
+        self.assertEqual(rec.c_imp_catalogue, 1)
+        self.assertEqual(len(self.delegate.imported), 3)
+
+    def test_running(self):
+        started, release = threading.Event(), threading.Event()
+
+        def import_catalogue(cat):
+            started.set()
+            release.wait(30)
+
+        self._request('init')
+        with mock.patch.object(self.delegate, 'import_catalogue', side_effect=import_catalogue):
+            self._request('import', filename='import.xml')
+            self.assertTrue(started.wait(30))
+            res = self._request('import', filename='import.xml')
+            release.set()
+            self._wait_jobs()
+        self.assertEqual(res.content, b'progress\nImport running: import.xml\n'
+                                      b'Imported: classifier=1 catalogue=0 offers_pack=0 doc=0')
+        self.assertEqual(self._request('import', filename='import.xml').content, b'success\n')
+
+    def test_failure(self):
+        self._request('init')
+        with mock.patch.object(self.delegate, 'import_offers', side_effect=ValueError('Database is gone')), \
+                self.assertLogs('cml', 'ERROR'):
+            self._request('import', filename='import.xml')
+            self._wait_jobs()
+        res = self._request('import', filename='import.xml')
+        self.assertEqual(res.content, b'failure\nImport failed: Database is gone')
+        rec = Exchange.objects.get(user=self.user)
+        self.assertEqual(rec.state, str(ExchangeState.ABORT))
+        self.assertEqual(rec.job_state, str(JobState.FAILED))
+
+
+class ApiFileTestCase(ProtocolRequestsMixin, TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+
+    def _upload(self, filename, data):
+        res = self._request('file', data, filename=filename)
+        self.assertEqual(res.content, b'success\n')
+
+    @staticmethod
+    def _read(filename):
+        with open(items.FileRef(filename).full_path, 'rb') as f:
+            return f.read()
+
+    @mock.patch('cml.views.UPLOAD_CHUNK_SIZE', 7)
+    def test_overwrite(self):
+        self._request('init')
+        self._upload('import.xml', b'first content')
+        self._upload('import.xml', b'second content')
+        self.assertEqual(self._read('import.xml'), b'second content')
+
+    @override_settings(CML_FILE_LIMIT=10)
+    def test_parts(self):
+        self._request('init')
+        self._upload('import.xml', b'0123456789')
+        self._upload('import.xml', b'abc')
+        self._upload('import_files/1.jpg', b'image')
+        self.assertEqual(self._read('import.xml'), b'0123456789abc')
+
+        # The file is sent again
+        self._upload('import.xml', b'new')
+        self.assertEqual(self._read('import.xml'), b'new')
+
+        self._request('init')
+        self._upload('import.xml', b'next')
+        self.assertEqual(self._read('import.xml'), b'next')
+
+    @override_settings(CML_FILE_LIMIT=10)
+    def test_retried_part(self):
+        self._request('init')
+        self._upload('import.xml', b'0123456789')
+        # Request of the next part failed after writing a half of it
+        with open(items.FileRef('import.xml').full_path, 'ab') as f:
+            f.write(b'abc')
+        self._upload('import.xml', b'abcdef')
+        self.assertEqual(self._read('import.xml'), b'0123456789abcdef')
+        self.assertEqual(Exchange.objects.get().file_size, 16)
+
+    @override_settings(CML_FILE_LIMIT=10)
+    def test_retried_file(self):
+        self._request('init')
+        # The last part is smaller than the limit, so the file is complete
+        self._upload('import.xml', b'<a>b</a>')
+        self._upload('import.xml', b'<a>b</a>')
+        self.assertEqual(self._read('import.xml'), b'<a>b</a>')
+        self._upload('import.xml', b'0123456789')
+        self._upload('import.xml', b'abc')
+        self._upload('import.xml', b'0123456789')
+        self.assertEqual(self._read('import.xml'), b'0123456789')
+        self.assertEqual(Exchange.objects.get().file_size, 10)
+
+
+class QueriesTestCase(ProtocolRequestsMixin, TestCase):
+    """Budget of database queries per protocol request"""
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+        self.delegate = TestDelegate()
+        self.addCleanup(shutil.rmtree, items.FileRef.base_path, ignore_errors=True)
+
+    def test_exchange(self):
+        # Savepoint, lock of the user, abort of previous sessions and insert
+        with self.assertNumQueries(5):
+            self._request('init')
+        with self.assertNumQueries(1):
+            self.assertEqual(self._request('file', b'image', filename='import_files/1.jpg').content, b'success\n')
+        with self.assertNumQueries(1):
+            self._request('file', packet_xml(products=2), filename='import.xml')
+        with self.assertNumQueries(2):
+            self.assertEqual(self._request('import', filename='import.xml').content, b'success\n')
+        with self.assertNumQueries(1):
+            self._request('success', p_type='sale')
+
+        rec = Exchange.objects.get()
+        self.assertEqual(rec.state, str(ExchangeState.DONE))
+        self.assertEqual((rec.c_up, rec.c_up_xml, rec.c_up_img), (2, 1, 1))
+        self.assertEqual((rec.operation, rec.file_name), ('catalog_import', 'import.xml'))
+
+    def test_init(self):
+        self._request('init')
+        rec = Exchange.objects.get()
+        self.assertEqual((rec.operation, rec.file_name, rec.report), ('catalog_init', None, 'OK'))
+
+    def test_query(self):
+        # Savepoint, lock of the user, abort of previous sessions, insert and update of export counter
+        with self.assertNumQueries(6):
+            res = self._request('query', p_type='sale')
+            b''.join(res.streaming_content)
+        rec = Exchange.objects.get()
+        self.assertEqual((rec.operation, rec.file_name, rec.c_exp_doc), ('sale_query', 'query', 1))
+
+    def test_checkauth(self):
+        request = RequestFactory().get('/cml', dict(type='catalog', mode='checkauth'))
+        SessionMiddleware(lambda r: None).process_request(request)
+        request.session.save()  # session of logged in user
+        request.user = self.user
+        with self.assertNumQueries(0):
+            res = ProtocolView().dispatch(request)
+        self.assertTrue(res.content.startswith(b'success\n'))
+
+    @override_settings(CML_FILE_LIMIT=10)
+    def test_file_parts(self):
+        self._request('init')
+        # The last operation is loaded to append parts
+        with self.assertNumQueries(2):
+            self._request('file', b'0123456789', filename='import.xml')
+        with self.assertNumQueries(2):
+            self._request('file', b'abc', filename='import.xml')
+        self.assertEqual(Exchange.objects.get().c_up, 2)
+
+    def test_not_started(self):
+        with self.assertNumQueries(1):
+            res = self._request('file', b'data', filename='import.xml')
+        self.assertEqual(res.content, b'failure\nSession has not been started. Try to make init request.')
+        self.assertFalse(items.FileRef('import.xml').full_path.exists())
+
+        with self.assertNumQueries(1):
+            res = self._request('success', p_type='sale')
+        self.assertEqual(res.content, b'failure\nSession has not been started. Try to make init request.')
+
+
+class ConcurrentUploadTestCase(ProtocolRequestsMixin, TransactionTestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+        self.addCleanup(shutil.rmtree, items.FileRef.base_path, ignore_errors=True)
+
+    def test_parallel_uploads(self):
+        self._request('init')
+        count = 16
+        barrier = threading.Barrier(count)
+        results = [None] * count
+
+        def upload(i):
+            barrier.wait(30)
+            results[i] = self._request('file', b'image', filename=f'import_files/{i}.jpg').content
+
+        threads = [threading.Thread(target=upload, args=(i, )) for i in range(count)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(60)
+        self.assertEqual(results, [b'success\n'] * count)
+
+        rec = Exchange.objects.get(user=self.user)
+        self.assertEqual(rec.state, str(ExchangeState.INIT))
+        self.assertEqual((rec.c_up, rec.c_up_img), (count, count))
+
+        self._request('success', p_type='sale')
+        # Finished session is not changed back by late request
+        res = self._request('file', b'image', filename='import_files/late.jpg')
+        self.assertTrue(res.content.startswith(b'failure'))
+        rec.refresh_from_db()
+        self.assertEqual((rec.state, rec.c_up), (str(ExchangeState.DONE), count))
+
+
+class SpeculativeParseTestCase(ProtocolRequestsMixin, TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cml', password='cml')
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        self.addCleanup(shutil.rmtree, items.FileRef.base_path, ignore_errors=True)
+        settings = override_settings(CML_SPECULATIVE_PARSE=True, CML_PARSE_CACHE=True, CML_PARSE_CACHE_ROOT=root,
+                                     CML_DELETE_FILES_AFTER_IMPORT=False)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        self.addCleanup(views._prefetched.clear)
+
+    @staticmethod
+    def _wait_prefetched():
+        views._prefetch_executor.submit(lambda: None).result(timeout=30)
+
+    def test_prefetched(self):
+        self._request('init')
+        self._request('file', packet_xml(products=3), filename='import.xml')
+        self._request('file', b'image', filename='import_files/1.jpg')
+        self._wait_prefetched()
+        with mock.patch('cml.cache._iterparse', side_effect=AssertionError('Parsed again')), \
+                mock.patch('cml.cache.file_hash', wraps=cache.file_hash) as file_hash:
+            res = self._request('import', filename='import.xml')
+        self.assertEqual(res.content, b'success\n')
+        file_hash.assert_not_called()
+        self.assertEqual(Exchange.objects.get().c_imp_catalogue, 1)
+
+    def test_changed_file(self):
+        self._request('init')
+        self._request('file', packet_xml(products=3), filename='import.xml')
+        self._wait_prefetched()
+        path = items.FileRef('import.xml').full_path
+        with open(path, 'wb') as f:
+            f.write(packet_xml(products=4))
+        self.assertIsNone(views.get_prefetched(path))
+        self.assertEqual(self._request('import', filename='import.xml').content, b'success\n')
+
+    def test_parts(self):
+        data = packet_xml(products=3)
+        limit = len(data) - 100
+        path = items.FileRef('import.xml').full_path
+        self._request('init')
+        with override_settings(CML_FILE_LIMIT=limit):
+            self._request('file', data[:limit], filename='import.xml')
+            self.assertNotIn(str(path), views._prefetched)  # more parts may follow
+            self._request('file', data[limit:], filename='import.xml')
+        self.assertIn(str(path), views._prefetched)
+        self._wait_prefetched()
+        with mock.patch('cml.cache._iterparse', side_effect=AssertionError('Parsed again')):
+            self.assertEqual(self._request('import', filename='import.xml').content, b'success\n')
+
+    @override_settings(CML_SPECULATIVE_PARSE_TIMEOUT=0.01)
+    def test_timeout(self):
+        self._request('init')
+        self._request('file', packet_xml(products=3), filename='import.xml')
+        self._wait_prefetched()
+        path = items.FileRef('import.xml').full_path
+        future = Future()  # parsing is never started
+        views._prefetched[str(path)] = (views._file_key(path), future, threading.Event())
+        self.assertEqual(self._request('import', filename='import.xml').content, b'success\n')
+        self.assertTrue(future.cancelled())
+        self.assertEqual(Exchange.objects.get().c_imp_catalogue, 1)
+
+    @override_settings(CML_SPECULATIVE_PARSE_TIMEOUT=0.01)
+    def test_running_awaited(self):
+        self._request('init')
+        self._request('file', packet_xml(products=3), filename='import.xml')
+        self._wait_prefetched()
+        path = items.FileRef('import.xml').full_path
+        future = Future()
+        future.set_running_or_notify_cancel()
+        cancelled = threading.Event()
+        views._prefetched[str(path)] = (views._file_key(path), future, cancelled)
+        timer = threading.Timer(0.1, future.set_result, ['file-hash'])
+        timer.start()
+        self.addCleanup(timer.cancel)
+        self.assertEqual(views.get_prefetched(path), 'file-hash')
+        self.assertFalse(cancelled.is_set())
@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -
+from __future__ import absolute_import
+from io import BytesIO
+from django.test import SimpleTestCase
+from cml.xml import XmlElement, XmlField, XmlFields, XmlImportException
+from .synthetic import packet_xml
+
+PATHS = ('Ид', 'Группы/Ид', 'Картинка', 'ЗначенияСвойств/ЗначенияСвойства', 'ЗначенияСвойств/*/Значение',
+         'Отсутствует', 'Группы/Отсутствует', './Ид', '{*}Ид')
+
+
+class XmlElementFindTestCase(SimpleTestCase):
+
+    def _product(self, namespace):
+        root = XmlElement.parse(BytesIO(packet_xml(products=1, namespace=namespace)))
+        return root.find('Каталог/Товары/Товар')
+
+    def test_same_as_lxml(self):
+        for namespace in (False, True):
+            el = self._product(namespace)
+            for path in PATHS:
+                expected = el.el.findall(path, namespaces=el.el.nsmap)
+                self.assertEqual([it.el for it in el.findall(path)], expected, path)
+                res = el.find(path, required=False)
+                self.assertEqual(None if res is None else res.el,
+                                 expected[0] if expected else None, path)
+
+    def test_errors(self):
+        el = self._product(True)
+        with self.assertRaisesMessage(XmlImportException,
+                                      'ElementNotFound: xpath="Каталог/Товары/Товар/Группы/Отсутствует"'):
+            el.find('Группы/Отсутствует')
+        with self.assertRaisesMessage(XmlImportException, 'ConverterError: xpath="Каталог/Товары/Товар" type=int'):
+            el.find('Ид', converter=int)
+
+
+class XmlFieldsTestCase(SimpleTestCase):
+
+    def _product(self):
+        root = XmlElement.parse(BytesIO(packet_xml(products=1)))
+        return root.find('Каталог/Товары/Товар')
+
+    def test_same_as_find(self):
+        el = self._product()
+        fields = XmlFields((
+            XmlField('Ид', 'uid', converter=str),
+            XmlField('Группы/Ид', 'groups', converter=str, many=True),
+            XmlField('ЗначенияСвойств/*/Значение', 'values', converter=str, many=True),
+            XmlField('ЗначенияСвойств/ЗначенияСвойства', 'props', many=True),
+            XmlField('Отсутствует', 'absent', converter=int, default=5),
+            XmlField('Код', 'code', converter=int),
+        ))
+        obj = fields.parse(el, type('Obj', (), {})())
+        self.assertEqual(obj.uid, el.find('Ид', converter=str))
+        self.assertEqual(obj.groups, el.findall('Группы/Ид', converter=str))
+        self.assertEqual(obj.values, el.findall('ЗначенияСвойств/*/Значение', converter=str))
+        self.assertEqual([it.el for it in obj.props],
+                         [it.el for it in el.findall('ЗначенияСвойств/ЗначенияСвойства')])
+        self.assertEqual(obj.absent, 5)
+        self.assertEqual(obj.code, 0)
+
+    def test_errors(self):
+        el = self._product()
+        fields = XmlFields((
+            XmlField('Ид', 'uid', converter=str),
+            XmlField('Группы/Отсутствует', 'absent', converter=str),
+        ))
+        with self.assertRaisesMessage(XmlImportException,
+                                      'ElementNotFound: xpath="Каталог/Товары/Товар/Группы/Отсутствует"'):
+            fields.parse(el, type('Obj', (), {})())
+
+
+class ComposeStreamTestCase(SimpleTestCase):
+
+    def test_same_as_compose(self):
+        def root():
+            el = XmlElement('Root')
+            el.set_attr('a', '1')
+            el.append(XmlElement('Header')).text = 'header'
+            return el
+
+        def children():
+            for i in range(1000):
+                child = XmlElement('Child')
+                child.text = str(i)
+                yield child
+
+        whole = root()
+        for child in children():
+            whole.append(child)
+        chunks = list(root().compose_stream(children(), chunk_size=1024))
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(b''.join(chunks), whole.compose())